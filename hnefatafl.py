@@ -3,6 +3,9 @@ A two player version of Hnefatafl, a Viking board game.
 
 A full description of the game can be found here: http://tinyurl.com/2lpvjb
 
+The rules are implemented in hnefatafl_engine, which does not depend on
+pygame. This module is the pygame front-end on top of it.
+
 Author: Sean Lowen
 Date: 7/13/2015
 
@@ -11,313 +14,125 @@ Date: 7/13/2015
 import sys
 import pygame
 from pygame.locals import *
+from hnefatafl_engine import (GameState, DIM, square, coords, iter_squares,
+                               has_legal_move)
 
 WINDOW_SIZE = WIDTH, HEIGHT = 640, 700
 MARGIN_COLOR = 128, 102, 69
 GSIZE = WIDTH // 12
 MARGIN = GSIZE // 12
 SPECIALSQS = set([(5, 5), (0, 0), (0, 10), (10, 10), (10, 0)])
+ATTACKER_COLOR = 149, 19, 62
+DEFENDER_COLOR = 52, 134, 175
+KING_COLOR = 19, 149, 62
+SELECTED_COLOR = 71, 166, 169
 
 
 class Move(object):
 
-    """The Move class contains all information about the current move state."""
+    """The Move class contains all information about the current move state.
 
-    def __init__(self):
+    The position itself is kept in a GameState; the Move object adds the
+    piece the player has selected and the restart prompt on top of it.
+    """
+
+    def __init__(self, state=None):
         """Initialized the Move object.
 
-        a_turn: Bool which is true when its the Attacker's turn, false o.w.
+        state: GameState holding the pieces and whose turn it is.
         selected: Bool which is true if a piece has been selected to move.
-        king_killed: Bool which is true if the king has been killed.
-        escaped: Bool which is true if the king escaped
-        game_over: Bool which is true if either player has won or its a draw
         restart: Bool which pauses game and asks if players want to restart
+        no_moves: Bool which is true if the side to move has no legal moves,
+                  and so has lost.
+
+        Args:
+            state (GameState): position to play from, defaults to the
+                               starting layout of Board.grid
         """
-        self.a_turn = True
+        if state is None:
+            state = GameState(Board().grid)
+        self.state = state
         self.selected = False
-        self.king_killed = False
-        self.escaped = False
-        self.game_over = False
         self.restart = False
+        self.no_moves = False
+
+    @property
+    def a_turn(self):
+        """Bool which is true when its the Attacker's turn, false o.w."""
+        return self.state.a_turn
+
+    @property
+    def king_killed(self):
+        """Bool which is true if the king has been killed."""
+        return self.state.king_killed
 
-    def select(self, piece):
+    @property
+    def escaped(self):
+        """Bool which is true if the king escaped."""
+        return self.state.escaped
+
+    @property
+    def game_over(self):
+        """Bool which is true if either player has won."""
+        return self.state.game_over or self.no_moves
+
+    def select(self, row, col):
         """Allow players to select one of their pieces to move.
 
         When a player clicks on a piece, this function first checks if they
         have chosen a piece to move already. If they have not, the function
         determines if the piece is theirs or not, and if it is, its location
-        is stored in the Move object, its color is changed so the player can
-        see what they selected, and the valid moves for that piece are
-        calculated.
+        is stored in the Move object so it is drawn in a different color, and
+        the valid moves for that piece are calculated. If a piece was already
+        selected it is deselected.
 
         Args:
-            piece (Piece): the playing piece that the player selected.
+            row (int): the row of the tile the player clicked on
+            col (int): the column of the tile the player clicked on
         """
         if not self.selected:
-            self.selected = True
-            piece.color = (71, 166, 169)
-            self.row = piece.x_tile
-            self.col = piece.y_tile
-            self.vm = self.valid_moves(piece.special_sqs)
+            if self.state.side(self.a_turn) >> square(row, col) & 1:
+                self.selected = True
+                self.row = row
+                self.col = col
+                self.vm = self.valid_moves()
         else:
             self.selected = False
-            piece.color = piece.base_color
 
-    def valid_moves(self, special_sqs):
+    def valid_moves(self):
         """Determine the valid moves for the selected piece.
 
-        Currently there are four very similar functions to determine all valid
-        moves to the left, the right, above, and below. These functions need to
-        be refactored.
-
-        Args:
-            special_sqs (bool): True if piece can move on special squares
-
         Returns:
             vm (set(int,int)): Set of valid moves.
         """
-        vm = set()
-        vm.update(self.left_bound())
-        vm.update(self.right_bound())
-        vm.update(self.up_bound())
-        vm.update(self.down_bound())
-        if not special_sqs:
-            vm.difference_update(SPECIALSQS)
-        return vm
-
-    def is_valid_move(self, pos, piece, tile_coords=False):
-        """Determine if the selected move is valid or not.
+        moves = self.state.piece_moves(square(self.row, self.col))
+        return set(coords(sq) for sq in iter_squares(moves))
 
-        The function finds the tile on the board where the player wants to move
-        their piece and returns True if the tile is in the set of valid moves
-        for the selected piece.
+    def is_valid_move(self, row, col):
+        """Determine if the selected move is valid or not.
 
         Args:
-            pos (int, int): x and y coordinates in pixels
-            piece (Piece): the selected piece
+            row (int): the row of the tile the player wants to move to
+            col (int): the column of the tile the player wants to move to
 
         Returns:
             bool: True if valid move, false o.w.
         """
-        if tile_coords:
-            row = pos[0]
-            col = pos[1]
-        else:
-            row = pos[0] // (WIDTH // 11)
-            col = pos[1] // (WIDTH // 11)
-
-        if (row, col) in self.vm:
-            piece.pos_cent(row, col)
-            self.row = row
-            self.col = col
-            return True
-        else:
-            return False
-
-    def king_escaped(self, Kings):
-        """Check if king has moved onto a corner square."""
-        king = (Kings.sprites()[0].x_tile, Kings.sprites()[0].y_tile)
-        if king in SPECIALSQS.difference([(5, 5)]):
-            self.escaped = True
-            self.game_over = True
-
-    def remove_pieces(self, g1, g2, Kings):
-        """Determine if any pieces need to be removed from the board.
-
-        check_pts is a list of four tuples. Each tuple is a tuple of tile
-        coordinates, the first of which is directly next to the square
-        where the piece moved, and the second of which is two squares away
-        in the same direction. First, the function checks to see if there is
-        an opponent's piece adjacent to where the player just moved his
-        piece. If there is one, then it checks if the other side of the
-        opponenet's piece is either occupied by the player's piece or if it
-        is an unoccupied hostile territory (SPECIALSQS). If either of those
-        is true, then the piece is captured, and removed from the board.
-
-        Args:
-            g1 (Group(sprites)): the opponent's pieces
-            g2 (Group(sprites)): the current player's pieces
-            Kings (Group(sprites)): the group containing the king
-        """
-        check_pts = set([((self.row, self.col + 1), (self.row, self.col + 2)),
-                         ((self.row + 1, self.col), (self.row + 2, self.col)),
-                         ((self.row, self.col - 1), (self.row, self.col - 2)),
-                         ((self.row - 1, self.col), (self.row - 2, self.col))])
-        captured = []
-        king = (Kings.sprites()[0].x_tile, Kings.sprites()[0].y_tile)
-        for square in check_pts:
-            if square[0] == king:
-                if Kings.sprites()[0] in g1:
-                    if self.kill_king(king[0], king[1], g2):
-                        self.king_killed = True
-                        self.game_over = True
-                        captured.append(Kings.sprites()[0])
-            else:
-                for p1 in g1:
-                    if (p1.x_tile, p1.y_tile) == square[0]:
-                        for p2 in g2:
-                            if (p2.x_tile, p2.y_tile) == (square[1]):
-                                captured.append(p1)
-                            elif square[1] in SPECIALSQS:
-                                if square[1] != king:
-                                    captured.append(p1)
-        for a in captured:
-            a.kill()
-
-    def kill_king(self, x, y, attackers):
-        """Determine if the king has been killed.
-
-        The king is killed if it is surrounded on all four sides by attacking
-        pieces or hostile territories.
-
-        Args:
-            x (int): x tile coordinate of the king
-            y (int): y tile coordinate of the king
-
-        Returns:
-            True if king has been killed, False o.w.
-        """
-        kill_pts = set([(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)])
-        kill_pts.difference_update(SPECIALSQS)
-        attack_pts = set()
-        for pt in kill_pts:
-            for a in attackers:
-                try:
-                    attack_pts.add((a.x_tile, a.y_tile))
-                except KeyError:
-                    pass
-        kill_pts.difference_update(attack_pts)
-        if not kill_pts:
-            return True
-
-    def left_bound(self):
-        """Find the all valid moves to the left of the selected piece.
-
-        Iterates through all spaces to the left until the space is either
-        occupied or it has reached the edge of the board. Every valid move
-        is added to a set of valid moves, which is returned.
-
-        Returns:
-            vm (set(int, int)): Set of tuples of the tile coordinates of
-                                valid moves to the left.
-        """
-        vm = set()
-        temp_row = self.row - 1
-        while True:
-            if temp_row < 0:
-                return vm
-            for p in Pieces:
-                ppos = self.ppos_cent(temp_row, self.col)
-                if p.rect.collidepoint(ppos):
-                    return vm
-            vm.add((temp_row, self.col))
-            temp_row -= 1
-
-    def right_bound(self):
-        """Find the all valid moves to the right of the selected piece.
-
-        Iterates through all spaces to the right until the space is either
-        occupied or it has reached the edge of the board. Every valid move
-        is added to a set of valid moves, which is returned.
+        return (row, col) in self.vm
 
-        Returns:
-            vm (set(int, int)): Set of tuples of the tile coordinates of
-                                valid moves to the right.
-        """
-        vm = set()
-        temp_row = self.row + 1
-        clear = True
-        while clear:
-            if temp_row > 10:
-                return vm
-            for p in Pieces:
-                ppos = self.ppos_cent(temp_row, self.col)
-                if p.rect.collidepoint(ppos):
-                    return vm
-            vm.add((temp_row, self.col))
-            temp_row += 1
-
-    def up_bound(self):
-        """Find the all valid moves above the selected piece.
-
-        Iterates through all spaces above until the space is either
-        occupied or it has reached the edge of the board. Every valid move
-        is added to a set of valid moves, which is returned.
-
-        Returns:
-            vm (set(int, int)): Set of tuples of the tile coordinates of
-                                valid moves above.
-        """
-        vm = set()
-        temp_col = self.col - 1
-        clear = True
-        while clear:
-            if temp_col < 0:
-                return vm
-            for p in Pieces:
-                ppos = self.ppos_cent(self.row, temp_col)
-                if p.rect.collidepoint(ppos):
-                    return vm
-            vm.add((self.row, temp_col))
-            temp_col -= 1
-
-    def down_bound(self):
-        """Find the all valid moves below the selected piece.
-
-        Iterates through all spaces below until the space is either
-        occupied or it has reached the edge of the board. Every valid move
-        is added to a set of valid moves, which is returned.
-
-        Returns:
-            vm (set(int, int)): Set of tuples of the tile coordinates of
-                                valid moves below.
-        """
-        vm = set()
-        temp_col = self.col + 1
-        clear = True
-        while clear:
-            if temp_col > 10:
-                return vm
-            for p in Pieces:
-                ppos = self.ppos_cent(self.row, temp_col)
-                if p.rect.collidepoint(ppos):
-                    return vm
-            vm.add((self.row, temp_col))
-            temp_col += 1
-
-    def ppos(self, x):
-        """Find the top or left pixel position of a given tile.
+    def end_turn(self, row, col):
+        """Play the selected move and end the turn.
 
-        Args:
-            x (int): the row or column number
-
-        Returns:
-            (int): the top or left pixel location of the tile.
-        """
-        return x*(GSIZE + (GSIZE // 12)) + (GSIZE // 12)
-
-    def ppos_cent(self, x, y):
-        """Find the center pixel position of a given tile.
+        The selected piece is moved, any captured pieces are removed and the
+        game state checks if the king escaped or was killed. Then the turn
+        passes to the other player and the piece is deselected.
 
         Args:
-            x (int): the row number
-            y (int): the column number
-
-        Returns:
-            (int, int): tuple of the center pixel location of tile
-        """
-        return (self.ppos(x) + (GSIZE // 2), self.ppos(y) + (GSIZE // 2))
-
-    def end_turn(self, piece):
-        """Perform some cleanup to end the turn.
-
-        Once the turn has been completed, the a_turn bool is flipped so the
-        other player can go, the selected piece is deselected, and its color
-        returns to normal.
+            row (int): the row of the tile the piece moves to
+            col (int): the column of the tile the piece moves to
         """
-        self.a_turn = not self.a_turn
+        self.state.move(square(self.row, self.col), square(row, col))
         self.selected = False
-        piece.color = piece.base_color
 
 
 class Board(object):
@@ -363,208 +178,186 @@ class Board(object):
         self.dim = len(self.grid)
 
 
-class Piece(pygame.sprite.Sprite):
+def tile(pos):
+    """Find the tile under a pixel position.
 
-    """Class for all playing pieces.
+    Args:
+        pos (int, int): x and y coordinates in pixels
 
-    Pieces are pygame sprite objects. It makes grouping, determining
-    collisions, and removing pieces very simple.
+    Returns:
+        (int, int): the row and column of the tile, or None if the position
+                    is off the board, such as in the status bar
     """
+    row, col = pos[0] // (GSIZE + MARGIN), pos[1] // (GSIZE + MARGIN)
+    if 0 <= row < DIM and 0 <= col < DIM:
+        return row, col
+    return None
 
-    def __init__(self, x, y):
-        """Create a piece at a given location.
 
-        special_sqs, a bool which dermines if a piece is allowed to move
-        onto the corners or center square, defaults to False.
+def ppos_cent(x, y):
+    """Find the center pixel position of a given tile.
 
-        Args:
-            x (int): the row that the piece will be placed
-            y (int): the column that the piece will be placed.
-        """
-        pygame.sprite.Sprite.__init__(self, self.groups)
-        self.special_sqs = False
-        self.pos_cent(x, y)
+    Args:
+        x (int): the row number
+        y (int): the column number
+
+    Returns:
+        (int, int): tuple of the center pixel location of tile
+    """
+    return (x*(GSIZE + MARGIN) + MARGIN + GSIZE // 2,
+            y*(GSIZE + MARGIN) + MARGIN + GSIZE // 2)
 
-    def pos(self, x):
-        """Find the top or left pixel position of a given tile.
 
-        Args:
-            x (int): the row or column number
+class Renderer(object):
 
-        Returns:
-            (int): the top or left pixel location of the tile.
-        """
-        return x*(GSIZE + (GSIZE // 12)) + (GSIZE // 12)
+    """Draws the game, redrawing only the parts of the window that changed.
 
-    def pos_cent(self, x, y):
-        """Find the center pixel position of a given tile.
+    The empty board is drawn once onto a cached surface. Each frame, the
+    pieces and selection are compared with the last frame drawn, and only
+    the tiles that differ, plus the status text if it changed, are redrawn
+    from the cached board and updated on the display.
+    """
 
-        Stores coordinates of the tile (x_tile and y_tile) as well as the
-        center pixel locations of the tiles.
+    def __init__(self, screen, board):
+        """Create a renderer and draw the empty board.
 
         Args:
-            x (int): the row number
-            y (int): the column number
-
-        Returns:
-            (int, int): tuple of the center pixel location of tile
+            screen (pygame.Surface): game window that the user interacts with
+            board (Board): the board that the pieces are on
         """
-        self.x_tile = x
-        self.y_tile = y
-        self.x_px = self.pos(x) + (GSIZE // 2)
-        self.y_px = self.pos(y) + (GSIZE // 2)
-        self.rect = pygame.Rect([self.x_px - GSIZE//2,
-                                 self.y_px - GSIZE//2,
-                                 GSIZE,
-                                 GSIZE])
+        self.screen = screen
+        self.background = pygame.Surface(screen.get_size())
+        self.background.fill(MARGIN_COLOR)
+        for y in range(board.dim):
+            for x in range(board.dim):
+                xywh = [x*(GSIZE + MARGIN) + MARGIN,
+                        y*(GSIZE + MARGIN) + MARGIN,
+                        GSIZE,
+                        GSIZE]
+                pygame.draw.rect(self.background,
+                                 board.colors[board.grid[x][y]], xywh)
+        self.font = pygame.font.Font(None, 36)
+        self.messages = {}
+        self.status_rect = pygame.Rect(0, WIDTH, WIDTH, HEIGHT - WIDTH)
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the last frame, so the next one is drawn in full."""
+        self.pieces = None
+        self.selected = None
+        self.status = None
+
+    def render(self, text):
+        """Render a line of status text, reusing earlier renders."""
+        msg = self.messages.get(text)
+        if msg is None:
+            msg = self.messages[text] = self.font.render(text, 1, (0, 0, 0))
+        return msg
+
+    def tile_rect(self, x, y):
+        """Return the area of a tile and the margin around it."""
+        return pygame.Rect(x*(GSIZE + MARGIN), y*(GSIZE + MARGIN),
+                           GSIZE + 2*MARGIN, GSIZE + 2*MARGIN)
+
+    def draw(self, move, text, text2):
+        """Draw the changes since the last frame and update the display.
 
-    def draw(self, screen):
-        """Draw the piece on the board in the correct location."""
-        pygame.draw.circle(screen, self.color, [self.x_px, self.y_px],
-                           GSIZE//2)
-
-
-class Attacker(Piece):
-
-    """Class for all attacking pieces; inherits from Piece."""
-
-    def __init__(self, x, y):
-        """Inherit from Piece and give attacking piece a color."""
-        Piece.__init__(self, x, y)
-        pygame.sprite.Sprite.__init__(self, self.groups)
-        self.base_color = (149, 19, 62)
-        self.color = self.base_color
-
-
-class Defender(Piece):
-
-    """Class for all defending pieces; inherits from Piece."""
-
-    def __init__(self, x, y):
-        """Inherit from Piece and give attacking piece a color."""
-        Piece.__init__(self, x, y)
-        pygame.sprite.Sprite.__init__(self, self.groups)
-        self.base_color = (52, 134, 175)
-        self.color = self.base_color
-
-
-class King(Defender):
-
-    """Class for king; inherits from Defender."""
-
-    def __init__(self, x, y):
-        """Inherit from Piece and give attacking piece a color.
-
-        The king can move on special squares, so special_sqs is True.
+        Args:
+            move (Move): the move state data
+            text (str): first line of the status text
+            text2 (str): second line of the status text, or None
         """
-        Defender.__init__(self, x, y)
-        pygame.sprite.Sprite.__init__(self, self.groups)
-        self.base_color = (19, 149, 62)
-        self.color = self.base_color
-        self.special_sqs = True
-
-
-def initialize_groups():
-    """Create global groups for different pieces.
-
-    Notes:
-        The groups are defined as follows:
-            Pieces: all pieces
-            Attackers: all attacking pieces
-            Defenders: all defending pieces, including king
-            Kings: the king piece
-            Current: the current selected piece
-    """
-    global Pieces
-    global Attackers
-    global Defenders
-    global Kings
-    global Current
-
-    Pieces = pygame.sprite.Group()
-    Attackers = pygame.sprite.Group()
-    Defenders = pygame.sprite.Group()
-    Kings = pygame.sprite.Group()
-    Current = pygame.sprite.Group()
-
-    Piece.groups = Pieces
-    Defender.groups = Pieces, Defenders
-    Attacker.groups = Pieces, Attackers
-    King.groups = Pieces, Defenders, Kings
-
+        state = move.state
+        pieces = (state.attackers, state.defenders, state.king)
+        selected = (move.row, move.col) if move.selected else None
+        full = self.pieces is None
+        if full:
+            self.screen.blit(self.background, (0, 0))
+            dirty = state.occupied()
+        else:
+            dirty = 0
+            for new, old in zip(pieces, self.pieces):
+                dirty |= new ^ old
+        squares = set(coords(sq) for sq in iter_squares(dirty))
+        if selected != self.selected:
+            for sq in (selected, self.selected):
+                if sq is not None:
+                    squares.add(sq)
+
+        rects = []
+        for x, y in squares:
+            if not full:
+                rect = self.tile_rect(x, y)
+                self.screen.blit(self.background, rect, rect)
+                rects.append(rect)
+            bit = 1 << square(x, y)
+            if not state.occupied() & bit:
+                continue
+            if (x, y) == selected:
+                color = SELECTED_COLOR
+            elif state.attackers & bit:
+                color = ATTACKER_COLOR
+            elif state.king & bit:
+                color = KING_COLOR
+            else:
+                color = DEFENDER_COLOR
+            pygame.draw.circle(self.screen, color, ppos_cent(x, y), GSIZE//2)
+
+        if full or (text, text2) != self.status:
+            """Write which player's turn it is on the bottom of the window."""
+            self.screen.blit(self.background, self.status_rect,
+                             self.status_rect)
+            msg = self.render(text)
+            msgpos = msg.get_rect()
+            msgpos.centerx = self.screen.get_rect().centerx
+            if text2:
+                msg2 = self.render(text2)
+                msgpos2 = msg2.get_rect()
+                msgpos.centery = ((HEIGHT - WIDTH) / 7) + WIDTH
+                msgpos2.centerx = self.screen.get_rect().centerx
+                msgpos2.centery = (5 * (HEIGHT - WIDTH) / 7) + WIDTH
+                self.screen.blit(msg, msgpos)
+                self.screen.blit(msg2, msgpos2)
+            else:
+                msgpos.centery = ((HEIGHT - WIDTH) / 2) + WIDTH
+                self.screen.blit(msg, msgpos)
+            rects.append(self.status_rect)
 
-def initialize_pieces(board):
-    """Create all of the game pieces and put them in groups.
+        self.pieces = pieces
+        self.selected = selected
+        self.status = (text, text2)
+        if full:
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update(rects)
 
-    Note:
-        The board layout from Board class is used for initial placement of
-        pieces.
 
-    Args:
-        board (Board): the game board object
-    """
-    for y in range(board.dim):
-        for x in range(board.dim):
-            p = board.grid[y][x]
-            if p == "a":
-                Attacker(x, y)
-            elif p == "d":
-                Defender(x, y)
-            elif p == "c":
-                King(x, y)
+renderer = None
 
 
 def update_image(screen, board, move, text, text2):
     """Update the image that the users see.
 
-    Note:
-        Right now, it redraws the whole board every time it goes through this
-        function. In the future, it should only update the necessary tiles.
+    Only the tiles and text that changed since the last call are redrawn,
+    using a Renderer that is kept for the screen between calls.
 
     Args:
         screen (pygame.Surface): game window that the user interacts with
         board (Board): the board that the pieces are on
         move (Move): the move state data
     """
-    screen.fill(MARGIN_COLOR)
-    for y in range(board.dim):
-        for x in range(board.dim):
-            xywh = [x*(GSIZE + MARGIN) + MARGIN,
-                    y*(GSIZE + MARGIN) + MARGIN,
-                    GSIZE,
-                    GSIZE]
-            pygame.draw.rect(screen, board.colors[board.grid[x][y]], xywh)
-
-    for piece in Pieces:
-        piece.draw(screen)
-
-    """Write which player's turn it is on the bottom of the window."""
-    font = pygame.font.Font(None, 36)
-    msg = font.render(text, 1, (0, 0, 0))
-    msgpos = msg.get_rect()
-    if text2:
-        msg2 = font.render(text2, 1, (0, 0, 0))
-        msgpos2 = msg2.get_rect()
-        msgpos.centerx = screen.get_rect().centerx
-        msgpos.centery = ((HEIGHT - WIDTH) / 7) + WIDTH
-        msgpos2.centerx = screen.get_rect().centerx
-        msgpos2.centery = (5 * (HEIGHT - WIDTH) / 7) + WIDTH
-        screen.blit(msg, msgpos)
-        screen.blit(msg2, msgpos2)
-    else:
-        msgpos.centerx = screen.get_rect().centerx
-        msgpos.centery = ((HEIGHT - WIDTH) / 2) + WIDTH
-        screen.blit(msg, msgpos)
-
-    pygame.display.flip()
-
-
-def run_game(screen):
+    global renderer
+    if renderer is None or renderer.screen is not screen:
+        renderer = Renderer(screen, board)
+    renderer.draw(move, text, text2)
+
+
+def run_game(screen, attacker=None, defender=None, fps=30):
     """Start and run a new game of hnefatafl.
 
-    The game, groups, board, move info, screen, and pieces are initialized
-    first. Then, the game starts. It runs in a while loop, which will exit
-    if the user closes out of the game. Another event that it listens
+    The game, board, move info and screen are initialized first. Then, the
+    game starts. It runs in a while loop, which will exit if the user
+    closes out of the game. Another event that it listens
     for is a MOUSEBUTTONDOWN event; the game takes action when the user clicks
     on the board. If a piece has not been selected yet and the user clicks on
     one of his pieces, then the piece will be selected and change colors. The
@@ -574,22 +367,78 @@ def run_game(screen):
     also listens for KEYDOWN event. If the game has ended or the player wants
     to restart the game, it will listen for 'y' or 'n'. If the player wants
     to restart the game, they can press 'r', which will require confirmation
-    before actually restarting.
+    before actually restarting. When it is the turn of a side played by the
+    computer, its move is chosen and played without waiting for a click.
+    A side left without a legal move loses, and the game ends there.
+
+    While waiting for a human, the loop sleeps until the next event rather
+    than polling, and the window is only redrawn after something changed.
+    The loop runs at most fps times a second.
 
     Args:
         screen (pygame.Surface): The game window
+        attacker (function): picks a (from square, to square) move for the
+                             attackers in a GameState, or None for a human
+        defender (function): picks a move for the defenders, or None for a
+                             human
+        fps (int): cap on the number of frames drawn per second, or None
 
     Returns:
         True if players want a new game, False o.w.
     """
     board = Board()
     move = Move()
-    initialize_pieces(board)
+    clock = pygame.time.Clock()
+    changed = True
     while 1:
-        for event in pygame.event.get():
+        if changed and not move.game_over and not has_legal_move(move.state):
+            # A side that cannot move loses
+            move.no_moves = True
+        """Text to display on bottom of game."""
+        text2 = None
+        if move.a_turn:
+            text = "Attacker's Turn"
+        if not move.a_turn:
+            text = "Defender's Turn"
+        if move.escaped:
+            text = "King escaped! Defenders win!"
+            text2 = "Play again? y/n"
+        if move.king_killed:
+            text = "King killed! Attackers win!"
+            text2 = "Play again? y/n"
+        if move.no_moves:
+            if move.a_turn:
+                text = "Attackers cannot move! Defenders win!"
+            else:
+                text = "Defenders cannot move! Attackers win!"
+            text2 = "Play again? y/n"
+        if move.restart:
+            text = "Restart game? y/n"
+        if changed:
+            update_image(screen, board, move, text, text2)
+            changed = False
+
+        player = attacker if move.a_turn else defender
+        if player is not None and not move.game_over and not move.restart:
+            choice = player(move.state)
+            if choice is None:
+                # No legal moves: the side to move loses
+                move.no_moves = True
+            else:
+                move.state.move(*choice)
+            changed = True
+            events = pygame.event.get()
+        else:
+            events = [pygame.event.wait()] + pygame.event.get()
+
+        for event in events:
             if event.type == QUIT:
                 sys.exit()
+            if event.type == VIDEOEXPOSE and renderer is not None:
+                renderer.invalidate()
+                changed = True
             if event.type == pygame.KEYDOWN:
+                changed = True
                 if move.game_over and event.key == pygame.K_n:
                     return False
                 if move.game_over and event.key == pygame.K_y:
@@ -601,76 +450,35 @@ def run_game(screen):
                 if event.key == pygame.K_r:
                     move.restart = True
             if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                pos = pygame.mouse.get_pos()
+                changed = True
+                clicked = tile(event.pos)
+                if clicked is None:
+                    continue
+                row, col = clicked
                 if move.game_over:
                     pass
                 elif move.restart:
                     pass
                 elif not move.selected:
-                    if move.a_turn:
-                        for piece in Attackers:
-                            if piece.rect.collidepoint(pos):
-                                move.select(piece)
-                                Current.add(piece)
-                    else:
-                        for piece in Defenders:
-                            if piece.rect.collidepoint(pos):
-                                move.select(piece)
-                                Current.add(piece)
+                    move.select(row, col)
                 else:
-                    if Current.sprites()[0].rect.collidepoint(pos):
-                        move.select(Current.sprites()[0])
-                        Current.empty()
-                    elif move.is_valid_move(pos, Current.sprites()[0]):
-                        if Current.sprites()[0] in Kings:
-                            move.king_escaped(Kings)
-                        if move.a_turn:
-                            move.remove_pieces(Defenders, Attackers, Kings)
-                        else:
-                            move.remove_pieces(Attackers, Defenders, Kings)
-                        move.end_turn(Current.sprites()[0])
-                        Current.empty()
-
-        """Text to display on bottom of game."""
-        text2 = None
-        if move.a_turn:
-            text = "Attacker's Turn"
-        if not move.a_turn:
-            text = "Defender's Turn"
-        if move.escaped:
-            text = "King escaped! Defenders win!"
-            text2 = "Play again? y/n"
-        if move.king_killed:
-            text = "King killed! Attackers win!"
-            text2 = "Play again? y/n"
-        if move.restart:
-            text = "Restart game? y/n"
-        update_image(screen, board, move, text, text2)
-
-
-def cleanup():
-    """Empty out all groups of sprites.
-
-    Note:
-        Although this works for now, I don't think that it properly deletes
-        all of the sprites. Must fix this.
-    """
-    Current.empty()
-    Kings.empty()
-    Defenders.empty()
-    Attackers.empty()
-    Pieces.empty()
+                    if (row, col) == (move.row, move.col):
+                        move.select(row, col)
+                    elif move.is_valid_move(row, col):
+                        move.end_turn(row, col)
+        if fps:
+            clock.tick(fps)
 
 
 def main():
     """Main function- initializes screen and starts new games."""
     pygame.init()
     screen = pygame.display.set_mode(WINDOW_SIZE)
-    initialize_groups()
+    # Mouse motion is never used, so don't wake up the game loop for it
+    pygame.event.set_blocked(MOUSEMOTION)
     play = True
     while play:
         play = run_game(screen)
-        cleanup()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,408 @@
+"""
+Move generation checks and benchmarks for Hnefatafl.
+
+perft counts the positions reached by every sequence of legal moves, which
+checks move generation and captures against the reference counts below.
+check plays random games and compares the captures of every legal move
+with the captures worked out from the bitboards alone.
+The benchmarks time move generation, random playouts (one at a time and in
+batches), MCTS simulations, model evaluation and drawing a frame, and can
+write their results as JSON to compare releases.
+
+Usage:
+    python hnefatafl_bench.py perft 3 [--divide] [--position FILE]
+    python hnefatafl_bench.py check [--games 10]
+    python hnefatafl_bench.py bench [--output results.json]
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import hnefatafl_engine as engine
+
+# perft counts for the starting layout. Depths 1 to 3 were also checked
+# against the original sprite-based move generation.
+PERFT_REFERENCE = {1: 116, 2: 6788, 3: 806344, 4: 50456804}
+
+
+def load_position(path, defenders_to_move=False):
+    """Read a position from a file in the format of Board.grid.
+
+    Args:
+        path (str): file with one line of 11 tiles per row
+        defenders_to_move (bool): True if the defenders move first
+
+    Returns:
+        (GameState): the position
+    """
+    with open(path) as f:
+        grid = [line.strip() for line in f if line.strip()]
+    state = engine.GameState(grid)
+    if defenders_to_move:
+        state.a_turn = False
+        state.hash = state.compute_hash()
+    return state
+
+
+def check_perft(max_depth=3):
+    """Compare perft of the starting layout with the reference counts.
+
+    Args:
+        max_depth (int): deepest reference count to check
+
+    Returns:
+        list((int, int, int)): (depth, expected, actual) for every depth
+                               that does not match
+    """
+    failures = []
+    for depth in range(1, max_depth + 1):
+        nodes = engine.perft(engine.GameState(), depth)
+        if nodes != PERFT_REFERENCE[depth]:
+            failures.append((depth, PERFT_REFERENCE[depth], nodes))
+    return failures
+
+
+def reference_captures(state, frm, to):
+    """Find the pieces a move would capture from the bitboards alone.
+
+    This is how GameState found captures before it kept a table of the
+    piece on every square, by shifting the destination square towards its
+    neighbours; check_captures compares the two.
+
+    Args:
+        state (GameState): position to play the move in; it is not changed
+        frm (int): square the piece is on
+        to (int): square the piece moves to
+
+    Returns:
+        (int): bitboard of the pieces that would be captured
+    """
+    bits = (1 << frm) | (1 << to)
+    attackers, defenders, king = state.attackers, state.defenders, state.king
+    attacker = bool(attackers >> frm & 1)
+    if attacker:
+        attackers ^= bits
+    elif king >> frm & 1:
+        king ^= bits
+    else:
+        defenders ^= bits
+    occupied = attackers | defenders | king
+    if attacker:
+        friends, enemies = attackers, defenders
+    else:
+        friends, enemies = defenders | king, attackers
+    hostile = friends | (engine.SPECIAL & ~occupied)
+    captured = 0
+    for shift in engine.SHIFTS:
+        adjacent = shift(1 << to) & enemies
+        if adjacent and shift(adjacent) & hostile:
+            captured |= adjacent
+    if (attacker and engine.NEIGHBORS[to] & king and not king & engine.EDGES
+            and not engine.NEIGHBORS[king.bit_length() - 1] &
+            ~(attackers | engine.SPECIAL)):
+        captured |= king
+    return captured
+
+
+def check_captures(num_games=10, seed=0):
+    """Compare the captures of every legal move in random games with
+    reference_captures, and the square table with the bitboards.
+
+    Args:
+        num_games (int): number of random games to check
+        seed (int): seed for the moves, so the games can be replayed
+
+    Returns:
+        (int, int, list): moves checked, moves that capture, and for every
+                          mismatch the position's hash, the move, and the
+                          expected and actual captures
+    """
+    rng = random.Random(seed)
+    checked = captures = 0
+    failures = []
+    for _ in range(num_games):
+        state = engine.GameState()
+        while not state.game_over:
+            for piece, bb in ((engine.ATTACKER, state.attackers),
+                              (engine.DEFENDER, state.defenders),
+                              (engine.KING, state.king)):
+                for sq in engine.iter_squares(bb):
+                    if state.squares[sq] != piece:
+                        failures.append((state.hash, None, piece,
+                                         state.squares[sq]))
+            if sum(p is not None for p in state.squares) != engine.popcount(
+                    state.occupied()):
+                failures.append((state.hash, None, None, None))
+            moves = state.legal_moves()
+            if not moves:
+                break
+            for frm, to in moves:
+                expected = reference_captures(state, frm, to)
+                actual = state.move_captures(frm, to)
+                checked += 1
+                captures += bool(expected)
+                if actual != expected:
+                    failures.append((state.hash, (frm, to), expected, actual))
+            state.move(*rng.choice(moves))
+    return checked, captures, failures
+
+
+def bench_perft(depth=3):
+    """Time perft of the starting layout.
+
+    Returns:
+        (dict): depth, nodes, seconds and nodes per second
+    """
+    state = engine.GameState()
+    start = time.time()
+    nodes = engine.perft(state, depth)
+    elapsed = time.time() - start
+    return {"depth": depth, "nodes": nodes, "seconds": elapsed,
+            "nodes_per_sec": nodes / elapsed,
+            "matches_reference": nodes == PERFT_REFERENCE.get(depth)}
+
+
+def bench_playouts(num_games=100, seed=0):
+    """Time random games played to completion from the starting layout.
+
+    Returns:
+        (dict): games, moves, seconds, games per second and moves per second
+    """
+    start = time.time()
+    results = engine.play_random_games(num_games, seed=seed)
+    elapsed = time.time() - start
+    moves = sum(n for _, n in results)
+    return {"games": num_games, "moves": moves, "seconds": elapsed,
+            "games_per_sec": num_games / elapsed,
+            "moves_per_sec": moves / elapsed}
+
+
+def bench_vec_playouts(num_steps=200, batch_size=256, seed=0):
+    """Time random games played in batches with hnefatafl_vec.
+
+    Returns:
+        (dict): batch size, moves, games finished, seconds and moves per
+                second, or None if NumPy is not installed
+    """
+    try:
+        import numpy as np
+        import hnefatafl_vec as vec
+    except ImportError:
+        return None
+    rng = np.random.RandomState(seed)
+    env = vec.VecGame(batch_size)
+    start = time.time()
+    for _ in range(num_steps):
+        env.step(env.random_actions(rng))
+    elapsed = time.time() - start
+    moves = num_steps * batch_size
+    return {"batch_size": batch_size, "moves": moves,
+            "games": env.games_played, "seconds": elapsed,
+            "moves_per_sec": moves / elapsed}
+
+
+def bench_mcts(num_simulations=2000, playout_simulations=50):
+    """Time MCTS from the starting layout, with both leaf evaluations.
+
+    Returns:
+        (dict): simulations, seconds and simulations per second with the
+                default static evaluation and with random playouts, or None
+                if NumPy is not installed
+    """
+    try:
+        import hnefatafl_mcts as mcts
+    except ImportError:
+        return None
+    results = {}
+    for name, simulations, playouts in (
+            ("static", num_simulations, False),
+            ("playouts", playout_simulations, True)):
+        result = mcts.MCTS(playouts=playouts).search(engine.GameState(),
+                                                     simulations)
+        results[name] = {"simulations": result.simulations,
+                         "seconds": result.elapsed,
+                         "sims_per_sec": result.simulations_per_sec}
+    return results
+
+
+def bench_model(num_moves=20):
+    """Time do_best_move with an untrained model.
+
+    Returns:
+        (dict): positions scored, seconds and positions per second, or None
+                if the model cannot be built here
+    """
+    try:
+        import numpy as np
+        import hnefatafl_train as train
+        # TensorFlow is only imported once the model is built, and the
+        # first prediction traces it, so both are kept out of the timing
+        model = train.initialize_random_nn_model()
+        model.predict(np.zeros((1, engine.NUM_SQUARES)), verbose=0)
+    except ImportError:
+        return None
+    state = engine.GameState()
+    positions = 0
+    start = time.time()
+    for _ in range(num_moves):
+        if state.game_over:
+            break
+        positions += len(state.legal_moves())
+        train.do_best_move(state, model)
+    elapsed = time.time() - start
+    return {"positions": positions, "seconds": elapsed,
+            "positions_per_sec": positions / elapsed}
+
+
+def bench_render(num_frames=200, seed=0):
+    """Time drawing the board with the pygame front-end.
+
+    A random move is played before every frame, so each frame redraws the
+    tiles it changed. Drawing the whole window is timed separately. Without
+    a display, SDL's dummy video driver is used.
+
+    Returns:
+        (dict): frames, seconds and milliseconds per frame after a move and
+                for the whole window, or None if pygame is not installed
+    """
+    if not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")):
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        import pygame
+        import hnefatafl as tafl
+    except ImportError:
+        return None
+    pygame.init()
+    screen = pygame.display.set_mode(tafl.WINDOW_SIZE)
+    board = tafl.Board()
+    rng = random.Random(seed)
+    moves = []
+    state = engine.GameState()
+    while len(moves) < num_frames:
+        move = engine.random_move(state, rng)
+        if move is None or state.game_over:
+            state = engine.GameState()
+            continue
+        state.move(*move)
+        moves.append(state.copy())
+    renderer = tafl.Renderer(screen, board)
+    start = time.time()
+    for state in moves:
+        renderer.draw(tafl.Move(state), "Attacker's Turn", None)
+    elapsed = time.time() - start
+    start = time.time()
+    for state in moves:
+        renderer.invalidate()
+        renderer.draw(tafl.Move(state), "Attacker's Turn", None)
+    full = time.time() - start
+    pygame.quit()
+    return {"frames": num_frames, "seconds": elapsed,
+            "ms_per_frame": 1000. * elapsed / num_frames,
+            "ms_per_full_frame": 1000. * full / num_frames}
+
+
+def git_revision():
+    """Return the current git commit, or None outside a checkout."""
+    try:
+        out = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def run_benchmarks(perft_depth=3, num_games=100, num_moves=20,
+                   num_frames=200, num_simulations=2000):
+    """Run every benchmark.
+
+    Returns:
+        (dict): the results of each benchmark, and where they were run
+    """
+    return {"revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "perft": bench_perft(perft_depth),
+            "playouts": bench_playouts(num_games),
+            "vec_playouts": bench_vec_playouts(),
+            "mcts": bench_mcts(num_simulations),
+            "model": bench_model(num_moves),
+            "render": bench_render(num_frames)}
+
+
+def main(argv=None):
+    """Command line entry point for perft and the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser("perft", help="count positions to a depth")
+    p.add_argument("depth", type=int)
+    p.add_argument("--divide", action="store_true",
+                   help="print the count after each first move")
+    p.add_argument("--position", help="file with a Board.grid layout")
+    p.add_argument("--defenders-to-move", action="store_true")
+    c = commands.add_parser("check", help="check captures over random games")
+    c.add_argument("--games", type=int, default=10)
+    c.add_argument("--seed", type=int, default=0)
+    b = commands.add_parser("bench", help="run the benchmarks")
+    b.add_argument("--output", help="write the results to this JSON file")
+    b.add_argument("--perft-depth", type=int, default=3)
+    b.add_argument("--games", type=int, default=100)
+    b.add_argument("--moves", type=int, default=20)
+    b.add_argument("--frames", type=int, default=200)
+    b.add_argument("--simulations", type=int, default=2000,
+                   help="MCTS simulations with the static evaluation")
+    args = parser.parse_args(argv)
+
+    if args.command == "perft":
+        if args.position:
+            state = load_position(args.position, args.defenders_to_move)
+        else:
+            state = engine.GameState()
+        start = time.time()
+        if args.divide:
+            nodes = 0
+            for (frm, to), count in engine.perft_divide(state, args.depth):
+                print("{}-{}: {}".format(engine.coords(frm),
+                                         engine.coords(to), count))
+                nodes += count
+        else:
+            nodes = engine.perft(state, args.depth)
+        elapsed = time.time() - start
+        print("perft({}) = {} in {:.2f}s ({:.0f} nodes/sec)".format(
+            args.depth, nodes, elapsed, nodes / max(elapsed, 1e-9)))
+        if not args.position and args.depth in PERFT_REFERENCE:
+            if nodes != PERFT_REFERENCE[args.depth]:
+                print("MISMATCH: expected {}".format(
+                    PERFT_REFERENCE[args.depth]))
+                return 1
+    elif args.command == "check":
+        checked, captures, failures = check_captures(args.games, args.seed)
+        print("Checked {} moves in {} games, {} with captures: {} "
+              "mismatches".format(checked, args.games, captures,
+                                  len(failures)))
+        for failure in failures[:10]:
+            print("MISMATCH: hash {:016x}, move {}, expected {}, got "
+                  "{}".format(*failure))
+        if failures:
+            return 1
+    elif args.command == "bench":
+        results = run_benchmarks(args.perft_depth, args.games, args.moves,
+                                 args.frames, args.simulations)
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1042 @@
+"""
+Bitboard rules engine for Hnefatafl.
+
+The position is held as three 121-bit integers, one for the attackers, one
+for the defenders (not including the king) and one for the king. Square
+indices are x * 11 + y, where (x, y) are the same tile coordinates used by
+the pieces in hnefatafl.py, so a bitboard flattens in the same order as the
+11x11 arrays built by hnefatafl_train.game_state_to_array.
+
+Legal moves are found with precomputed ray masks and the nearest blocker on
+each ray. Alongside the bitboards, the position keeps a table of the piece
+type on every square, so captures and the capture of the king are found by
+looking up a fixed handful of neighbouring squares; neither depends on the
+number of pieces on the board.
+
+Every position also carries a Zobrist hash, which is updated as pieces move
+and are captured so that positions can be compared and cached cheaply.
+
+The moves of every piece are cached between calls. A move only changes
+which squares are occupied on the rows and columns of its from, to and
+captured squares, so only the pieces on those lines are marked stale and
+looked at again; asking for the legal moves again after a move mostly reuses
+the moves already found.
+
+"""
+
+import random
+
+DIM = 11
+NUM_SQUARES = DIM * DIM
+FULL = (1 << NUM_SQUARES) - 1
+
+
+def square(x, y):
+    """Convert tile coordinates to a square index.
+
+    Args:
+        x (int): the row number
+        y (int): the column number
+
+    Returns:
+        (int): index of the square on the bitboard
+    """
+    return x * DIM + y
+
+
+def coords(sq):
+    """Convert a square index back to tile coordinates.
+
+    Args:
+        sq (int): index of the square on the bitboard
+
+    Returns:
+        (int, int): the row and column of the square
+    """
+    return divmod(sq, DIM)
+
+
+def iter_squares(bb):
+    """Yield the index of every set bit in a bitboard, lowest first."""
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def popcount(bb):
+    """Count the set bits in a bitboard."""
+    return bin(bb).count("1")
+
+
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count
+
+
+CENTER = square(5, 5)
+CORNERS = ((1 << square(0, 0)) | (1 << square(0, 10)) |
+           (1 << square(10, 0)) | (1 << square(10, 10)))
+SPECIAL = CORNERS | (1 << CENTER)
+
+# Squares on the first and last column, used to stop shifts wrapping
+# from one row onto the next.
+COL_FIRST = sum(1 << square(x, 0) for x in range(DIM))
+COL_LAST = sum(1 << square(x, DIM - 1) for x in range(DIM))
+ROW_FIRST = sum(1 << square(0, y) for y in range(DIM))
+ROW_LAST = sum(1 << square(DIM - 1, y) for y in range(DIM))
+EDGES = COL_FIRST | COL_LAST | ROW_FIRST | ROW_LAST
+
+START_GRID = ["x..aaaaa..x",
+              ".....a.....",
+              "...........",
+              "a....d....a",
+              "a...ddd...a",
+              "aa.ddcdd.aa",
+              "a...ddd...a",
+              "a....d....a",
+              "...........",
+              ".....a.....",
+              "x..aaaaa..x"]
+
+
+def _shift_up(bb):
+    return (bb << 1) & ~COL_FIRST & FULL
+
+
+def _shift_down(bb):
+    return (bb >> 1) & ~COL_LAST
+
+
+def _shift_right(bb):
+    return (bb << DIM) & FULL
+
+
+def _shift_left(bb):
+    return bb >> DIM
+
+
+SHIFTS = (_shift_up, _shift_right, _shift_down, _shift_left)
+
+
+def _spread(bb):
+    return _shift_up(bb) | _shift_down(bb) | _shift_right(bb) | _shift_left(bb)
+
+
+def flood_fill(seed, passable):
+    """Find every square connected to a set of squares.
+
+    Args:
+        seed (int): bitboard of the squares to start from
+        passable (int): bitboard of the squares the fill may spread over
+
+    Returns:
+        (int): bitboard of the seed and every passable square reached from
+               it through orthogonally adjacent passable squares
+    """
+    region = seed
+    while 1:
+        grown = region | (_spread(region) & passable)
+        if grown == region:
+            return region
+        region = grown
+
+
+def _ray(sq, dx, dy):
+    x, y = coords(sq)
+    bb = 0
+    x += dx
+    y += dy
+    while 0 <= x < DIM and 0 <= y < DIM:
+        bb |= 1 << square(x, y)
+        x += dx
+        y += dy
+    return bb
+
+
+# Rays running towards higher square indices, where the nearest blocker is
+# the lowest set bit, and rays running towards lower indices, where it is
+# the highest set bit.
+RAYS_POS = [(_ray(sq, 0, 1), _ray(sq, 1, 0)) for sq in range(NUM_SQUARES)]
+RAYS_NEG = [(_ray(sq, 0, -1), _ray(sq, -1, 0)) for sq in range(NUM_SQUARES)]
+
+NEIGHBORS = [_shift_up(1 << sq) | _shift_down(1 << sq) |
+             _shift_right(1 << sq) | _shift_left(1 << sq)
+             for sq in range(NUM_SQUARES)]
+
+
+
+def _step(sq, dx, dy):
+    x, y = coords(sq)
+    x += dx
+    y += dy
+    if 0 <= x < DIM and 0 <= y < DIM:
+        return square(x, y)
+    return None
+
+
+_DIRECTIONS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+
+# Squares next to every square, and (next, beyond) pairs of squares in a
+# line from it, the pairs a move to the square can sandwich a piece in.
+NEIGHBOR_SQUARES = [tuple(n for n in (_step(sq, dx, dy)
+                                      for dx, dy in _DIRECTIONS)
+                          if n is not None)
+                    for sq in range(NUM_SQUARES)]
+CAPTURE_PAIRS = [tuple((_step(sq, dx, dy), _step(sq, 2 * dx, 2 * dy))
+                       for dx, dy in _DIRECTIONS
+                       if _step(sq, 2 * dx, 2 * dy) is not None)
+                 for sq in range(NUM_SQUARES)]
+IS_SPECIAL = [bool(SPECIAL >> sq & 1) for sq in range(NUM_SQUARES)]
+IS_EDGE = [bool(EDGES >> sq & 1) for sq in range(NUM_SQUARES)]
+
+
+
+def _corner_rays(sq):
+    x, y = coords(sq)
+    rays = []
+    if CORNERS >> sq & 1:
+        return ()
+    for cx, cy in ((0, 0), (0, DIM - 1), (DIM - 1, 0), (DIM - 1, DIM - 1)):
+        if x == cx or y == cy:
+            dx = (cx > x) - (cx < x)
+            dy = (cy > y) - (cy < y)
+            rays.append(_ray(sq, dx, dy) & ~_ray(square(cx, cy), dx, dy))
+    return tuple(rays)
+
+
+# For every square, the squares a piece on it passes over and lands on to
+# reach each corner in one move along an edge, for the corners that share a
+# row or column with it.
+CORNER_RAYS = [_corner_rays(sq) for sq in range(NUM_SQUARES)]
+
+# The row and column through every square, the square included: the only
+# pieces whose moves change when a square is filled or emptied.
+LINES = [(1 << sq) | RAYS_POS[sq][0] | RAYS_POS[sq][1] |
+         RAYS_NEG[sq][0] | RAYS_NEG[sq][1] for sq in range(NUM_SQUARES)]
+
+
+ATTACKER = 0
+DEFENDER = 1
+KING = 2
+
+# Zobrist keys for every piece type on every square, and one for the
+# defenders being the side to move. The seed is fixed so hashes are the
+# same in every process.
+_zobrist_rng = random.Random(0x7AF1)
+ZOBRIST = [[_zobrist_rng.getrandbits(64) for sq in range(NUM_SQUARES)]
+           for piece in (ATTACKER, DEFENDER, KING)]
+ZOBRIST_SIDE = _zobrist_rng.getrandbits(64)
+
+
+def ray_moves(sq, occupied):
+    """Find every empty square a piece on sq can slide to.
+
+    Args:
+        sq (int): square of the piece
+        occupied (int): bitboard of all pieces on the board
+
+    Returns:
+        (int): bitboard of reachable squares, special squares included
+    """
+    moves = 0
+    for ray in RAYS_POS[sq]:
+        blockers = ray & occupied
+        if blockers:
+            ray &= (blockers & -blockers) - 1
+        moves |= ray
+    for ray in RAYS_NEG[sq]:
+        blockers = ray & occupied
+        if blockers:
+            nearest = blockers.bit_length()
+            ray = (ray >> nearest) << nearest
+        moves |= ray
+    return moves
+
+
+class GameState(object):
+
+    """Bitboard representation of a position and the rules that act on it."""
+
+    def __init__(self, grid=None):
+        """Set up a position from a board layout.
+
+        attackers: Bitboard of the attacking pieces.
+        defenders: Bitboard of the defending pieces, not including the king.
+        king: Bitboard holding the king, or 0 once it has been captured.
+        king_sq: Square index of the king.
+        squares: List of the piece type on every square, None if empty.
+        a_turn: Bool which is true when its the Attacker's turn, false o.w.
+        king_killed: Bool which is true if the king has been killed.
+        escaped: Bool which is true if the king escaped.
+        game_over: Bool which is true if either player has won.
+        hash: Zobrist hash of the pieces and the side to move.
+        ply: Number of moves on the undo stack.
+
+        Args:
+            grid (list(str)): layout in the format of Board.grid, where
+                              grid[y][x] is the tile at (x, y). Defaults to
+                              the starting layout.
+        """
+        if grid is None:
+            grid = START_GRID
+        self.attackers = 0
+        self.defenders = 0
+        self.king = 0
+        self.king_sq = None
+        for y, line in enumerate(grid):
+            for x, p in enumerate(line):
+                bit = 1 << square(x, y)
+                if p == "a":
+                    self.attackers |= bit
+                elif p == "d":
+                    self.defenders |= bit
+                elif p == "c":
+                    self.king = bit
+                    self.king_sq = square(x, y)
+        self.a_turn = True
+        self.king_killed = False
+        self.escaped = False
+        self.game_over = False
+        self.hash = self.compute_hash()
+        self.squares = [None] * NUM_SQUARES
+        for piece, bb in ((ATTACKER, self.attackers),
+                          (DEFENDER, self.defenders), (KING, self.king)):
+            for sq in iter_squares(bb):
+                self.squares[sq] = piece
+        self._clear_move_cache()
+        # The undo stack is kept in parallel lists indexed by ply, which
+        # only grow when a line deeper than any before is played.
+        self.ply = 0
+        self._undo_frm = []
+        self._undo_to = []
+        self._undo_captured = []
+        self._undo_flags = []
+        self._undo_hash = []
+        self._undo_stale = []
+        self._undo_cache = []
+
+    def copy(self):
+        """Return a copy of the position with an empty undo stack."""
+        other = GameState.__new__(GameState)
+        other.attackers = self.attackers
+        other.defenders = self.defenders
+        other.king = self.king
+        other.king_sq = self.king_sq
+        other.a_turn = self.a_turn
+        other.king_killed = self.king_killed
+        other.escaped = self.escaped
+        other.game_over = self.game_over
+        other.hash = self.hash
+        other.squares = list(self.squares)
+        other._targets = list(self._targets)
+        other._pairs = list(self._pairs)
+        other._stale = self._stale
+        other.ply = 0
+        other._undo_frm = []
+        other._undo_to = []
+        other._undo_captured = []
+        other._undo_flags = []
+        other._undo_hash = []
+        other._undo_stale = []
+        other._undo_cache = []
+        return other
+
+    def _clear_move_cache(self):
+        # Moves of the piece on every square as a bitboard of targets, and
+        # as a list of (from, to) pairs once legal_moves has built it;
+        # _stale marks the squares whose entries are out of date
+        self._targets = [0] * NUM_SQUARES
+        self._pairs = [None] * NUM_SQUARES
+        self._stale = FULL
+
+    def _refresh_moves(self, pieces):
+        # Bring the cached moves of the pieces on a bitboard up to date
+        stale = pieces & self._stale
+        if stale:
+            occupied = self.occupied()
+            for sq in iter_squares(stale):
+                targets = ray_moves(sq, occupied)
+                if sq != self.king_sq:
+                    targets &= ~SPECIAL
+                self._targets[sq] = targets
+                self._pairs[sq] = None
+            self._stale &= ~stale
+
+    def compute_hash(self):
+        """Compute the Zobrist hash of the position from scratch.
+
+        Returns:
+            (int): 64-bit hash of the pieces and the side to move
+        """
+        h = 0
+        for piece, bb in ((ATTACKER, self.attackers),
+                          (DEFENDER, self.defenders),
+                          (KING, self.king)):
+            for sq in iter_squares(bb):
+                h ^= ZOBRIST[piece][sq]
+        if not self.a_turn:
+            h ^= ZOBRIST_SIDE
+        return h
+
+    def piece_at(self, sq):
+        """Return the type of the piece on a square, or None if empty."""
+        return self.squares[sq]
+
+    def occupied(self):
+        """Return a bitboard of every piece on the board."""
+        return self.attackers | self.defenders | self.king
+
+    def side(self, attacker):
+        """Return a bitboard of one side's pieces, the king included.
+
+        Args:
+            attacker (bool): True for the attackers, False for the defenders
+        """
+        if attacker:
+            return self.attackers
+        return self.defenders | self.king
+
+    def piece_moves(self, sq):
+        """Find the valid moves for the piece on a square.
+
+        Only the king may stop on the center and corner squares, but every
+        piece may pass over the empty center.
+
+        Args:
+            sq (int): square of the piece
+
+        Returns:
+            (int): bitboard of the squares the piece can move to
+        """
+        self._refresh_moves(1 << sq)
+        return self._targets[sq]
+
+    def legal_moves(self):
+        """List every move for the side whose turn it is.
+
+        Returns:
+            list((int, int)): (from square, to square) pairs
+        """
+        pieces = self.side(self.a_turn)
+        self._refresh_moves(pieces)
+        moves = []
+        for frm in iter_squares(pieces):
+            pairs = self._pairs[frm]
+            if pairs is None:
+                pairs = [(frm, to) for to in iter_squares(self._targets[frm])]
+                self._pairs[frm] = pairs
+            moves += pairs
+        return moves
+
+    def relocate(self, frm, to):
+        """Move a piece from one square to another, ignoring captures.
+
+        Args:
+            frm (int): square the piece is on
+            to (int): empty square the piece moves to
+        """
+        bits = (1 << frm) | (1 << to)
+        squares = self.squares
+        piece = squares[frm]
+        squares[to] = piece
+        squares[frm] = None
+        if piece == ATTACKER:
+            self.attackers ^= bits
+        elif piece == KING:
+            self.king ^= bits
+            self.king_sq = to
+        else:
+            self.defenders ^= bits
+        keys = ZOBRIST[piece]
+        self.hash ^= keys[frm] ^ keys[to]
+        self._stale |= LINES[frm] | LINES[to]
+
+    def king_surrounded(self, by=None):
+        """Determine if the king is enclosed on all four sides.
+
+        A side counts as enclosed if it holds an attacker or is the center
+        or a corner. A king on the edge of the board cannot be captured.
+
+        Args:
+            by (int): square to count as holding an attacker, for a move
+                      that has not been played yet
+
+        Returns:
+            True if king has been killed, False o.w.
+        """
+        if not self.king or IS_EDGE[self.king_sq]:
+            return False
+        squares = self.squares
+        for sq in NEIGHBOR_SQUARES[self.king_sq]:
+            if squares[sq] != ATTACKER and not IS_SPECIAL[sq] and sq != by:
+                return False
+        return True
+
+    def find_captures(self, to):
+        """Find the pieces captured by the piece that just moved to a square.
+
+        An opponent's piece next to the moved piece is captured if the
+        square beyond it holds one of the mover's pieces or is an empty
+        center or corner square. The king is never captured this way; it is
+        only captured by an attacker completing the enclosure around it.
+
+        Args:
+            to (int): square the piece moved to
+
+        Returns:
+            (int): bitboard of the captured pieces, including the king
+        """
+        return self._captures(to, self.squares[to] == ATTACKER)
+
+    def _captures(self, to, attacker):
+        # Pieces a piece of one side standing on to captures; only the
+        # squares around to are looked at, so to itself may still be empty
+        squares = self.squares
+        if attacker:
+            enemy = DEFENDER
+        else:
+            enemy = ATTACKER
+        captured = 0
+        for adjacent, beyond in CAPTURE_PAIRS[to]:
+            if squares[adjacent] != enemy:
+                continue
+            far = squares[beyond]
+            if far is None:
+                if IS_SPECIAL[beyond]:
+                    captured |= 1 << adjacent
+            elif (far == ATTACKER) == attacker:
+                captured |= 1 << adjacent
+        if attacker and NEIGHBORS[to] & self.king and self.king_surrounded(to):
+            captured |= self.king
+        return captured
+
+    def move_captures(self, frm, to):
+        """Find the pieces a move would capture, without playing it.
+
+        The captures are looked up around the target square with the piece
+        still on frm, which cannot be one of the squares that matter: the
+        squares between frm and to are empty. Nothing is changed, so the
+        move cache and the state kept by subclasses are left alone.
+
+        Args:
+            frm (int): square the piece is on
+            to (int): square the piece moves to
+
+        Returns:
+            (int): bitboard of the pieces that would be captured
+        """
+        return self._captures(to, self.squares[frm] == ATTACKER)
+
+    def resolve_captures(self, to):
+        """Remove the pieces captured by a move to a square.
+
+        Args:
+            to (int): square the piece moved to
+
+        Returns:
+            (int): bitboard of the captured pieces, including the king
+        """
+        captured = self.find_captures(to)
+        if captured:
+            squares = self.squares
+            for sq in iter_squares(captured):
+                self.hash ^= ZOBRIST[squares[sq]][sq]
+                squares[sq] = None
+                self._stale |= LINES[sq]
+            self.attackers &= ~captured
+            self.defenders &= ~captured
+            if captured & self.king:
+                self.king = 0
+                self.king_killed = True
+                self.game_over = True
+        return captured
+
+    def check_escape(self):
+        """Check if king has moved onto a corner square."""
+        if self.king & CORNERS:
+            self.escaped = True
+            self.game_over = True
+
+    def move(self, frm, to):
+        """Play a move, resolve its captures and pass the turn.
+
+        Args:
+            frm (int): square the piece is on
+            to (int): square the piece moves to
+
+        Returns:
+            (int): bitboard of the captured pieces
+        """
+        self.relocate(frm, to)
+        if to == self.king_sq:
+            self.check_escape()
+        captured = self.resolve_captures(to)
+        self.a_turn = not self.a_turn
+        self.hash ^= ZOBRIST_SIDE
+        return captured
+
+    def make_move(self, frm, to):
+        """Play a move so that it can be taken back with unmake_move.
+
+        The move, the pieces it captured and the win flags and hash from
+        before it are pushed on the undo stack, along with the cached moves
+        the move makes stale, so taking it back restores the move cache.
+
+        Args:
+            frm (int): square the piece is on
+            to (int): square the piece moves to
+
+        Returns:
+            (int): bitboard of the captured pieces
+        """
+        ply = self.ply
+        if ply == len(self._undo_frm):
+            for stack in (self._undo_frm, self._undo_to, self._undo_captured,
+                          self._undo_flags, self._undo_hash,
+                          self._undo_stale, self._undo_cache):
+                stack.append(0)
+        self._undo_frm[ply] = frm
+        self._undo_to[ply] = to
+        self._undo_flags[ply] = (self.king_killed | self.escaped << 1 |
+                                 self.game_over << 2)
+        self._undo_hash[ply] = self.hash
+        # The cache is copied as it was before the move; copying the whole
+        # lists is cheaper than picking out the entries the move touches
+        self._undo_stale[ply] = self._stale
+        self._undo_cache[ply] = (self._targets[:], self._pairs[:])
+        captured = self.move(frm, to)
+        self._undo_captured[ply] = captured
+        self.ply = ply + 1
+        return captured
+
+    def unmake_move(self):
+        """Take back the last move played with make_move."""
+        self.ply -= 1
+        ply = self.ply
+        frm = self._undo_frm[ply]
+        to = self._undo_to[ply]
+        captured = self._undo_captured[ply]
+        flags = self._undo_flags[ply]
+        bits = (1 << frm) | (1 << to)
+        squares = self.squares
+        piece = squares[to]
+        squares[frm] = piece
+        squares[to] = None
+        self.a_turn = not self.a_turn
+        if piece == ATTACKER:
+            self.attackers ^= bits
+        elif piece == KING:
+            self.king ^= bits
+            self.king_sq = frm
+        else:
+            self.defenders ^= bits
+        if captured:
+            self._restore(captured)
+        self.king_killed = bool(flags & 1)
+        self.escaped = bool(flags & 2)
+        self.game_over = bool(flags & 4)
+        self.hash = self._undo_hash[ply]
+        # The move only changed the moves of pieces on the lines through
+        # the squares it emptied and filled, so entries brought up to date
+        # after it are still right for the pieces off those lines
+        stale = self._undo_stale[ply]
+        touched = LINES[frm] | LINES[to]
+        if captured:
+            for sq in iter_squares(captured):
+                touched |= LINES[sq]
+        kept = stale & ~self._stale & ~touched
+        old_targets, old_pairs = self._undo_cache[ply]
+        if kept:
+            targets = self._targets
+            pairs = self._pairs
+            for sq in iter_squares(touched & ~stale):
+                targets[sq] = old_targets[sq]
+                pairs[sq] = old_pairs[sq]
+            self._stale = stale & ~kept
+        else:
+            self._targets = old_targets
+            self._pairs = old_pairs
+            self._stale = stale
+
+    def _restore(self, captured):
+        # Put back the pieces taken by the move being taken back, which
+        # were all of the side not to move
+        squares = self.squares
+        if self.a_turn:
+            piece = DEFENDER
+            if captured >> self.king_sq & 1:
+                self.king = 1 << self.king_sq
+                squares[self.king_sq] = KING
+                captured ^= self.king
+            self.defenders |= captured
+        else:
+            piece = ATTACKER
+            self.attackers |= captured
+        for sq in iter_squares(captured):
+            squares[sq] = piece
+
+
+def outcome(state):
+    """Result of a finished game.
+
+    Returns:
+        (float): 1.0 if the attackers won, -1.0 if the defenders won and
+                 None if the game is still going
+    """
+    if state.king_killed:
+        return 1.0
+    if state.escaped:
+        return -1.0
+    return None
+
+
+def has_legal_move(state):
+    """Check if the side to move has any legal move, without listing them."""
+    pieces = state.side(state.a_turn)
+    state._refresh_moves(pieces)
+    targets = state._targets
+    for frm in iter_squares(pieces):
+        if targets[frm]:
+            return True
+    return False
+
+
+def is_capture(state, frm, to):
+    """Check if a move captures anything, without playing it.
+
+    Only the piece types on the squares around the target are read, as in
+    GameState.move_captures, and the search stops at the first capture.
+
+    Args:
+        state (GameState): position to look at
+        frm (int): square the piece is on
+        to (int): square the piece moves to
+    """
+    squares = state.squares
+    attacker = squares[frm] == ATTACKER
+    if attacker:
+        enemy = DEFENDER
+    else:
+        enemy = ATTACKER
+    for adjacent, beyond in CAPTURE_PAIRS[to]:
+        if squares[adjacent] != enemy:
+            continue
+        far = squares[beyond]
+        if far is None:
+            if IS_SPECIAL[beyond]:
+                return True
+        elif (far == ATTACKER) == attacker:
+            return True
+    return bool(attacker and NEIGHBORS[to] & state.king and
+                state.king_surrounded(to))
+
+
+def open_escape_routes(sq, occupied):
+    """Count the corners a king on a square could reach in one move.
+
+    Args:
+        sq (int): square of the king
+        occupied (int): bitboard of the other pieces on the board
+
+    Returns:
+        (int): 0, 1 or 2 open lines to a corner
+    """
+    n = 0
+    for ray in CORNER_RAYS[sq]:
+        if not ray & occupied:
+            n += 1
+    return n
+
+
+def escape_routes(state):
+    """Count the king's open lines to a corner.
+
+    With the defenders to move, one open line wins on their next move;
+    with the attackers to move, two open lines cannot both be blocked, so
+    the king escapes whatever they play.
+
+    Args:
+        state (GameState): the position
+
+    Returns:
+        (int): 0, 1 or 2 open lines, or 0 if the king has been captured
+    """
+    if not state.king:
+        return 0
+    return open_escape_routes(state.king_sq, state.attackers | state.defenders)
+
+
+def forced_escape(state):
+    """Check if the king escapes within two moves whatever the attackers do.
+    """
+    routes = escape_routes(state)
+    return routes >= 2 or (routes == 1 and not state.a_turn)
+
+
+def encircled(state):
+    """Check if the attackers have shut the king and every defender in.
+
+    Returns:
+        (bool): True if no defender and not the king can reach the edge of
+                the board by any number of moves
+    """
+    inside = flood_fill(state.defenders | state.king, FULL & ~state.attackers)
+    return not inside & EDGES
+
+
+def edge_fort(state):
+    """Check if the king has built an edge fort the attackers cannot break.
+
+    The king is on the edge, able to move, and shut in by defenders with no
+    attacker inside; and no defender of the wall can be captured, as on
+    both lines through it at least one neighbour is off the board, inside
+    the fort, or another defender that cannot be captured.
+
+    Returns:
+        (bool): True if the king is in an edge fort
+    """
+    if not state.king & EDGES or not state.piece_moves(state.king_sq):
+        return False
+    inside = flood_fill(state.king, FULL & ~state.defenders)
+    if inside & state.attackers:
+        return False
+    wall = _spread(inside) & state.defenders
+    # Take out defenders that could be captured until the rest hold
+    solid = state.defenders
+    while 1:
+        safe = (inside & ~SPECIAL) | solid
+        held = ((_shift_down(safe) | COL_LAST | _shift_up(safe) | COL_FIRST) &
+                (_shift_left(safe) | ROW_LAST | _shift_right(safe) | ROW_FIRST))
+        if solid & held == solid:
+            break
+        solid &= held
+    return solid & wall == wall
+
+
+class Rules(object):
+
+    """Ways a game can end besides the king being captured or escaping.
+
+    Attributes:
+        repetition (int): the game ends once a position, with the same side
+                          to move, occurs this many times; None to allow
+                          repeats
+        repetition_result (float): result of a game ended by repetition
+        no_moves (bool): a side with no legal moves loses
+        encirclement (bool): the attackers win by shutting in the king and
+                             every defender
+        edge_fort (bool): the defenders win by building an edge fort
+        forced_escape (bool): the defenders win as soon as the king has an
+                              escape the attackers cannot stop
+        move_limit (int): the game is a draw after this many moves; None
+                          for no limit
+    """
+
+    def __init__(self, repetition=3, repetition_result=0.0, no_moves=True,
+                 encirclement=True, edge_fort=True, forced_escape=True,
+                 move_limit=1000):
+        self.repetition = repetition
+        self.repetition_result = repetition_result
+        self.no_moves = no_moves
+        self.encirclement = encirclement
+        self.edge_fort = edge_fort
+        self.forced_escape = forced_escape
+        self.move_limit = move_limit
+
+
+class Referee(object):
+
+    """Decides when a game is over, and why, under a set of Rules.
+
+    The referee keeps a count of every position seen in the game, keyed by
+    its hash, so finding a repetition costs one lookup per move.
+
+    Attributes:
+        rules (Rules): rules in play
+        history (dict): number of times each position hash has occurred
+        num_moves (int): number of moves played
+        result (float): 1.0 if the attackers won, -1.0 if the defenders
+                        won, 0.0 for a draw, or None while the game goes on
+        reason (str): how the game ended, or None while it goes on
+    """
+
+    def __init__(self, state, rules=None):
+        """Start refereeing a game.
+
+        Args:
+            state (GameState): the position the game starts from
+            rules (Rules): rules in play, defaults to Rules()
+        """
+        self.rules = Rules() if rules is None else rules
+        self.history = {state.hash: 1}
+        self.num_moves = 0
+        self.result = None
+        self.reason = None
+
+    def _end(self, result, reason):
+        self.result = result
+        self.reason = reason
+        return result
+
+    def update(self, state):
+        """Record the move just played and decide if the game is over.
+
+        Args:
+            state (GameState): the position after the move
+
+        Returns:
+            (float): the result if the game is over, or None
+        """
+        rules = self.rules
+        self.num_moves += 1
+        if state.king_killed:
+            return self._end(1.0, "King killed! Attackers win!")
+        if state.escaped:
+            return self._end(-1.0, "King escaped! Defenders win!")
+        count = self.history.get(state.hash, 0) + 1
+        self.history[state.hash] = count
+        if rules.repetition is not None and count >= rules.repetition:
+            return self._end(rules.repetition_result,
+                             "Position repeated {} times after {} moves".format(
+                                 count, self.num_moves))
+        if rules.encirclement and not state.a_turn and encircled(state):
+            return self._end(1.0, "Defenders encircled! Attackers win!")
+        if rules.forced_escape and forced_escape(state):
+            return self._end(-1.0, "King cannot be stopped! Defenders win!")
+        if rules.edge_fort and state.a_turn and edge_fort(state):
+            return self._end(-1.0, "King built an edge fort! Defenders win!")
+        if rules.no_moves and not has_legal_move(state):
+            if state.a_turn:
+                return self._end(-1.0, "Attackers cannot move! Defenders win!")
+            return self._end(1.0, "Defenders cannot move! Attackers win!")
+        if rules.move_limit is not None and self.num_moves >= rules.move_limit:
+            return self._end(0.0, "Draw game after {} moves".format(
+                self.num_moves))
+        return None
+
+
+def random_move(state, rng=random):
+    """Pick a move uniformly at random from all legal moves.
+
+    The moves of every piece of the side to move are counted in one pass,
+    then a single random number picks the piece and the square, so there is
+    no retrying for pieces that cannot move.
+
+    Args:
+        state (GameState): position to pick a move in
+        rng (random.Random): source of random numbers
+
+    Returns:
+        ((int, int)): (from square, to square), or None if there are no
+                      legal moves
+    """
+    pieces = state.side(state.a_turn)
+    state._refresh_moves(pieces)
+    cache = state._targets
+    total = 0
+    options = []
+    for frm in iter_squares(pieces):
+        targets = cache[frm]
+        if targets:
+            n = popcount(targets)
+            options.append((frm, targets, n))
+            total += n
+    if not total:
+        return None
+    r = rng.randrange(total)
+    for frm, targets, n in options:
+        if r < n:
+            for _ in range(r):
+                targets &= targets - 1
+            return frm, (targets & -targets).bit_length() - 1
+        r -= n
+
+
+def random_playout(state, limit=1000, rng=random):
+    """Play uniformly random moves until the game ends.
+
+    A side with no legal moves loses.
+
+    Args:
+        state (GameState): position to play from; the moves are played on it
+        limit (int): moves to play before calling the game a draw
+        rng (random.Random): source of random numbers
+
+    Returns:
+        (float, int): the result, 1.0 if the attackers won, -1.0 if the
+                      defenders won and 0.0 for a draw, and the number of
+                      moves played
+    """
+    for n in range(limit):
+        move = random_move(state, rng)
+        if move is None:
+            return (-1.0 if state.a_turn else 1.0), n
+        state.move(*move)
+        if state.game_over:
+            return outcome(state), n + 1
+    return 0.0, limit
+
+
+def perft(state, depth):
+    """Count the positions reached by every sequence of legal moves.
+
+    A game that ends before depth moves counts as no positions, since
+    there are no moves to continue it with.
+
+    Args:
+        state (GameState): position to start from; it is restored afterwards
+        depth (int): number of moves in each sequence
+
+    Returns:
+        (int): number of positions at exactly depth moves
+    """
+    if depth == 0:
+        return 1
+    if state.game_over:
+        return 0
+    moves = state.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for frm, to in moves:
+        state.make_move(frm, to)
+        nodes += perft(state, depth - 1)
+        state.unmake_move()
+    return nodes
+
+
+def perft_divide(state, depth):
+    """Run perft for the position after each legal move.
+
+    Args:
+        state (GameState): position to start from; it is restored afterwards
+        depth (int): number of moves in each sequence, including the first
+
+    Returns:
+        list(((int, int), int)): every legal move with its perft count
+    """
+    counts = []
+    for frm, to in state.legal_moves():
+        state.make_move(frm, to)
+        counts.append(((frm, to), perft(state, depth - 1)))
+        state.unmake_move()
+    return counts
+
+
+def play_random_games(num_games, limit=1000, grid=None, seed=None):
+    """Play games of uniformly random moves to completion.
+
+    Args:
+        num_games (int): number of games to play
+        limit (int): moves per game before it is called a draw
+        grid (list(str)): starting layout, defaults to START_GRID
+        seed (int): seed for the moves, so the games can be replayed
+
+    Returns:
+        list((float, int)): result and number of moves of every game, as
+                            returned by random_playout
+    """
+    rng = random.Random(seed)
+    start = GameState(grid)
+    return [random_playout(start.copy(), limit, rng)
+            for _ in range(num_games)]
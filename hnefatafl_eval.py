@@ -0,0 +1,373 @@
+"""
+Hand-written static evaluation for Hnefatafl.
+
+Positions are scored from the attackers' point of view as the tanh of a
+weighted sum of a few features:
+
+    attackers             attackers on the board
+    defenders             defenders on the board, not counting the king
+    king_corner_distance  moves along rows and columns from the king to the
+                          nearest corner, ignoring the pieces in the way
+    escape_routes         the king's open lines to a corner, 0 to 2
+    king_attackers        attackers next to the king
+    attacker_mobility     legal moves of the attackers
+    defender_mobility     legal moves of the defenders
+
+The weights, and a bias, are kept in a JSON file of name and weight pairs;
+missing names keep their DEFAULT_WEIGHTS.
+
+StaticEvaluator has the predict method of a Keras model, so it can be
+passed to do_best_move and the other players in place of the attacker
+model, and an evaluate method for hnefatafl_search.Searcher. EvalState is a
+GameState that keeps its material, the attackers around the king and each
+side's mobility up to date on make_move and unmake_move, so evaluate only
+looks up a few counts. After a move only the pieces on the rows and columns
+it touched are counted again, through the move cache of GameState.
+
+Usage:
+    python hnefatafl_eval.py defaults weights.json
+
+"""
+
+import argparse
+import json
+import math
+import sys
+import numpy as np
+import hnefatafl_engine as engine
+import hnefatafl_vec as vec
+from hnefatafl_features import bitboard_to_array
+
+FEATURES = ("attackers", "defenders", "king_corner_distance", "escape_routes",
+            "king_attackers", "attacker_mobility", "defender_mobility")
+
+DEFAULT_WEIGHTS = {
+    "bias": 0.0,
+    "attackers": 0.04,
+    "defenders": -0.08,
+    "king_corner_distance": 0.06,
+    "escape_routes": -0.5,
+    "king_attackers": 0.15,
+    "attacker_mobility": 0.002,
+    "defender_mobility": -0.004,
+}
+
+CORNER_DISTANCE = [min(x, engine.DIM - 1 - x) + min(y, engine.DIM - 1 - y)
+                   for x, y in map(engine.coords, range(engine.NUM_SQUARES))]
+
+
+# Tables for scoring (N, 121) boards: the squares next to every square,
+# padded with the off-board square 121, and the squares on every square's
+# two possible lines to a corner.
+_NEIGHBOR_INDEX = np.array([(list(engine.NEIGHBOR_SQUARES[sq]) +
+                             [engine.NUM_SQUARES] * 4)[:4]
+                            for sq in range(engine.NUM_SQUARES)])
+_CORNER_RAYS = np.array([[bitboard_to_array(ray).astype(bool)
+                          for ray in (engine.CORNER_RAYS[sq] + (0, 0))[:2]]
+                         for sq in range(engine.NUM_SQUARES)])
+_CORNER_DISTANCE = np.array(CORNER_DISTANCE)
+
+
+def _mobility(state, attacker):
+    pieces = state.side(attacker)
+    state._refresh_moves(pieces)
+    targets = state._targets
+    moves = 0
+    for sq in engine.iter_squares(pieces):
+        moves += engine.popcount(targets[sq])
+    return moves
+
+
+class EvalState(engine.GameState):
+
+    """A GameState that keeps the counts the evaluation needs up to date.
+
+    Attributes:
+        num_attackers (int): attackers on the board
+        num_defenders (int): defenders on the board, not counting the king
+        king_attackers (int): attackers next to the king
+        attacker_mobility (int): legal moves of the attackers
+        defender_mobility (int): legal moves of the defenders
+    """
+
+    def __init__(self, grid=None):
+        engine.GameState.__init__(self, grid)
+        self._count()
+
+    @classmethod
+    def from_state(cls, state):
+        """Copy any GameState into an EvalState with an empty undo stack.
+
+        The players that search with a StaticEvaluator use this to search
+        a copy of the game's position instead of the position itself.
+        """
+        other = engine.GameState.copy(state)
+        other.__class__ = cls
+        other._count()
+        return other
+
+    def _count_mobility(self):
+        # Moves of the piece on every square, by side, and their totals
+        self._attacker_moves = [0] * engine.NUM_SQUARES
+        self._defender_moves = [0] * engine.NUM_SQUARES
+        self.attacker_mobility = 0
+        self.defender_mobility = 0
+        self._undo_mobility = []
+        self._update_mobility(self.occupied())
+
+    def _update_mobility(self, pieces):
+        # Count the moves of the pieces on some squares again
+        squares = self.squares
+        attacker_moves = self._attacker_moves
+        defender_moves = self._defender_moves
+        self._refresh_moves(pieces & self.occupied())
+        targets = self._targets
+        for sq in engine.iter_squares(pieces):
+            self.attacker_mobility -= attacker_moves[sq]
+            self.defender_mobility -= defender_moves[sq]
+            piece = squares[sq]
+            if piece is None:
+                attacker_moves[sq] = defender_moves[sq] = 0
+                continue
+            moves = engine.popcount(targets[sq])
+            if piece == engine.ATTACKER:
+                attacker_moves[sq] = moves
+                defender_moves[sq] = 0
+                self.attacker_mobility += moves
+            else:
+                attacker_moves[sq] = 0
+                defender_moves[sq] = moves
+                self.defender_mobility += moves
+
+    def copy(self):
+        """Return a copy of the position with an empty undo stack."""
+        other = engine.GameState.copy(self)
+        other.__class__ = EvalState
+        other.num_attackers = self.num_attackers
+        other.num_defenders = self.num_defenders
+        other.king_attackers = self.king_attackers
+        other._attacker_moves = list(self._attacker_moves)
+        other._defender_moves = list(self._defender_moves)
+        other.attacker_mobility = self.attacker_mobility
+        other.defender_mobility = self.defender_mobility
+        other._undo_mobility = []
+        return other
+
+    def _count(self):
+        self.num_attackers = engine.popcount(self.attackers)
+        self.num_defenders = engine.popcount(self.defenders)
+        self._count_king_attackers()
+        self._count_mobility()
+
+    def _count_king_attackers(self):
+        if self.king:
+            self.king_attackers = engine.popcount(
+                engine.NEIGHBORS[self.king_sq] & self.attackers)
+        else:
+            self.king_attackers = 0
+
+    def relocate(self, frm, to):
+        engine.GameState.relocate(self, frm, to)
+        if to == self.king_sq:
+            self._count_king_attackers()
+        elif self.squares[to] == engine.ATTACKER and self.king:
+            around = engine.NEIGHBORS[self.king_sq]
+            self.king_attackers += (around >> to & 1) - (around >> frm & 1)
+
+    def resolve_captures(self, to):
+        captured = engine.GameState.resolve_captures(self, to)
+        if captured:
+            if self.squares[to] == engine.ATTACKER:
+                self.num_defenders -= engine.popcount(
+                    captured & ~(1 << self.king_sq))
+                if self.king_killed:
+                    self.king_attackers = 0
+            else:
+                self.num_attackers -= engine.popcount(captured)
+                self._count_king_attackers()
+        return captured
+
+    def move(self, frm, to):
+        before = self.occupied()
+        captured = engine.GameState.move(self, frm, to)
+        touched = engine.LINES[frm] | engine.LINES[to]
+        for sq in engine.iter_squares(captured):
+            touched |= engine.LINES[sq]
+        self._update_mobility((before | 1 << to) & touched)
+        return captured
+
+    def make_move(self, frm, to):
+        ply = self.ply
+        saved = (list(self._attacker_moves), list(self._defender_moves),
+                 self.attacker_mobility, self.defender_mobility)
+        if ply == len(self._undo_mobility):
+            self._undo_mobility.append(saved)
+        else:
+            self._undo_mobility[ply] = saved
+        return engine.GameState.make_move(self, frm, to)
+
+    def unmake_move(self):
+        captured = self._undo_captured[self.ply - 1]
+        engine.GameState.unmake_move(self)
+        (self._attacker_moves, self._defender_moves,
+         self.attacker_mobility, self.defender_mobility) = \
+            self._undo_mobility[self.ply]
+        if captured:
+            if self.a_turn:
+                self.num_defenders += engine.popcount(
+                    captured & ~(1 << self.king_sq))
+            else:
+                self.num_attackers += engine.popcount(captured)
+        self._count_king_attackers()
+
+
+class StaticEvaluator(object):
+
+    """Scores positions with a weighted sum of hand-picked features.
+
+    Attributes:
+        weights (dict): weight of every name in FEATURES, and the bias
+    """
+
+    def __init__(self, weights=None):
+        """Set up the evaluator.
+
+        Args:
+            weights (dict): weights by feature name; missing ones keep
+                            their DEFAULT_WEIGHTS
+        """
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            unknown = set(weights) - set(DEFAULT_WEIGHTS)
+            if unknown:
+                raise ValueError("unknown features {}".format(
+                    ", ".join(sorted(unknown))))
+            self.weights.update(weights)
+        self._vector = np.array([self.weights[f] for f in FEATURES])
+        self._list = self._vector.tolist()
+
+    @classmethod
+    def load(cls, path):
+        """Read the weights from a JSON file of name and weight pairs."""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        """Write the weights to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.weights, f, indent=2, sort_keys=True)
+
+    def features(self, state):
+        """Compute the features of a position.
+
+        An EvalState already holds its material, the attackers next to the
+        king and the mobility of both sides; for other GameStates they are
+        counted from the bitboards and the move cache.
+
+        Args:
+            state (GameState): position to describe
+
+        Returns:
+            (numpy.ndarray): the value of every name in FEATURES
+        """
+        return np.array(self._features(state), dtype=float)
+
+    def _features(self, state):
+        if isinstance(state, EvalState):
+            return [state.num_attackers, state.num_defenders,
+                    CORNER_DISTANCE[state.king_sq], engine.escape_routes(state),
+                    state.king_attackers, state.attacker_mobility,
+                    state.defender_mobility]
+        return [engine.popcount(state.attackers),
+                engine.popcount(state.defenders),
+                CORNER_DISTANCE[state.king_sq], engine.escape_routes(state),
+                engine.popcount(engine.NEIGHBORS[state.king_sq] &
+                                state.attackers),
+                _mobility(state, True), _mobility(state, False)]
+
+    def evaluate(self, state):
+        """Score a position for hnefatafl_search.Searcher.
+
+        Args:
+            state (GameState): position to score
+
+        Returns:
+            (float): score from the attackers' point of view, from -1 to 1
+        """
+        if state.king_killed:
+            return 1.0
+        if state.escaped:
+            return -1.0
+        score = self.weights["bias"]
+        for weight, value in zip(self._list, self._features(state)):
+            score += weight * value
+        return math.tanh(score)
+
+    def board_features(self, boards):
+        """Compute the features of a batch of boards.
+
+        Args:
+            boards (numpy.ndarray): (N, 121) positions in the encoding of
+                                    game_state_to_array
+
+        Returns:
+            (numpy.ndarray): (N, len(FEATURES)) features
+        """
+        boards = np.asarray(boards, dtype=np.int8).reshape(-1, engine.NUM_SQUARES)
+        n = len(boards)
+        king_sq = np.argmax(boards == vec.KING, axis=1)
+        padded = np.zeros((n, engine.NUM_SQUARES + 1), dtype=np.int8)
+        padded[:, :engine.NUM_SQUARES] = boards
+        around = padded[np.arange(n)[:, None], _NEIGHBOR_INDEX[king_sq]]
+        rays = _CORNER_RAYS[king_sq]
+        pieces = (boards == vec.ATTACKER) | (boards == vec.DEFENDER)
+        open_rays = rays.any(axis=2) & ~(rays & pieces[:, None, :]).any(axis=2)
+        features = np.empty((n, len(FEATURES)))
+        features[:, 0] = (boards == vec.ATTACKER).sum(axis=1)
+        features[:, 1] = (boards == vec.DEFENDER).sum(axis=1)
+        features[:, 2] = _CORNER_DISTANCE[king_sq]
+        features[:, 3] = open_rays.sum(axis=1)
+        features[:, 4] = (around == vec.ATTACKER).sum(axis=1)
+        features[:, 5] = vec.legal_mask(boards, np.ones(n, dtype=bool)).sum(axis=1)
+        features[:, 6] = vec.legal_mask(boards, np.zeros(n, dtype=bool)).sum(axis=1)
+        return features
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Score a batch of positions like a Keras model.
+
+        Args:
+            x (numpy.ndarray): (N, 121) positions in the encoding of
+                               game_state_to_array
+            batch_size, verbose: accepted for Keras compatibility, unused
+
+        Returns:
+            (numpy.ndarray): (N, 1) scores from the attackers' point of view
+        """
+        boards = np.asarray(x, dtype=np.int8).reshape(-1, engine.NUM_SQUARES)
+        scores = np.tanh(self.weights["bias"] +
+                         np.dot(self.board_features(boards), self._vector))
+        # Finished games: the king captured or on a corner
+        has_king = (boards == vec.KING).any(axis=1)
+        scores[~has_king] = 1.0
+        escaped = (boards[:, vec.CORNERS[:engine.NUM_SQUARES]] == vec.KING)
+        scores[escaped.any(axis=1)] = -1.0
+        return scores.reshape(-1, 1)
+
+
+def main(argv=None):
+    """Command line entry point for writing a weights file."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command")
+    d = commands.add_parser("defaults", help="write the default weights")
+    d.add_argument("output", help="file to write (.json)")
+    args = parser.parse_args(argv)
+
+    if args.command == "defaults":
+        StaticEvaluator().save(args.output)
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
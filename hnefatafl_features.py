@@ -0,0 +1,196 @@
+"""
+Network input planes kept up to date as a game is played.
+
+FeatureState is a GameState that also holds its position as NumPy arrays,
+changed square by square as pieces move and are captured instead of being
+rebuilt for every position:
+
+    board    (121,) int8 in the encoding of game_state_to_array: 0 empty,
+             1 attacker, 2 defender, 3 king
+    planes   (NUM_PLANES, 121) float32 one-hot planes, one per piece type
+             (ATTACKER_PLANE, DEFENDER_PLANE, KING_PLANE), then SIDE_PLANE,
+             all ones when the attackers are to move, and with mobility on,
+             ATTACKER_MOBILITY and DEFENDER_MOBILITY, the number of pieces
+             of each side that can move to every square
+
+Both are updated in place, so a reference to them always shows the current
+position. The planes can be kept inside a larger array by passing a row of
+it as out: with the rows of one array from new_planes, a batch of games
+always has its model input ready with no copying at all.
+
+"""
+
+import numpy as np
+import hnefatafl_engine as engine
+
+ATTACKER_PLANE = engine.ATTACKER
+DEFENDER_PLANE = engine.DEFENDER
+KING_PLANE = engine.KING
+SIDE_PLANE = 3
+ATTACKER_MOBILITY = 4
+DEFENDER_MOBILITY = 5
+
+NUM_PLANES = 4
+NUM_PLANES_MOBILITY = 6
+
+
+def bitboard_to_array(bb):
+    """Unpack a bitboard into a (121,) uint8 array of zeros and ones."""
+    raw = np.frombuffer(bb.to_bytes(16, "little"), dtype=np.uint8)
+    return np.unpackbits(raw, bitorder="little")[:engine.NUM_SQUARES]
+
+
+def new_planes(num_states, mobility=False):
+    """Allocate planes for a batch of FeatureStates.
+
+    Args:
+        num_states (int): number of positions in the batch
+        mobility (bool): True to make room for the mobility planes
+
+    Returns:
+        (numpy.ndarray): (num_states, planes, 121) float32 zeros; pass each
+                         row to a FeatureState as out
+    """
+    num_planes = NUM_PLANES_MOBILITY if mobility else NUM_PLANES
+    return np.zeros((num_states, num_planes, engine.NUM_SQUARES),
+                    dtype=np.float32)
+
+
+def stack_planes(states, out=None):
+    """Stack the planes of several FeatureStates into one batch.
+
+    Args:
+        states (list(FeatureState)): positions, all with or all without
+                                     mobility planes
+        out (numpy.ndarray): array to write the batch into, or None
+
+    Returns:
+        (numpy.ndarray): (len(states), planes, 121) float32 planes
+    """
+    return np.stack([s.planes for s in states], out=out)
+
+
+def stack_boards(states, out=None):
+    """Stack the boards of several FeatureStates into an (N, 121) batch."""
+    return np.stack([s.board for s in states], out=out)
+
+
+class FeatureState(engine.GameState):
+
+    """A GameState that keeps its network input planes up to date.
+
+    Attributes:
+        board (numpy.ndarray): (121,) int8 position in the encoding of
+                               game_state_to_array
+        planes (numpy.ndarray): (planes, 121) float32 input planes
+        mobility (bool): True if the mobility planes are kept
+    """
+
+    def __init__(self, grid=None, mobility=False, out=None):
+        """Set up a position and its planes.
+
+        Args:
+            grid (list(str)): layout in the format of Board.grid, defaults
+                              to the starting layout
+            mobility (bool): True to keep the mobility planes as well; they
+                             are recomputed after every move
+            out (numpy.ndarray): (planes, 121) float32 array to keep the
+                                 planes in, such as a row from new_planes,
+                                 or None to allocate one
+        """
+        engine.GameState.__init__(self, grid)
+        self.mobility = mobility
+        num_planes = NUM_PLANES_MOBILITY if mobility else NUM_PLANES
+        if out is None:
+            out = np.zeros((num_planes, engine.NUM_SQUARES), dtype=np.float32)
+        elif out.shape != (num_planes, engine.NUM_SQUARES):
+            raise ValueError("planes must have shape ({}, {})".format(
+                num_planes, engine.NUM_SQUARES))
+        self.planes = out
+        self.board = np.zeros(engine.NUM_SQUARES, dtype=np.int8)
+        self.refresh()
+
+    def copy(self, out=None):
+        """Return a copy of the position, with its own planes, and an empty
+        undo stack.
+
+        Args:
+            out (numpy.ndarray): array to keep the copy's planes in, or None
+        """
+        other = engine.GameState.copy(self)
+        other.__class__ = FeatureState
+        other.mobility = self.mobility
+        if out is None:
+            other.planes = self.planes.copy()
+        else:
+            out[...] = self.planes
+            other.planes = out
+        other.board = self.board.copy()
+        return other
+
+    def refresh(self):
+        """Rebuild the board and planes from the bitboards."""
+        self.board[:] = 0
+        for piece, bb in ((engine.ATTACKER, self.attackers),
+                          (engine.DEFENDER, self.defenders),
+                          (engine.KING, self.king)):
+            bits = bitboard_to_array(bb)
+            self.planes[piece] = bits
+            self.board[bits.view(bool)] = piece + 1
+        self._update_side()
+
+    def _place(self, piece, sq):
+        self.planes[piece, sq] = 1
+        self.board[sq] = piece + 1
+
+    def _clear(self, piece, sq):
+        self.planes[piece, sq] = 0
+        self.board[sq] = 0
+
+    def _update_side(self):
+        self.planes[SIDE_PLANE].fill(self.a_turn)
+        if self.mobility:
+            for plane, attacker in ((ATTACKER_MOBILITY, True),
+                                    (DEFENDER_MOBILITY, False)):
+                counts = self.planes[plane]
+                counts[:] = 0
+                for sq in engine.iter_squares(self.side(attacker)):
+                    counts += bitboard_to_array(self.piece_moves(sq))
+
+    def relocate(self, frm, to):
+        engine.GameState.relocate(self, frm, to)
+        piece = self.piece_at(to)
+        self._clear(piece, frm)
+        self._place(piece, to)
+
+    def resolve_captures(self, to):
+        if self.a_turn:
+            piece = engine.DEFENDER
+        else:
+            piece = engine.ATTACKER
+        captured = engine.GameState.resolve_captures(self, to)
+        if captured:
+            if self.king_killed:
+                self._clear(engine.KING, self.king_sq)
+            for sq in engine.iter_squares(captured & ~(1 << self.king_sq)):
+                self._clear(piece, sq)
+        return captured
+
+    def move(self, frm, to):
+        captured = engine.GameState.move(self, frm, to)
+        self._update_side()
+        return captured
+
+    def unmake_move(self):
+        ply = self.ply - 1
+        frm = self._undo_frm[ply]
+        to = self._undo_to[ply]
+        captured = self._undo_captured[ply]
+        engine.GameState.unmake_move(self)
+        piece = self.piece_at(frm)
+        self._clear(piece, to)
+        self._place(piece, frm)
+        if captured:
+            for sq in engine.iter_squares(captured):
+                self._place(self.piece_at(sq), sq)
+        self._update_side()
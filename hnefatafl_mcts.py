@@ -0,0 +1,288 @@
+"""
+Monte Carlo Tree Search player for Hnefatafl.
+
+The tree is searched with PUCT. Every node keeps the statistics of its
+children in parallel lists indexed by move, and only creates a child node
+the first time that move is played in a simulation. Leaves are scored by a
+value function, by default the evaluate method of a
+hnefatafl_eval.StaticEvaluator, or by random playouts to the end of the
+game if asked for. A leaf's legal moves are only listed when a simulation
+passes through it a second time, as most leaves are never visited again.
+
+Values are always from the attackers' point of view: +1 is a win for the
+attackers and -1 a win for the defenders.
+
+"""
+
+import math
+import time
+import hnefatafl_engine as engine
+from hnefatafl_eval import StaticEvaluator
+
+PLAYOUT_LIMIT = 200
+
+
+class Node(object):
+
+    """A position in the search tree and the statistics of its moves."""
+
+    __slots__ = ("hash", "a_turn", "moves", "priors", "visits", "values",
+                 "children", "total", "value_sum", "order", "tried",
+                 "terminal", "evaluated")
+
+    def __init__(self, state):
+        """Create an unexpanded node for a position.
+
+        hash: Zobrist hash of the position.
+        a_turn: True if the attackers are to move.
+        moves: Legal moves, or None until the node is expanded.
+        priors, visits, values: Prior probability, visit count and summed
+                                value of every move, from the point of view
+                                of the side to move.
+        children: Child node of every move, or None until it is visited.
+        total: Number of simulations that passed through this node.
+        value_sum: Summed value of those simulations, for the side to move.
+        order: Indices of the moves by falling prior, or None if the priors
+               are all equal.
+        tried: Number of moves, in that order, played at least once.
+        terminal: Value of the position if the game is over, None o.w.
+        evaluated: True once the position has been scored as a leaf.
+
+        Args:
+            state (GameState): the position
+        """
+        self.hash = state.hash
+        self.a_turn = state.a_turn
+        self.moves = None
+        self.priors = None
+        self.visits = None
+        self.values = None
+        self.children = None
+        self.total = 0
+        self.value_sum = 0.0
+        self.order = None
+        self.tried = 0
+        self.terminal = None
+        self.evaluated = False
+
+
+def random_playout(state, limit=PLAYOUT_LIMIT):
+    """Play random moves on a copy of a position until the game ends.
+
+    Args:
+        state (GameState): position to start from; it is not changed
+        limit (int): moves to play before calling the game a draw
+
+    Returns:
+        (float): 1.0 if the attackers won, -1.0 if the defenders won, and
+                 0.0 for a draw
+    """
+    return engine.random_playout(state.copy(), limit)[0]
+
+
+class MCTSResult(object):
+
+    """The outcome of an MCTS search.
+
+    Attributes:
+        move ((int, int)): most visited move, as (from square, to square)
+        value (float): average value of the move, for the side to move
+        simulations (int): number of simulations run by this search
+        elapsed (float): seconds spent searching
+        policy (list(((int, int), float))): share of the root visits that
+                                            went to each move
+    """
+
+    def __init__(self, move, value, simulations, elapsed, policy):
+        self.move = move
+        self.value = value
+        self.simulations = simulations
+        self.elapsed = elapsed
+        self.policy = policy
+
+    @property
+    def simulations_per_sec(self):
+        """Simulations run per second."""
+        return self.simulations / max(self.elapsed, 1e-9)
+
+    def __repr__(self):
+        return ("MCTSResult(move={}, value={:.3f}, simulations={}, "
+                "sims/sec={:.0f})".format(self.move, self.value,
+                                          self.simulations,
+                                          self.simulations_per_sec))
+
+
+class MCTS(object):
+
+    """PUCT tree search, keeping its tree from one move to the next."""
+
+    def __init__(self, value=None, prior=None, c_puct=1.5,
+                 playout_limit=PLAYOUT_LIMIT, playouts=False):
+        """Set up the search.
+
+        Args:
+            value (function): scores a GameState from the attackers' point
+                              of view in [-1, 1]; defaults to the evaluate
+                              method of a StaticEvaluator with the default
+                              weights
+            prior (function): takes a GameState and its legal moves and
+                              returns a probability for each move; moves
+                              are equally likely if not given
+            c_puct (float): weight of the prior against the average value
+            playout_limit (int): moves in a random playout before it is
+                                 called a draw
+            playouts (bool): True to score leaves with random playouts
+                             instead of the value function; much slower
+        """
+        if value is None and not playouts:
+            value = StaticEvaluator().evaluate
+        self.value = None if playouts else value
+        self.prior = prior
+        self.c_puct = c_puct
+        self.playout_limit = playout_limit
+        self.root = None
+
+    def search(self, state, simulations=1000, time_limit=None):
+        """Run simulations from a position and pick the most visited move.
+
+        If the position is already in the tree from the previous search,
+        up to two moves ago, that part of the tree is kept.
+
+        Args:
+            state (GameState): position to search; it is restored afterwards
+            simulations (int): simulations to run, or None to run until the
+                               time limit
+            time_limit (float): seconds to search for, or None
+
+        Returns:
+            (MCTSResult): the chosen move and statistics about the search
+        """
+        self.root = self._find_root(state)
+        if self.root.moves is None and self.root.terminal is None:
+            self._expand(self.root, state)
+        start = time.time()
+        deadline = None if time_limit is None else start + time_limit
+        n = 0
+        while simulations is None or n < simulations:
+            self._simulate(state)
+            n += 1
+            if deadline is not None and not n & 15 and time.time() >= deadline:
+                break
+        elapsed = time.time() - start
+
+        root = self.root
+        if not root.moves:
+            return MCTSResult(None, -1.0, n, elapsed, [])
+        best = max(range(len(root.moves)), key=root.visits.__getitem__)
+        visits = root.visits[best]
+        value = root.values[best] / visits if visits else 0.0
+        total = float(sum(root.visits)) or 1.0
+        policy = [(m, v / total) for m, v in zip(root.moves, root.visits)]
+        return MCTSResult(root.moves[best], value, n, elapsed, policy)
+
+    def _find_root(self, state):
+        root = self.root
+        if root is not None:
+            if root.hash == state.hash:
+                return root
+            for child in root.children or ():
+                if child is None:
+                    continue
+                if child.hash == state.hash:
+                    return child
+                for grandchild in child.children or ():
+                    if grandchild is not None and grandchild.hash == state.hash:
+                        return grandchild
+        return Node(state)
+
+    def _simulate(self, state):
+        node = self.root
+        path = []
+        while 1:
+            if node.terminal is not None:
+                value = node.terminal
+                break
+            if node.moves is None:
+                if not node.evaluated:
+                    value = self._evaluate(node, state)
+                    break
+                self._expand(node, state)
+                if node.terminal is not None:
+                    value = node.terminal
+                    break
+            i = self._select(node)
+            path.append((node, i))
+            state.make_move(*node.moves[i])
+            child = node.children[i]
+            if child is None:
+                child = node.children[i] = Node(state)
+            node = child
+        for node, i in path:
+            state.unmake_move()
+            node.total += 1
+            node.visits[i] += 1
+            v = value if node.a_turn else -value
+            node.values[i] += v
+            node.value_sum += v
+
+    def _evaluate(self, node, state):
+        value = engine.outcome(state)
+        if value is None and not engine.has_legal_move(state):
+            # A side that cannot move loses
+            value = -1.0 if state.a_turn else 1.0
+        if value is not None:
+            node.terminal = value
+            return value
+        node.evaluated = True
+        if self.value is not None:
+            return self.value(state)
+        return random_playout(state, self.playout_limit)
+
+    def _expand(self, node, state):
+        value = engine.outcome(state)
+        moves = [] if value is not None else state.legal_moves()
+        if not moves:
+            if value is None:
+                # A side that cannot move loses
+                value = -1.0 if state.a_turn else 1.0
+            node.terminal = value
+            return
+        n = len(moves)
+        if self.prior is None:
+            priors = [1.0 / n] * n
+        else:
+            priors = list(self.prior(state, moves))
+            node.order = sorted(range(n), key=priors.__getitem__,
+                                reverse=True)
+        node.moves = moves
+        node.priors = priors
+        node.visits = [0] * n
+        node.values = [0.0] * n
+        node.children = [None] * n
+
+    def _select(self, node):
+        # Moves not played yet all take the average value of the node, so
+        # the best of them is the one with the highest prior, and only the
+        # moves tried so far and that one need to be scored
+        scale = self.c_puct * math.sqrt(node.total + 1)
+        visits = node.visits
+        values = node.values
+        priors = node.priors
+        order = node.order
+        tried = node.tried
+        best = None
+        best_score = -1e300
+        for j in range(tried):
+            i = j if order is None else order[j]
+            n = visits[i]
+            score = values[i] / n + scale * priors[i] / (1 + n)
+            if score > best_score:
+                best_score = score
+                best = i
+        if tried < len(visits):
+            i = tried if order is None else order[tried]
+            first_play = node.value_sum / node.total if node.total else 0.0
+            if first_play + scale * priors[i] > best_score:
+                best = i
+                node.tried = tried + 1
+        return best
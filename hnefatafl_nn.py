@@ -0,0 +1,239 @@
+"""
+NumPy forward pass for the Hnefatafl value networks.
+
+The models built by hnefatafl_train.initialize_random_nn_model are small
+stacks of Dense layers, so scoring positions does not need TensorFlow.
+export_model writes the weights and activations of a model's Dense layers
+to a .npz file, and NumpyModel loads them and computes the same outputs
+with NumPy. Dropout layers only act while training and are left out.
+
+NumpyModel has the predict method of a Keras model, so it can be passed to
+do_best_move and the other players in place of one.
+
+Usage:
+    python hnefatafl_nn.py export attacker_model_after_340_games.h5 attacker.npz
+
+"""
+
+import argparse
+import json
+import sys
+import numpy as np
+
+ACTIVATIONS = {
+    "linear": None,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "tanh": lambda x: np.tanh(x, out=x),
+    "sigmoid": lambda x: np.divide(1, 1 + np.exp(-x, out=x), out=x),
+}
+
+
+def dense_layers(model):
+    """Collect the Dense layers of a Keras model.
+
+    Args:
+        model (Model): the Keras model
+
+    Returns:
+        list((numpy.ndarray, numpy.ndarray, str)): kernel, bias and name of
+                                                   the activation of every
+                                                   Dense layer, in order
+    """
+    layers = []
+    for layer in model.layers:
+        if type(layer).__name__ != "Dense":
+            continue
+        kernel, bias = layer.get_weights()
+        layers.append((kernel, bias, layer.get_config()["activation"]))
+    return layers
+
+
+def export_model(model, path):
+    """Write the Dense layers of a Keras model to a .npz file.
+
+    Args:
+        model (Model): the Keras model, or a file name to load it from
+        path (str): file name of the .npz file
+    """
+    if isinstance(model, str):
+        from tensorflow.keras.models import load_model
+        model = load_model(model)
+    arrays = {}
+    activations = []
+    for i, (kernel, bias, activation) in enumerate(dense_layers(model)):
+        arrays["kernel_{}".format(i)] = kernel
+        arrays["bias_{}".format(i)] = bias
+        activations.append(activation)
+    np.savez(path, activations=np.array(activations), **arrays)
+
+
+class NumpyModel(object):
+
+    """A stack of Dense layers evaluated with NumPy.
+
+    Attributes:
+        kernels (list(numpy.ndarray)): weight matrix of every layer
+        biases (list(numpy.ndarray)): bias vector of every layer
+        activations (list(str)): activation of every layer
+        dtype (numpy.dtype): precision the outputs are computed in
+    """
+
+    def __init__(self, layers, dtype=np.float64):
+        """Set up the layers.
+
+        Args:
+            layers (list((numpy.ndarray, numpy.ndarray, str))): kernel, bias
+                and name of the activation of every layer, as returned by
+                dense_layers
+            dtype (numpy.dtype): np.float64 by default; np.float32 matches
+                                 Keras and also reuses the same buffers for
+                                 every call
+        """
+        self.dtype = np.dtype(dtype)
+        self._buffers = None
+        self.activations = []
+        for _, _, activation in layers:
+            if activation not in ACTIVATIONS:
+                raise ValueError("unsupported activation {}".format(activation))
+            self.activations.append(activation)
+        self.set_weights([w for kernel, bias, _ in layers
+                          for w in (kernel, bias)])
+
+    @classmethod
+    def load(cls, path, dtype=np.float64):
+        """Load a model written by export_model.
+
+        Args:
+            path (str): file name of the .npz file
+            dtype (numpy.dtype): precision to compute the outputs in
+        """
+        with np.load(path) as f:
+            activations = [str(a) for a in f["activations"]]
+            layers = [(f["kernel_{}".format(i)], f["bias_{}".format(i)], a)
+                      for i, a in enumerate(activations)]
+        return cls(layers, dtype)
+
+    @classmethod
+    def from_json(cls, json_config, weights, dtype=np.float64):
+        """Build a model from a Keras architecture and its weights.
+
+        This reads the output of model.to_json() and model.get_weights(), as
+        sent by hnefatafl_train.model_snapshot, without loading Keras.
+
+        Args:
+            json_config (str): architecture from model.to_json()
+            weights (list(numpy.ndarray)): weights from model.get_weights()
+            dtype (numpy.dtype): precision to compute the outputs in
+        """
+        config = json.loads(json_config)["config"]
+        if isinstance(config, dict):
+            config = config["layers"]
+        activations = [layer["config"]["activation"] for layer in config
+                       if layer["class_name"] == "Dense"]
+        layers = [(weights[2 * i], weights[2 * i + 1], a)
+                  for i, a in enumerate(activations)]
+        return cls(layers, dtype)
+
+    @property
+    def kernels(self):
+        """Weight matrix of every layer."""
+        return self._weights[0]
+
+    @property
+    def biases(self):
+        """Bias vector of every layer."""
+        return self._weights[1]
+
+    def set_weights(self, weights):
+        """Replace the weights, given in the order of model.get_weights().
+
+        The kernels and biases are swapped in together, so a predict running
+        in another thread uses either the old weights or the new ones.
+        """
+        kernels = [np.ascontiguousarray(w, dtype=self.dtype)
+                   for w in weights[0::2]]
+        biases = [np.asarray(w, dtype=self.dtype) for w in weights[1::2]]
+        self._weights = (kernels, biases)
+
+    def get_weights(self):
+        """Return the weights in the order of model.get_weights()."""
+        kernels, biases = self._weights
+        return [w for pair in zip(kernels, biases) for w in pair]
+
+    def _outputs(self, n, biases):
+        # Keep one output buffer per layer, big enough for the largest batch
+        # seen so far and as wide as the layer
+        buffers = self._buffers
+        if (buffers is None or len(buffers[0]) < n or
+                any(buf.shape[1] != len(b) for buf, b in zip(buffers, biases))):
+            buffers = [np.empty((n, len(b)), dtype=self.dtype)
+                       for b in biases]
+            self._buffers = buffers
+        return [buf[:n] for buf in buffers]
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Score a batch of positions.
+
+        Args:
+            x (numpy.ndarray): (N, 121) positions in the encoding of
+                               game_state_to_array
+            batch_size, verbose: accepted for Keras compatibility, unused
+
+        Returns:
+            (numpy.ndarray): (N, 1) scores; with float32 the array is one
+                             of the model's buffers, and is overwritten by
+                             the next call
+        """
+        kernels, biases = self._weights
+        x = np.asarray(x, dtype=self.dtype).reshape(-1, kernels[0].shape[0])
+        if self.dtype == np.float32:
+            outputs = self._outputs(len(x), biases)
+        else:
+            outputs = [None] * len(kernels)
+        for kernel, bias, activation, out in zip(kernels, biases,
+                                                 self.activations, outputs):
+            x = np.dot(x, kernel, out=out)
+            x += bias
+            if ACTIVATIONS[activation] is not None:
+                ACTIVATIONS[activation](x)
+        return x
+
+    def evaluate(self, position):
+        """Score a single position.
+
+        Args:
+            position (numpy.ndarray): 121 squares, or an 11x11 array
+
+        Returns:
+            (float): the score
+        """
+        return float(self.predict(position.reshape(1, -1))[0, 0])
+
+
+def main(argv=None):
+    """Command line entry point for exporting models."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command")
+    e = commands.add_parser("export", help="convert a saved model to .npz")
+    e.add_argument("model", help="model saved by Keras (.h5)")
+    e.add_argument("output", help="file to write (.npz)")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        from tensorflow.keras.models import load_model
+        model = load_model(args.model)
+        export_model(model, args.output)
+        # Check the exported model against Keras on random positions
+        x = np.random.randint(0, 4, size=(256, 11 * 11))
+        expected = model.predict(x, verbose=0)
+        actual = NumpyModel.load(args.output).predict(x)
+        print("Wrote {}: {} Dense layers, largest difference from Keras "
+              "{:.3g}".format(args.output, len(dense_layers(model)),
+                              float(np.abs(expected - actual).max())))
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
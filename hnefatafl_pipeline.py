@@ -0,0 +1,219 @@
+"""
+Stages connected by bounded queues, for overlapping the steps of training.
+
+Each Stage runs in its own threads, takes items from an input queue, and
+puts what it makes on an output queue. The queues are bounded, so a stage
+that gets ahead of the next one blocks until there is room again, and the
+whole pipeline runs at the pace of its slowest stage.
+
+Every stage counts the items it handles and splits its time between
+working, waiting for input and waiting for room on its output. The stage
+that spends the largest share of its time working is the bottleneck.
+
+"""
+
+import queue
+import sys
+import threading
+import time
+
+# How often blocked threads check whether the pipeline is stopping, in
+# seconds
+POLL_INTERVAL = 0.1
+
+
+class Stage(object):
+
+    """One step of a pipeline, run by one or more threads.
+
+    Attributes:
+        name (str): name shown in the statistics
+        items (int): number of items handled so far
+        busy (float): thread-seconds spent working
+        waiting_for_input (float): thread-seconds spent waiting for input
+        waiting_for_output (float): thread-seconds spent waiting for room
+                                    on the output queue
+    """
+
+    def __init__(self, pipeline, name, work, input=None, output=None,
+                 threads=1):
+        """Set up a stage; Pipeline.add_stage is the usual way to make one.
+
+        Args:
+            pipeline (Pipeline): the pipeline the stage belongs to
+            name (str): name shown in the statistics
+            work (function): called with each input item, or with no
+                             arguments if the stage has no input, and
+                             returns a list of items for the output
+            input (queue.Queue): queue to take items from, or None for a
+                                 stage that makes items of its own
+            output (queue.Queue): queue to put items on, or None
+            threads (int): number of threads running the stage
+        """
+        self.pipeline = pipeline
+        self.name = name
+        self.work = work
+        self.input = input
+        self.output = output
+        self.upstream = []
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_for_input = 0.0
+        self.waiting_for_output = 0.0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=name)
+                        for _ in range(threads)]
+        for t in self.threads:
+            t.daemon = True
+
+    def done(self):
+        """True once every thread of the stage has finished."""
+        return not any(t.is_alive() for t in self.threads)
+
+    def _finished(self):
+        # Sources stop when asked; other stages first drain their input
+        if not self.pipeline.stopping.is_set():
+            return False
+        if self.input is None:
+            return True
+        return self.input.empty() and all(s.done() for s in self.upstream)
+
+    def _get(self):
+        while 1:
+            try:
+                return self.input.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self._finished():
+                    raise StopIteration
+
+    def _put(self, item):
+        while 1:
+            try:
+                self.output.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                if self.pipeline.error is not None:
+                    raise StopIteration
+
+    def _run(self):
+        try:
+            while not self._finished() and self.pipeline.error is None:
+                start = time.time()
+                if self.input is None:
+                    ready = start
+                    results = self.work()
+                else:
+                    item = self._get()
+                    ready = time.time()
+                    results = self.work(item)
+                worked = time.time()
+                if self.output is not None:
+                    for result in results:
+                        self._put(result)
+                end = time.time()
+                with self.lock:
+                    self.items += 1
+                    self.waiting_for_input += ready - start
+                    self.busy += worked - ready
+                    self.waiting_for_output += end - worked
+        except StopIteration:
+            pass
+        except BaseException:
+            self.pipeline.error = sys.exc_info()
+            self.pipeline.stop()
+
+
+class Pipeline(object):
+
+    """A set of stages and the queues between them."""
+
+    def __init__(self):
+        self.stages = []
+        self.stopping = threading.Event()
+        self.error = None
+        self.start_time = None
+
+    def add_stage(self, name, work, input=None, output=None, threads=1):
+        """Add a stage; see Stage for the arguments.
+
+        Stages whose output is this stage's input are its upstream, and it
+        only finishes after they have.
+
+        Returns:
+            (Stage): the new stage
+        """
+        stage = Stage(self, name, work, input, output, threads)
+        for other in self.stages:
+            if input is not None and other.output is input:
+                stage.upstream.append(other)
+            if output is not None and other.input is output:
+                other.upstream.append(stage)
+        self.stages.append(stage)
+        return stage
+
+    def stop(self):
+        """Stop the sources; the other stages finish the items left."""
+        self.stopping.set()
+
+    def stats(self):
+        """Throughput and time split of every stage.
+
+        Returns:
+            list(dict): for each stage, its name, items handled, items per
+                        second, and the share of its threads' time spent
+                        working, waiting for input and waiting for output
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        stats = []
+        for stage in self.stages:
+            with stage.lock:
+                total = max(elapsed * len(stage.threads), 1e-9)
+                stats.append({
+                    "stage": stage.name,
+                    "items": stage.items,
+                    "items_per_sec": stage.items / elapsed,
+                    "busy": stage.busy / total,
+                    "waiting_for_input": stage.waiting_for_input / total,
+                    "waiting_for_output": stage.waiting_for_output / total})
+        return stats
+
+    def report(self):
+        """Format the statistics as one line per stage."""
+        lines = []
+        for s in self.stats():
+            lines.append("{:<12} {:>8} items {:>9.2f}/s  busy {:>4.0%}  "
+                         "in {:>4.0%}  out {:>4.0%}".format(
+                             s["stage"], s["items"], s["items_per_sec"],
+                             s["busy"], s["waiting_for_input"],
+                             s["waiting_for_output"]))
+        return "\n".join(lines)
+
+    def run(self, report_every=None):
+        """Start every stage and wait for them all to finish.
+
+        The pipeline runs until a stage calls stop, or until interrupted
+        with Ctrl-C. An exception in any stage stops the pipeline and is
+        raised here.
+
+        Args:
+            report_every (float): print the statistics this often, in
+                                  seconds, or None
+        """
+        self.start_time = time.time()
+        for stage in self.stages:
+            for t in stage.threads:
+                t.start()
+        last_report = self.start_time
+        try:
+            while not all(stage.done() for stage in self.stages):
+                time.sleep(POLL_INTERVAL)
+                if (report_every is not None and
+                        time.time() - last_report >= report_every):
+                    print(self.report())
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            self.stop()
+            while not all(stage.done() for stage in self.stages):
+                time.sleep(POLL_INTERVAL)
+        if self.error is not None:
+            raise self.error[1].with_traceback(self.error[2])
@@ -0,0 +1,256 @@
+"""
+Compact binary records of Hnefatafl games.
+
+A record file starts with MAGIC and is followed by any number of games.
+Every game is stored as a GAME_HEADER, little-endian:
+
+    flags        uint8   START_CUSTOM if the start position follows,
+                         DEFENDERS_FIRST if the defenders moved first
+    result       int8    1 if the attackers won, -1 if the defenders won,
+                         0 for a draw
+    num_moves    uint32  number of moves
+    name sizes   2 uint8 length of the attacker's and defender's names
+
+followed by the two names in UTF-8, the start position if START_CUSTOM is
+set (121 bytes, one per square: 0 empty, 1 attacker, 2 defender, 3 king),
+and two bytes per move: the from square and the to square.
+
+RecordWriter appends games to a file as they finish, and read_games is a
+generator that reads them back one at a time; the positions of a game are
+only worked out when GameRecord.positions is iterated.
+
+"""
+
+import struct
+import hnefatafl_engine as engine
+
+MAGIC = b"HNFTREC\x01"
+GAME_HEADER = struct.Struct("<BbIBB")
+
+START_CUSTOM = 1
+DEFENDERS_FIRST = 2
+
+_PIECES = ".adc"
+
+
+class GameRecord(object):
+
+    """One recorded game.
+
+    Attributes:
+        result (int): 1 if the attackers won, -1 if the defenders won, 0 for
+                      a draw
+        attacker (str): name of the attacking player
+        defender (str): name of the defending player
+        start (bytes): start position, 121 squares, or None for the
+                       starting layout
+        defenders_first (bool): True if the defenders moved first
+        data (bytes): the moves, two bytes each
+    """
+
+    def __init__(self, result, attacker, defender, start, defenders_first,
+                 data):
+        self.result = result
+        self.attacker = attacker
+        self.defender = defender
+        self.start = start
+        self.defenders_first = defenders_first
+        self.data = data
+
+    def __len__(self):
+        """Number of moves in the game."""
+        return len(self.data) // 2
+
+    @property
+    def moves(self):
+        """List of (from square, to square) moves."""
+        data = self.data
+        return [(data[i], data[i + 1]) for i in range(0, len(data), 2)]
+
+    def initial_state(self):
+        """Return the GameState the game started from."""
+        if self.start is None:
+            state = engine.GameState()
+        else:
+            grid = ["".join(_PIECES[self.start[engine.square(x, y)]]
+                            for x in range(engine.DIM))
+                    for y in range(engine.DIM)]
+            state = engine.GameState(grid)
+        if self.defenders_first:
+            state.a_turn = False
+            state.hash = state.compute_hash()
+        return state
+
+    def positions(self):
+        """Replay the game, yielding the position after every move.
+
+        The same GameState is yielded every time, moved on by one move, so
+        copy it to keep a position.
+
+        Yields:
+            ((int, int), GameState): the move and the position after it
+        """
+        state = self.initial_state()
+        data = self.data
+        for i in range(0, len(data), 2):
+            move = (data[i], data[i + 1])
+            state.move(*move)
+            yield move, state
+
+
+def encode_position(state):
+    """Encode a GameState as 121 bytes, one per square."""
+    squares = bytearray(engine.NUM_SQUARES)
+    for piece, bb in ((1, state.attackers), (2, state.defenders),
+                      (3, state.king)):
+        for sq in engine.iter_squares(bb):
+            squares[sq] = piece
+    return bytes(squares)
+
+
+_START_POSITION = encode_position(engine.GameState())
+
+
+def _encode_name(name):
+    # Names are cut to 255 bytes of UTF-8, without splitting a character
+    return name.encode("utf-8")[:255].decode("utf-8", "ignore").encode("utf-8")
+
+
+class RecordWriter(object):
+
+    """Appends games to a record file."""
+
+    def __init__(self, path):
+        """Open a record file for appending, creating it if needed.
+
+        Args:
+            path (str): file name of the record file
+        """
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.games = 0
+
+    def write_game(self, moves, result, attacker="", defender="", start=None):
+        """Append one game.
+
+        Args:
+            moves (list((int, int))): the moves, as (from, to) squares
+            result (float): 1.0 if the attackers won, -1.0 if the defenders
+                            won, 0.0 for a draw
+            attacker (str): name of the attacking player
+            defender (str): name of the defending player
+            start (GameState): position the game started from, or None for
+                               the starting layout with the attackers to move
+        """
+        attacker = _encode_name(attacker)
+        defender = _encode_name(defender)
+        flags = 0
+        position = b""
+        if start is not None:
+            position = encode_position(start)
+            if position != _START_POSITION:
+                flags |= START_CUSTOM
+            else:
+                position = b""
+            if not start.a_turn:
+                flags |= DEFENDERS_FIRST
+        data = bytearray(2 * len(moves))
+        data[0::2] = bytes(frm for frm, _ in moves)
+        data[1::2] = bytes(to for _, to in moves)
+        self.file.write(GAME_HEADER.pack(flags, int(result), len(moves),
+                                         len(attacker), len(defender)))
+        self.file.write(attacker + defender + position + data)
+        self.games += 1
+
+    def flush(self):
+        """Write buffered games out to the file."""
+        self.file.flush()
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GameRecorder(object):
+
+    """Collects the moves of a game being played on a GameState.
+
+    The moves are read off the position after each one, so the game loops
+    only need to call update after every move, whoever made it.
+    """
+
+    def __init__(self, writer, state, attacker="", defender=""):
+        """Start recording a game.
+
+        Args:
+            writer (RecordWriter): file to write the game to when it ends
+            state (GameState): the position the game starts from
+            attacker (str): name of the attacking player
+            defender (str): name of the defending player
+        """
+        self.writer = writer
+        self.start = state.copy()
+        self.attacker = attacker
+        self.defender = defender
+        self.moves = []
+        self.sides = (state.attackers, state.defenders | state.king)
+
+    def update(self, state):
+        """Record the move just played on the position."""
+        sides = (state.attackers, state.defenders | state.king)
+        # Only the side that moved has one piece gone and one new; its
+        # pieces cannot have been captured on its own move
+        for before, after in zip(self.sides, sides):
+            if before & ~after and after & ~before:
+                frm = (before & ~after).bit_length() - 1
+                to = (after & ~before).bit_length() - 1
+                self.moves.append((frm, to))
+                break
+        self.sides = sides
+
+    def finish(self, result):
+        """Write the game to the file.
+
+        Args:
+            result (float): 1.0 if the attackers won, -1.0 if the defenders
+                            won, 0.0 for a draw
+        """
+        self.writer.write_game(self.moves, result, self.attacker,
+                               self.defender, self.start)
+
+
+def read_games(path):
+    """Read the games in a record file one at a time.
+
+    Args:
+        path (str): file name of the record file
+
+    Yields:
+        (GameRecord): every game in the file, in order
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a game record file".format(path))
+        while 1:
+            header = f.read(GAME_HEADER.size)
+            if len(header) < GAME_HEADER.size:
+                return
+            flags, result, num_moves, a_len, d_len = GAME_HEADER.unpack(header)
+            attacker = f.read(a_len).decode("utf-8")
+            defender = f.read(d_len).decode("utf-8")
+            start = None
+            if flags & START_CUSTOM:
+                start = f.read(engine.NUM_SQUARES)
+            data = f.read(2 * num_moves)
+            if len(data) < 2 * num_moves:
+                raise ValueError("{} ends in the middle of a game".format(path))
+            yield GameRecord(result, attacker, defender, start,
+                             bool(flags & DEFENDERS_FIRST), data)
+
@@ -0,0 +1,224 @@
+"""
+Replay buffer of self-play positions, kept on disk.
+
+Positions are appended as records to shards, .npy files with a fixed number
+of records each, named shard_000000.npy, shard_000001.npy, ... in one
+directory. Shards are memory-mapped, so neither writing nor sampling holds
+more than the pages in use in memory, and the records outlive the process:
+a buffer opened on the same directory later carries on where it left off.
+
+Every record holds a position in the encoding of game_state_to_array, the
+side that just moved (ATTACKER or DEFENDER), its training target and the
+id of the game it came from. Records not written yet have a game id of -1.
+
+"""
+
+import os
+import re
+import numpy as np
+
+ATTACKER = 1
+DEFENDER = 2
+
+RECORD_DTYPE = np.dtype([("state", np.int8, (11 * 11,)),
+                         ("side", np.int8),
+                         ("target", np.float32),
+                         ("game", np.int64)])
+
+SHARD_PATTERN = re.compile(r"shard_(\d{6})\.npy$")
+
+
+class ReplayBuffer(object):
+
+    """Append-only store of training records, sampled in shuffled batches.
+
+    Attributes:
+        directory (str): directory holding the shards
+        shard_size (int): number of records in every shard
+        window (int): number of most recent shards to sample from, or None
+                      for all of them
+        next_game (int): id given to the next game added
+    """
+
+    def __init__(self, directory, shard_size=1 << 16, window=None):
+        """Open a buffer, creating the directory if needed.
+
+        Args:
+            directory (str): directory holding the shards
+            shard_size (int): records per shard, for new shards; existing
+                              shards keep the size they were made with
+            window (int): number of most recent shards to sample from, or
+                          None for all of them
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.window = window
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.shards = sorted(int(m.group(1)) for m in
+                             map(SHARD_PATTERN.match, os.listdir(directory))
+                             if m)
+        self._maps = {}
+        self._indices = {}
+        self.writer = None
+        self.fill = 0
+        self.next_game = 0
+        if self.shards:
+            self.writer = np.load(self._path(self.shards[-1]), mmap_mode="r+")
+            unused = np.flatnonzero(self.writer["game"] < 0)
+            self.fill = int(unused[0]) if len(unused) else len(self.writer)
+            # The last shard can be empty, so look at every shard; records
+            # not written yet have a game id of -1 and do not count
+            for shard in self.shards:
+                games = self._records(shard)["game"]
+                if len(games):
+                    self.next_game = max(self.next_game,
+                                         int(games.max()) + 1)
+
+    def _path(self, shard):
+        return os.path.join(self.directory, "shard_{:06d}.npy".format(shard))
+
+    def _records(self, shard):
+        if shard == self.shards[-1]:
+            return self.writer[:self.fill]
+        if shard not in self._maps:
+            self._maps[shard] = np.load(self._path(shard), mmap_mode="r")
+        return self._maps[shard]
+
+    def _new_shard(self):
+        if self.writer is not None:
+            self.writer.flush()
+        shard = self.shards[-1] + 1 if self.shards else 0
+        records = np.lib.format.open_memmap(self._path(shard), mode="w+",
+                                            dtype=RECORD_DTYPE,
+                                            shape=(self.shard_size,))
+        records["game"] = -1
+        self.shards.append(shard)
+        self.writer = records
+        self.fill = 0
+
+    def add(self, states, side, targets, game=None):
+        """Append the positions of one side in one game.
+
+        Args:
+            states (numpy.ndarray): (N, 121) or (N, 11, 11) positions
+            side (int): ATTACKER or DEFENDER, the side that just moved
+            targets (numpy.ndarray): (N,) training targets
+            game (int): id of the game, or None to use next_game
+
+        Returns:
+            (int): id of the game
+        """
+        if game is None:
+            game = self.next_game
+        self.next_game = max(self.next_game, game + 1)
+        states = np.asarray(states, dtype=np.int8).reshape(-1, 11 * 11)
+        targets = np.asarray(targets, dtype=np.float32).reshape(-1)
+        start = 0
+        while start < len(states):
+            if self.writer is None or self.fill == len(self.writer):
+                self._new_shard()
+            n = min(len(states) - start, len(self.writer) - self.fill)
+            records = self.writer[self.fill:self.fill + n]
+            records["state"] = states[start:start + n]
+            records["side"] = side
+            records["target"] = targets[start:start + n]
+            records["game"] = game
+            self.fill += n
+            start += n
+        return game
+
+    def add_game(self, a_game_states, a_targets, d_game_states=(),
+                 d_targets=()):
+        """Append both sides of one game under a new game id.
+
+        Returns:
+            (int): id of the game
+        """
+        game = self.next_game
+        self.add(a_game_states, ATTACKER, a_targets, game)
+        if len(d_game_states):
+            self.add(d_game_states, DEFENDER, d_targets, game)
+        return game
+
+    def flush(self):
+        """Write the shard being filled out to disk."""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def _window(self):
+        shards = self.shards
+        if self.window is not None:
+            shards = shards[-self.window:]
+            # Let go of shards that have left the window
+            for shard in list(self._maps):
+                if shard < shards[0]:
+                    del self._maps[shard]
+                    self._indices.pop((shard, None), None)
+                    self._indices.pop((shard, ATTACKER), None)
+                    self._indices.pop((shard, DEFENDER), None)
+        return shards
+
+    def _shard_indices(self, shard, side):
+        # Only full shards are cached, as the last one is still growing
+        key = (shard, side)
+        if key in self._indices:
+            return self._indices[key]
+        records = self._records(shard)
+        if side is None:
+            indices = np.arange(len(records))
+        else:
+            indices = np.flatnonzero(records["side"] == side)
+        if shard != self.shards[-1]:
+            self._indices[key] = indices
+        return indices
+
+    def __len__(self):
+        """Number of records in the sampling window."""
+        return sum(len(self._shard_indices(s, None)) for s in self._window())
+
+    def sample(self, batch_size, side=None, rng=np.random):
+        """Draw records at random, with replacement, from the sampling window.
+
+        Args:
+            batch_size (int): number of records to draw
+            side (int): only draw records of this side, or None for both
+            rng (numpy.random.RandomState): source of random numbers
+
+        Returns:
+            (numpy.ndarray): batch_size records of RECORD_DTYPE in random
+                             order, or none if the window holds none
+        """
+        shards = self._window()
+        indices = [self._shard_indices(s, side) for s in shards]
+        sizes = np.array([len(i) for i in indices])
+        total = int(sizes.sum())
+        if not total:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        picks = np.sort(rng.randint(0, total, size=batch_size))
+        # Read each shard's picks in one go, in file order
+        bounds = np.searchsorted(picks, np.cumsum(sizes))
+        batch = []
+        start = 0
+        offset = 0
+        for shard, shard_indices, size, end in zip(shards, indices, sizes,
+                                                   bounds):
+            if end > start:
+                rows = shard_indices[picks[start:end] - offset]
+                batch.append(self._records(shard)[rows])
+            start = end
+            offset += size
+        batch = np.concatenate(batch)
+        rng.shuffle(batch)
+        return batch
+
+    def batches(self, batch_size, num_batches, side=None, rng=np.random):
+        """Yield shuffled minibatches drawn with sample.
+
+        Yields:
+            (numpy.ndarray, numpy.ndarray): (batch_size, 121) states and
+                                            (batch_size,) targets
+        """
+        for _ in range(num_batches):
+            records = self.sample(batch_size, side, rng)
+            yield records["state"], records["target"]
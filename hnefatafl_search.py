@@ -0,0 +1,371 @@
+"""
+Search tools for computer players of Hnefatafl.
+
+Positions are identified by the Zobrist hash kept by
+hnefatafl_engine.GameState, so results found for one move order are reused
+when the same position is reached by another.
+
+"""
+
+import time
+from hnefatafl_engine import (CORNERS, DIM, NUM_SQUARES, coords, popcount,
+                               forced_escape, is_capture, open_escape_routes)
+
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+
+class TranspositionTable(object):
+
+    """Fixed-size table of search results keyed by Zobrist hash.
+
+    Each hash maps to a single slot. A new result replaces the one in its
+    slot if it is for the same position, if it was searched at least as
+    deep, or if the stored result is left over from an earlier search.
+    Plain model evaluations are stored with a depth of 0.
+    """
+
+    def __init__(self, size=1 << 20):
+        """Allocate the table.
+
+        Args:
+            size (int): number of slots, rounded up to a power of two
+        """
+        self.size = 1 << max(size - 1, 0).bit_length()
+        self.mask = self.size - 1
+        self.clear()
+
+    def probe(self, key):
+        """Look up a position.
+
+        Args:
+            key (int): Zobrist hash of the position
+
+        Returns:
+            (int, float, int, (int, int)): depth, score, bound flag and best
+                                           move, or None if not stored
+        """
+        self.probes += 1
+        i = key & self.mask
+        if self.keys[i] != key:
+            return None
+        self.hits += 1
+        self.ages[i] = self.age
+        return self.depths[i], self.scores[i], self.flags[i], self.moves[i]
+
+    def store(self, key, depth, score, flag=EXACT, move=None):
+        """Store the result for a position, subject to the replacement policy.
+
+        Args:
+            key (int): Zobrist hash of the position
+            depth (int): depth the position was searched to
+            score (float): score from the point of view of the side to move
+            flag (int): EXACT, LOWER_BOUND or UPPER_BOUND
+            move ((int, int)): best move found, as (from square, to square)
+        """
+        i = key & self.mask
+        stored = self.keys[i]
+        if (stored is not None and stored != key and
+                depth < self.depths[i] and self.ages[i] == self.age):
+            return
+        if stored == key and move is None:
+            move = self.moves[i]
+        self.keys[i] = key
+        self.depths[i] = depth
+        self.scores[i] = score
+        self.flags[i] = flag
+        self.moves[i] = move
+        self.ages[i] = self.age
+
+    def new_search(self):
+        """Mark everything stored so far as old, so it is replaced first."""
+        self.age += 1
+
+    def clear(self):
+        """Remove every entry and reset the statistics."""
+        self.keys = [None] * self.size
+        self.depths = [0] * self.size
+        self.scores = [0.0] * self.size
+        self.flags = [EXACT] * self.size
+        self.moves = [None] * self.size
+        self.ages = [0] * self.size
+        self.age = 0
+        self.probes = 0
+        self.hits = 0
+
+
+WIN_SCORE = 100000
+# Scores beyond this are wins or losses a known number of plies away.
+WIN_BOUND = WIN_SCORE - 1000
+MAX_PLY = 128
+
+
+def static_evaluate(state):
+    """Score a position by material and the king's distance to a corner.
+
+    Args:
+        state (GameState): position to score
+
+    Returns:
+        (float): score from the attackers' point of view
+    """
+    x, y = coords(state.king_sq)
+    corner_distance = min(x, DIM - 1 - x) + min(y, DIM - 1 - y)
+    return (popcount(state.attackers) - 2 * popcount(state.defenders) +
+            0.5 * corner_distance)
+
+
+class SearchAborted(Exception):
+
+    """Raised inside the search when its time or node budget runs out."""
+
+
+class SearchResult(object):
+
+    """The outcome of a search.
+
+    Attributes:
+        move ((int, int)): best move found, as (from square, to square)
+        score (float): score of the move for the side to move
+        depth (int): deepest iteration that was completed
+        nodes (int): number of positions visited
+        elapsed (float): seconds spent searching
+        pv (list((int, int))): principal variation, starting with move
+    """
+
+    def __init__(self, move, score, depth, nodes, elapsed, pv):
+        self.move = move
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.elapsed = elapsed
+        self.pv = pv
+
+    @property
+    def nps(self):
+        """Nodes searched per second."""
+        return self.nodes / max(self.elapsed, 1e-9)
+
+    def __repr__(self):
+        return ("SearchResult(move={}, score={}, depth={}, nodes={}, "
+                "nps={:.0f})".format(self.move, self.score, self.depth,
+                                     self.nodes, self.nps))
+
+
+class Searcher(object):
+
+    """Negamax alpha-beta search with iterative deepening.
+
+    Moves are tried in the order: best move from the transposition table,
+    moves that capture, or take the king to a corner or to an open line to
+    one, the two killer moves of the ply, and then the rest by their
+    history score. A position where the king escapes whatever the
+    attackers play is scored as a win for the defenders without searching
+    it.
+    """
+
+    def __init__(self, evaluate=static_evaluate, table=None):
+        """Set up a searcher.
+
+        Args:
+            evaluate (function): scores a GameState from the attackers'
+                                 point of view; a model can be plugged in
+                                 with hnefatafl_train.model_evaluator
+            table (TranspositionTable): table to share between searches,
+                                        a new one is made if not given
+        """
+        self.evaluate = evaluate
+        if table is None:
+            table = TranspositionTable()
+        self.table = table
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        self.history = [[0] * NUM_SQUARES for _ in range(NUM_SQUARES)]
+        self.nodes = 0
+
+    def search(self, state, max_depth=MAX_PLY - 1, time_limit=None,
+               node_limit=None, verbose=False):
+        """Find the best move for the side to move.
+
+        Deeper and deeper searches are run until max_depth is reached or the
+        time or node budget runs out. The result of the last search that
+        finished is returned, so the budget may be overrun by a little.
+
+        Args:
+            state (GameState): position to search; it is restored afterwards
+            max_depth (int): deepest search to run, in plies
+            time_limit (float): seconds to search for, or None
+            node_limit (int): positions to visit, or None
+            verbose (bool): print a line after every finished depth
+
+        Returns:
+            (SearchResult): the best move and statistics about the search
+        """
+        self.nodes = 0
+        self.start = time.time()
+        self.deadline = None if time_limit is None else self.start + time_limit
+        self.node_limit = node_limit
+        self.table.new_search()
+        for killers in self.killers:
+            killers[0] = killers[1] = None
+
+        moves = state.legal_moves()
+        if not moves:
+            return SearchResult(None, -WIN_SCORE, 0, 0, 0.0, [])
+        result = SearchResult(moves[0], 0, 0, 0, 0.0, [moves[0]])
+        root_ply = state.ply
+        for depth in range(1, max_depth + 1):
+            try:
+                score, move = self._search_root(state, moves, depth)
+            except SearchAborted:
+                while state.ply > root_ply:
+                    state.unmake_move()
+                break
+            result = SearchResult(move, score, depth, self.nodes,
+                                  time.time() - self.start,
+                                  self._principal_variation(state, depth))
+            if verbose:
+                print("depth {} score {} nodes {} nps {:.0f} pv {}".format(
+                    depth, score, result.nodes, result.nps,
+                    " ".join("{}-{}".format(coords(f), coords(t))
+                             for f, t in result.pv)))
+            # Try the best move first in the next iteration
+            moves.remove(move)
+            moves.insert(0, move)
+            if abs(score) >= WIN_BOUND:
+                break
+        result.nodes = self.nodes
+        result.elapsed = time.time() - self.start
+        return result
+
+    def _check_budget(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchAborted()
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchAborted()
+
+    def _search_root(self, state, moves, depth):
+        alpha = -WIN_SCORE - 1
+        best_move = moves[0]
+        for frm, to in moves:
+            state.make_move(frm, to)
+            score = -self._negamax(state, depth - 1, -WIN_SCORE - 1, -alpha, 1)
+            state.unmake_move()
+            if score > alpha:
+                alpha = score
+                best_move = (frm, to)
+        self.table.store(state.hash, depth, alpha, EXACT, best_move)
+        return alpha, best_move
+
+    def _negamax(self, state, depth, alpha, beta, ply):
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self._check_budget()
+        if state.game_over:
+            # The side that just moved won the game
+            return -WIN_SCORE + ply
+        if forced_escape(state):
+            # The king reaches a corner on the defenders' next move
+            if state.a_turn:
+                return -WIN_SCORE + ply + 2
+            return WIN_SCORE - ply - 1
+        if depth <= 0 or ply >= MAX_PLY - 1:
+            score = self.evaluate(state)
+            return score if state.a_turn else -score
+
+        key = state.hash
+        entry = self.table.probe(key)
+        tt_move = None
+        if entry is not None:
+            entry_depth, score, flag, tt_move = entry
+            if entry_depth >= depth:
+                # Wins are stored relative to the position, not the root
+                if score >= WIN_BOUND:
+                    score -= ply
+                elif score <= -WIN_BOUND:
+                    score += ply
+                if flag == EXACT:
+                    return score
+                if flag == LOWER_BOUND and score >= beta:
+                    return score
+                if flag == UPPER_BOUND and score <= alpha:
+                    return score
+
+        moves = state.legal_moves()
+        if not moves:
+            return -WIN_SCORE + ply
+
+        alpha_orig = alpha
+        best_score = -WIN_SCORE - 1
+        best_move = None
+        killers = self.killers[ply]
+        for frm, to in self._order_moves(state, moves, tt_move, killers):
+            captured = state.make_move(frm, to)
+            score = -self._negamax(state, depth - 1, -beta, -alpha, ply + 1)
+            state.unmake_move()
+            if score > best_score:
+                best_score = score
+                best_move = (frm, to)
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if not captured:
+                            if killers[0] != best_move:
+                                killers[1] = killers[0]
+                                killers[0] = best_move
+                            self.history[frm][to] += depth * depth
+                        break
+
+        if best_score <= alpha_orig:
+            flag = UPPER_BOUND
+        elif best_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        stored = best_score
+        if stored >= WIN_BOUND:
+            stored += ply
+        elif stored <= -WIN_BOUND:
+            stored -= ply
+        self.table.store(key, depth, stored, flag, best_move)
+        return best_score
+
+    def _order_moves(self, state, moves, tt_move, killers):
+        history = self.history
+        king_sq = state.king_sq
+        others = state.attackers | state.defenders
+        first = []
+        rest = []
+        for move in moves:
+            frm, to = move
+            if move == tt_move:
+                first.insert(0, move)
+            elif ((frm == king_sq and (CORNERS >> to & 1 or
+                                       open_escape_routes(to, others))) or
+                    is_capture(state, frm, to)):
+                first.append(move)
+            elif move == killers[0] or move == killers[1]:
+                first.append(move)
+            else:
+                rest.append(move)
+        rest.sort(key=lambda m: history[m[0]][m[1]], reverse=True)
+        return first + rest
+
+    def _principal_variation(self, state, depth):
+        pv = []
+        seen = set()
+        for _ in range(depth):
+            entry = self.table.probe(state.hash)
+            if entry is None or entry[3] is None or state.hash in seen:
+                break
+            seen.add(state.hash)
+            move = entry[3]
+            if move not in state.legal_moves():
+                break
+            pv.append(move)
+            state.make_move(*move)
+            if state.game_over:
+                break
+        for _ in pv:
+            state.unmake_move()
+        return pv
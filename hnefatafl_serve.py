@@ -0,0 +1,351 @@
+"""
+Batching inference server for the Hnefatafl models.
+
+Self-play workers each need to score many positions with the same models.
+Rather than every worker loading its own copy and calling predict on a few
+positions at a time, one InferenceServer holds the models and listens on a
+Unix socket. Requests from all the workers are queued, and a single thread
+takes them off the queue in batches: a batch is run as soon as it holds
+max_batch positions, or once the oldest request in it has waited
+max_latency seconds.
+
+Workers connect with an InferenceClient, and RemoteModel wraps a client in
+the predict method of a Keras model, so it can be passed to do_best_move,
+model_evaluator and the other players in place of a model.
+
+Every message is a header followed by a payload. Requests start with the
+operation, the model and the payload length, packed as REQUEST_HEADER, and
+replies with the payload length, packed as REPLY_HEADER.
+
+    PREDICT      positions as int8, 121 per position; the reply is one
+                 float32 score per position
+    STATS        no payload; the reply is the server's statistics as JSON
+    SET_WEIGHTS  pickled list of weight arrays for the model; empty reply
+
+Usage:
+    python hnefatafl_serve.py /tmp/hnefatafl.sock --attacker attacker.h5
+
+"""
+
+import argparse
+import collections
+import json
+import os
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+PREDICT = 0
+STATS = 1
+SET_WEIGHTS = 2
+
+MODELS = ("attacker", "defender")
+POSITION_SIZE = 11 * 11
+
+REQUEST_HEADER = struct.Struct("!BBI")
+REPLY_HEADER = struct.Struct("!I")
+
+
+class Request(object):
+
+    """Positions waiting to be scored, and the scores once they are."""
+
+    def __init__(self, model, positions):
+        """Queue up positions for a model.
+
+        Args:
+            model (int): index of the model in MODELS
+            positions (numpy.ndarray): (N, 121) positions
+        """
+        self.model = model
+        self.positions = positions
+        self.arrival = time.time()
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+
+    """Unix socket server that scores positions for many clients in batches.
+
+    Attributes:
+        models (dict): model for every name in MODELS that is served
+        max_batch (int): most positions to score in one predict call
+        max_latency (float): longest a request waits for others to join its
+                             batch, in seconds
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, models, max_batch=4096, max_latency=0.002):
+        """Bind the socket and start the batching thread.
+
+        Args:
+            path (str): file name of the Unix socket; an old socket left
+                        there is removed
+            models (dict): model with a Keras style predict method for the
+                           names in MODELS it serves
+            max_batch (int): most positions to score in one predict call
+            max_latency (float): longest a request waits for others to join
+                                 its batch, in seconds
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        self.models = models
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_positions = 0
+        self.num_batches = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=10000)
+        self.batcher = threading.Thread(target=self._run_batches)
+        self.batcher.daemon = True
+        self.batcher.start()
+
+    def score(self, model, positions):
+        """Queue positions to be scored and wait for their scores.
+
+        Args:
+            model (int): index of the model in MODELS
+            positions (numpy.ndarray): (N, 121) positions
+
+        Returns:
+            (numpy.ndarray): (N,) float32 scores
+        """
+        request = Request(model, positions)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def set_weights(self, model, weights):
+        """Replace the weights of a model between two batches."""
+        with self.lock:
+            self.models[MODELS[model]].set_weights(weights)
+
+    def stats(self):
+        """Summarize the requests served so far.
+
+        Returns:
+            (dict): requests, positions and batches served, the number of
+                    requests waiting, a histogram of batch sizes by powers
+                    of two, and the median and 99th percentile time from a
+                    request arriving to its scores being ready, in ms
+        """
+        latencies = sorted(self.latencies)
+        if latencies:
+            p50 = 1000. * latencies[len(latencies) // 2]
+            p99 = 1000. * latencies[min(len(latencies) - 1,
+                                        int(len(latencies) * 0.99))]
+        else:
+            p50 = p99 = None
+        return {"requests": self.num_requests,
+                "positions": self.num_positions,
+                "batches": self.num_batches,
+                "queue_depth": self.requests.qsize(),
+                "batch_sizes": {str(size): self.batch_sizes[size]
+                                for size in sorted(self.batch_sizes)},
+                "latency_p50_ms": p50,
+                "latency_p99_ms": p99}
+
+    def _run_batches(self):
+        while 1:
+            batch = [self.requests.get()]
+            size = len(batch[0].positions)
+            deadline = batch[0].arrival + self.max_latency
+            while size < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.positions)
+            self._score_batch(batch, size)
+
+    def _score_batch(self, batch, size):
+        for model in set(r.model for r in batch):
+            requests = [r for r in batch if r.model == model]
+            positions = np.concatenate([r.positions for r in requests])
+            try:
+                with self.lock:
+                    scores = self.models[MODELS[model]].predict(
+                        positions, batch_size=len(positions), verbose=0)
+                scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+                    r.done.set()
+                continue
+            start = 0
+            for r in requests:
+                r.scores = scores[start:start + len(r.positions)]
+                start += len(r.positions)
+        now = time.time()
+        self.num_requests += len(batch)
+        self.num_positions += size
+        self.num_batches += 1
+        self.batch_sizes[1 << (size.bit_length() - 1)] += 1
+        for r in batch:
+            self.latencies.append(now - r.arrival)
+            r.done.set()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while 1:
+            header = self.rfile.read(REQUEST_HEADER.size)
+            if len(header) < REQUEST_HEADER.size:
+                return
+            op, model, length = REQUEST_HEADER.unpack(header)
+            payload = self.rfile.read(length)
+            if op == PREDICT:
+                positions = np.frombuffer(payload, dtype=np.int8)
+                reply = self.server.score(
+                    model, positions.reshape(-1, POSITION_SIZE)).tobytes()
+            elif op == STATS:
+                reply = json.dumps(self.server.stats()).encode()
+            elif op == SET_WEIGHTS:
+                self.server.set_weights(model, pickle.loads(payload))
+                reply = b""
+            else:
+                return
+            self.wfile.write(REPLY_HEADER.pack(len(reply)) + reply)
+
+
+class InferenceClient(object):
+
+    """Connection to an InferenceServer."""
+
+    def __init__(self, path, timeout=None):
+        """Connect to a server.
+
+        Args:
+            path (str): file name of the server's Unix socket
+            timeout (float): seconds to keep retrying while the server
+                             starts up, or None to try once
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while 1:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if deadline is None or time.time() >= deadline:
+                    raise
+                time.sleep(0.05)
+        self.rfile = self.sock.makefile("rb")
+
+    def _call(self, op, model, payload=b""):
+        self.sock.sendall(REQUEST_HEADER.pack(op, model, len(payload)) +
+                          payload)
+        header = self.rfile.read(REPLY_HEADER.size)
+        if len(header) < REPLY_HEADER.size:
+            raise ConnectionError("inference server closed the connection")
+        return self.rfile.read(REPLY_HEADER.unpack(header)[0])
+
+    def predict(self, model, positions):
+        """Score positions with one of the server's models.
+
+        Args:
+            model (str): name of the model, one of MODELS
+            positions (numpy.ndarray): positions in the encoding of
+                                       game_state_to_array, 121 squares each
+
+        Returns:
+            (numpy.ndarray): (N,) float32 scores
+        """
+        positions = np.asarray(positions, dtype=np.int8)
+        reply = self._call(PREDICT, MODELS.index(model), positions.tobytes())
+        return np.frombuffer(reply, dtype=np.float32)
+
+    def set_weights(self, model, weights):
+        """Replace the weights of one of the server's models."""
+        self._call(SET_WEIGHTS, MODELS.index(model), pickle.dumps(weights))
+
+    def stats(self):
+        """Return the server's statistics, as described in stats."""
+        return json.loads(self._call(STATS, 0).decode())
+
+    def close(self):
+        """Close the connection."""
+        self.rfile.close()
+        self.sock.close()
+
+
+class RemoteModel(object):
+
+    """A model on an InferenceServer, with the predict method of Keras."""
+
+    def __init__(self, client, model):
+        """Wrap one of the server's models.
+
+        Args:
+            client (InferenceClient): connection to the server
+            model (str): name of the model, one of MODELS
+        """
+        self.client = client
+        self.model = model
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Score positions, returning an (N, 1) array like Keras."""
+        return self.client.predict(self.model, x).reshape(-1, 1)
+
+
+def main(argv=None):
+    """Command line entry point that serves models saved by Keras."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("socket", help="file name of the Unix socket")
+    parser.add_argument("--attacker", help="saved attacker model (.h5)")
+    parser.add_argument("--defender", help="saved defender model (.h5)")
+    parser.add_argument("--max-batch", type=int, default=4096)
+    parser.add_argument("--max-latency-ms", type=float, default=2.0)
+    parser.add_argument("--stats-every", type=float, default=0,
+                        help="print statistics every this many seconds")
+    args = parser.parse_args(argv)
+
+    from tensorflow.keras.models import load_model
+    models = {}
+    for name in MODELS:
+        if getattr(args, name):
+            models[name] = load_model(getattr(args, name))
+    server = InferenceServer(args.socket, models, args.max_batch,
+                             args.max_latency_ms / 1000.)
+    if args.stats_every > 0:
+        def report():
+            while 1:
+                time.sleep(args.stats_every)
+                print(json.dumps(server.stats()))
+        reporter = threading.Thread(target=report)
+        reporter.daemon = True
+        reporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
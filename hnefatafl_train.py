@@ -6,262 +6,428 @@ A full description of the game can be found here: http://tinyurl.com/2lpvjb
 Author: Jon Dumm
 Date: 4/4/2019
 
+TensorFlow is only imported once a model is built, loaded or trained, so
+playing and benchmarking start quickly. Run with -h for the subcommands:
+
+    python hnefatafl_train.py play --mode hacd
+    python hnefatafl_train.py selfplay --model attacker.npz --games 100
+    python hnefatafl_train.py train --workers 4
+    python hnefatafl_train.py eval attacker.npz
+    python hnefatafl_train.py eval weights.json
+    python hnefatafl_train.py eval weights.json --mcts 200 --games 20
+    python hnefatafl_train.py bench
+
 """
 
 import sys
-import pygame
-from pygame.locals import *
 import time
 import random
+import queue
+import argparse
+import multiprocessing
 import numpy as np
-from tensorflow.keras import Sequential
-from tensorflow.keras.layers import Dense, Activation, Dropout
-from tensorflow.keras.optimizers import SGD
-from tensorflow.keras.models import load_model
-import hnefatafl as tafl
+import hnefatafl_engine as engine
+import hnefatafl_vec as vec
+from hnefatafl_search import TranspositionTable, Searcher, EXACT
+from hnefatafl_mcts import MCTS
+from hnefatafl_serve import InferenceServer, InferenceClient, RemoteModel
+from hnefatafl_nn import NumpyModel
+from hnefatafl_eval import StaticEvaluator, EvalState
+from hnefatafl_replay import ReplayBuffer, ATTACKER
+from hnefatafl_pipeline import Pipeline
+from hnefatafl_record import RecordWriter, GameRecorder
+from hnefatafl_features import FeatureState, bitboard_to_array
+
+
+def show_game(screen, state, text="", text2=None):
+    """Draw a game on the screen and handle the window's events.
+
+    pygame and the front-end are only imported here, so games without a
+    screen never load them.
+    """
+    import pygame
+    import hnefatafl as tafl
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            sys.exit()
+    tafl.update_image(screen, tafl.Board(), tafl.Move(state), text, text2)
 
 
 def run_game_hahd(screen):
     """ Start a human vs human game
     """
-    run_game(screen)
+    import hnefatafl as tafl
+    tafl.run_game(screen)
+
+def search_player(searcher, time_limit=1.0, position=None):
+    """ Computer player that picks its moves with an alpha-beta search
+
+    Args:
+        searcher (Searcher): search engine, holding the evaluation function
+        time_limit (float): seconds to search for on every move
+        position (function): builds the position to search from the game's
+                             state, such as EvalState.from_state; the game's
+                             own state is searched if None
+    """
+    def player(state):
+        if position is not None:
+            state = position(state)
+        return searcher.search(state, time_limit=time_limit).move
+    return player
+
+def static_search_player(evaluator, time_limit=1.0):
+    """ Computer player that searches with a hnefatafl_eval.StaticEvaluator
+
+    The search runs on an EvalState copy of the game's position, which keeps
+    the counts the evaluation needs up to date as moves are made and taken
+    back instead of counting them again in every position.
+    """
+    return search_player(Searcher(evaluator.evaluate), time_limit, EvalState.from_state)
+
+def model_evaluator(model, table=None):
+    """ Evaluation function for the Searcher that scores positions with a model
+
+    The model scores positions from the attackers' point of view, like the
+    attacker model trained by main. If a TranspositionTable is given, scores
+    are cached in it so repeated positions are not scored again. It should
+    be a table of its own rather than the Searcher's: the search stores
+    bounds from the side to move's point of view, so only the exact depth 0
+    entries the evaluator stored itself are read back as scores, and a
+    search result is never overwritten.
+    """
+    def evaluate(state):
+        entry = None
+        if table is not None:
+            entry = table.probe(state.hash)
+            if entry is not None and entry[0] == 0 and entry[2] == EXACT:
+                return entry[1]
+        score = float(model.predict(game_state_to_array(state).reshape(1,11*11), verbose=0)[0][0])
+        if table is not None and entry is None:
+            table.store(state.hash, 0, score)
+        return score
+    return evaluate
+
+def mcts_player(mcts, simulations=1000, time_limit=None):
+    """ Computer player that picks its moves with Monte Carlo Tree Search
+
+    The same MCTS object is used for every move, so its tree is reused.
+    """
+    def player(state):
+        return mcts.search(state, simulations, time_limit).move
+    return player
+
+def model_value(attacker_model):
+    """ Value function for MCTS that scores positions with the attacker model
+    """
+    def value(state):
+        return float(attacker_model.predict(game_state_to_array(state).reshape(1,11*11), verbose=0)[0][0])
+    return value
+
+def model_prior(attacker_model, defender_model=None, temperature=1.0):
+    """ Prior function for MCTS from the model of the side to move
 
-def run_game_hacd(screen):
+    Like do_best_move, every candidate position is scored by the model of
+    the side to move in one batch; the priors are a softmax of the scores.
+    Without a defender model, the defenders' candidates are scored by the
+    attacker model with the sign flipped.
+    """
+    def prior(state, moves):
+        flip = not state.a_turn and defender_model is None
+        model = attacker_model if state.a_turn or flip else defender_model
+        game_state = game_state_to_array(state).reshape(11*11)
+        candidates = np.repeat(game_state.reshape(1,11*11), len(moves), axis=0)
+        for i, (frm, to) in enumerate(moves):
+            captured = state.make_move(frm, to)
+            state.unmake_move()
+            candidates[i, to] = candidates[i, frm]
+            candidates[i, frm] = 0
+            if captured:
+                candidates[i, list(engine.iter_squares(captured))] = 0
+        scores = model.predict(candidates, batch_size=len(moves), verbose=0)[:,0] / temperature
+        if flip:
+            scores = -scores
+        p = np.exp(scores - scores.max())
+        return p / p.sum()
+    return prior
+
+def computer_player(time_limit=1.0, evaluator=None, simulations=None):
+    """ Computer player for games in the window
+
+    The player runs an alpha-beta search, or Monte Carlo Tree Search with
+    that many simulations per move if simulations is given; either way a
+    move takes at most time_limit seconds. Positions are scored with the
+    evaluate method of a hnefatafl_eval.StaticEvaluator if one is given, and
+    otherwise with the Searcher's own evaluation or, for MCTS, a
+    StaticEvaluator with the default weights.
+    """
+    if simulations is not None:
+        value = None if evaluator is None else evaluator.evaluate
+        return mcts_player(MCTS(value), simulations, time_limit)
+    if evaluator is None:
+        return search_player(Searcher(), time_limit)
+    return static_search_player(evaluator, time_limit)
+
+def run_game_hacd(screen, time_limit=1.0, evaluator=None, simulations=None):
     """ Start a human attacker vs computer defender game
+
+    The computer player is built by computer_player.
     """
-    #run_game(screen)
-    pass
+    import hnefatafl as tafl
+    return tafl.run_game(screen, defender=computer_player(time_limit, evaluator, simulations))
 
-def run_game_cahd(screen):
+def run_game_cahd(screen, time_limit=1.0, evaluator=None, simulations=None):
     """ Start a computer attacker vs human defender game
+
+    The computer player is built by computer_player.
     """
-    #run_game(screen)
-    pass
+    import hnefatafl as tafl
+    return tafl.run_game(screen, attacker=computer_player(time_limit, evaluator, simulations))
 
-def run_game_random(screen=None):
+def run_game_random(screen=None,render_every=1,writer=None,rules=None):
 
     """Start a new game with random (legal) moves.
 
     TODO: Add description
 
+    If a screen is given, the board is drawn after every render_every moves,
+    so a game can be fast forwarded by only showing some of its moves.
+    If a hnefatafl_record.RecordWriter is given, the game is written to it.
+    The game ends as soon as an engine.Referee finds it decided under rules,
+    by default engine.Rules().
+
     """
-    board = tafl.Board()
-    move = tafl.Move()
-    talf.initialize_pieces(board)
+    state = engine.GameState()
+    referee = engine.Referee(state, rules)
+    recorder = None if writer is None else GameRecorder(writer, state, "random", "random")
     num_moves = 0
     while 1:
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                sys.exit()
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-               pass
-        
-        '''
-        if move.a_turn:
-            text = "Attacker's Turn: Move {}".format(num_moves)
-            print(text)
-        if not move.a_turn:
-            text = "Defender's Turn: Move {}".format(num_moves)
-            print(text)
-        '''
-        #print(move.to_array())
-        do_random_move(move)
+        #print(game_state_to_array(state))
+        do_random_move(state)
+        if recorder is not None:
+            recorder.update(state)
         num_moves += 1
-        if(num_moves >= 1000):
-            print("Draw game after {} moves".format(num_moves))
-            return False
 
         """Text to display on bottom of game."""
+        text = ""
         text2 = None
-        if move.escaped:
-            text = "King escaped! Defenders win!"
-            print(text)
-            text2 = "Play again? y/n"
-            return False
-        if move.king_killed:
-            text = "King killed! Attackers win!"
+        result = referee.update(state)
+        if result is not None:
+            text = referee.reason
             print(text)
             text2 = "Play again? y/n"
+            if recorder is not None:
+                recorder.finish(result)
             return False
-        if move.restart:
-            text = "Restart game? y/n"
-            print(text)
-            return False
-        if screen is not None:
-            talf.update_image(screen, board, move, text)
-            pygame.display.update()
+        if screen is not None and num_moves % render_every == 0:
+            show_game(screen, state, text, text2)
         #time.sleep(1)
 
-def do_random_move(move):
-    if move.a_turn:
-        pieces = tafl.Attackers
-    else:
-        pieces = tafl.Defenders
-    while 1:
-        #rn = int(random.random() * len(pieces.sprites()))
-        #piece = pieces.sprites()[rn]
-        piece = random.choice(pieces.sprites())
-        move.select(piece)
-        tafl.Current.add(piece)
-        #print("Piece at: {} {}".format(piece.x_tile,piece.y_tile))
-        #print("  Valid Moves: {}".format(move.vm))
-        if len(move.vm)==0:
-            #print("No valid moves...")
-            move.select(piece)
-            tafl.Current.empty()
-            continue
-        else:
-            pos = random.choice(tuple(move.vm))
-            #print("Moving piece to: {}".format(pos))
-            if move.is_valid_move(pos, tafl.Current.sprites()[0], True):
-                if tafl.Current.sprites()[0] in tafl.Kings:
-                    move.king_escaped(tafl.Kings)
-                if move.a_turn:
-                    move.remove_pieces(tafl.Defenders, tafl.Attackers, tafl.Kings)
-                else:
-                    move.remove_pieces(tafl.Attackers, tafl.Defenders, tafl.Kings)
-                move.end_turn(tafl.Current.sprites()[0])
-                tafl.Current.empty()
-            break
+def do_random_move(state):
+    """ Play a move picked uniformly at random from all legal moves
+    """
+    move = engine.random_move(state)
+    if move is None: # No valid moves for this side
+        return
+    #print("Moving piece from {} to {}".format(*move))
+    state.move(*move)
 
-def run_game_cacd_RL(attacker_model,defender_model,screen=None):
+def run_game_cacd_RL(attacker_model,defender_model,screen=None,attacker_table=None,render_every=1,writer=None,rules=None):
     """Start and run one game of computer vs computer hnefatafl.
 
     TODO: Add description
 
+    attacker_table is an optional TranspositionTable caching the attacker
+    model's scores; it must be cleared whenever the model's weights change.
+    If a screen is given, the board is drawn after every render_every moves.
+    If a hnefatafl_record.RecordWriter is given, the game is written to it.
+    The game ends as soon as an engine.Referee finds it decided under rules,
+    by default engine.Rules(), so drawn out endgames are not played to the
+    move limit. The game is played on a hnefatafl_features.FeatureState, so
+    the positions kept for training are copied from its board rather than
+    unpacked from the bitboards after every move.
+
     """
-    board = tafl.Board()
-    move = tafl.Move()
-    tafl.initialize_pieces(board)
+    state = FeatureState()
+    referee = engine.Referee(state, rules)
+    recorder = None if writer is None else GameRecorder(writer, state, "attacker model", "random")
     a_game_states = []
     a_predicted_scores = []
     d_game_states = []
     d_predicted_scores = []
     num_moves = 0
     while 1:
-        if screen is not None:
-            for event in pygame.event.get():
-                if event.type == QUIT:
-                    sys.exit()
-                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                    pass
-
-
         num_moves += 1
-        if(num_moves >= 1000):
-            print("Draw game after {} moves".format(num_moves))
-            a_predicted_scores.append(0.0)
-            d_predicted_scores.append(0.0)
-            return a_game_states,a_predicted_scores[1:], d_game_states,d_predicted_scores[1:] # i.e. the corrected scores from RL
 
-        if move.a_turn:
+        if state.a_turn:
             #print("Attacker's Turn: Move {}".format(num_moves))
-            game_state,predicted_score = do_best_move(move,attacker_model)
+            game_state,predicted_score = do_best_move(state,attacker_model,attacker_table)
             a_game_states.append(game_state)
             a_predicted_scores.append(predicted_score)
         else:
             #print("Defender's Turn: Move {}".format(num_moves))
-            #game_state,predicted_score = do_best_move(move,defender_model)
-            game_state = do_random_move(move)
+            #game_state,predicted_score = do_best_move(state,defender_model)
+            do_random_move(state)
+            game_state = game_state_to_array(state)
             predicted_score = (random.random()-0.5) * 2
             d_game_states.append(game_state)
             d_predicted_scores.append(predicted_score)
+        if recorder is not None:
+            recorder.update(state)
 
         """Text to display on bottom of game."""
-        if move.escaped:
-            print("King escaped! Defenders win!")
-            attacker_outcome = -1.0
+        result = referee.update(state)
+        if result is not None:
+            print(referee.reason)
             #print(a_predicted_scores[-1])
-            a_predicted_scores.append(-1.0)
-            d_predicted_scores.append(+1.0)
+            a_predicted_scores.append(result)
+            d_predicted_scores.append(-result)
+            if recorder is not None:
+                recorder.finish(result)
             return a_game_states,a_predicted_scores[1:], d_game_states,d_predicted_scores[1:] # i.e. the corrected scores from RL
-        if move.king_killed:
-            print("King killed! Attackers win!")
-            #print(a_predicted_scores[-1])
-            a_predicted_scores.append(+1.0)
-            d_predicted_scores.append(-1.0)
-            return a_game_states,a_predicted_scores[1:], d_game_states,d_predicted_scores[1:] # i.e. the corrected scores from RL
-        if screen is not None:
-            tafl.update_image(screen, board, move, "", "")
-            pygame.display.update()
+        if screen is not None and num_moves % render_every == 0:
+            show_game(screen, state)
+
 
 
+def run_games_cacd_RL_vec(attacker_model,batch_size=256,limit=1000,num_games=None,writer=None,rules=None):
+    """Play many computer vs computer games at once on a hnefatafl_vec.VecGame.
+
+    The players are the same as in run_game_cacd_RL: the attacker plays the
+    move its model scores best and the defender plays random moves. All the
+    games in the batch are stepped together, so the candidate positions of
+    every game with the attacker to move are scored in one model call.
+
+    This is a generator which yields the output of run_game_cacd_RL for each
+    game as it finishes, and starts a new game in its place. The model is
+    called again on every step, so it can be trained between games. If
+    num_games is given, exactly that many games are started, so results
+    are not skewed towards the games that finish first. If a
+    hnefatafl_record.RecordWriter is given, every finished game is written to it.
+    Games end as in VecGame.step, which decides them like an engine.Referee
+    under rules, by default engine.Rules(), except that they are always
+    called a draw after limit moves and a side with no moves always loses.
+    """
+    rules = engine.Rules() if rules is None else rules
+    env = vec.VecGame(batch_size, limit=limit, repetition=rules.repetition,
+                      repetition_result=rules.repetition_result,
+                      encirclement=rules.encirclement,
+                      edge_fort=rules.edge_fort,
+                      forced_escape=rules.forced_escape)
+    trajectories = [([],[],[],[]) for _ in range(batch_size)]
+    moves = [[] for _ in range(batch_size)]
+    active = np.ones(batch_size, dtype=bool)
+    started = batch_size
+    if num_games is not None:
+        active[num_games:] = False
+        started = min(batch_size, num_games)
+    finished = 0
+    while num_games is None or finished < num_games:
+        actions = env.random_actions()
+        attackers = np.flatnonzero(env.a_turn & active)
+        defenders = np.flatnonzero(~env.a_turn & active)
+        if len(attackers):
+            games,candidate_actions,candidates = env.successors(attackers)
+            scores = attacker_model.predict(candidates, batch_size=len(candidates), verbose=0)[:,0]
+            best = env.best_successors(games, scores)
+            actions[attackers] = candidate_actions[best]
+            for i,j in zip(attackers,best):
+                trajectories[i][0].append(candidates[j].reshape(11,11).copy())
+                trajectories[i][1].append(scores[j])
+        if len(defenders):
+            boards = env.boards[defenders]
+            vec.apply_moves(boards, actions[defenders])
+            for i,board in zip(defenders,boards):
+                trajectories[i][2].append(board.reshape(11,11).copy())
+                trajectories[i][3].append((random.random()-0.5) * 2)
+
+        if writer is not None:
+            for i in np.flatnonzero(active):
+                moves[i].append(vec.action_to_move(actions[i]))
+
+        done,results,lengths = env.step(actions)
+        for i in np.flatnonzero(done & active):
+            a_game_states,a_predicted_scores, d_game_states,d_predicted_scores = trajectories[i]
+            a_predicted_scores.append(results[i])
+            d_predicted_scores.append(-results[i])
+            trajectories[i] = ([],[],[],[])
+            if writer is not None:
+                writer.write_game(moves[i], results[i], "attacker model", "random")
+                moves[i] = []
+            finished += 1
+            if num_games is not None:
+                if started < num_games:
+                    started += 1
+                else:
+                    active[i] = False
+            yield a_game_states,a_predicted_scores[1:], d_game_states,d_predicted_scores[1:] # i.e. the corrected scores from RL
+
 
-def do_best_move(move,model):
+def do_best_move(state,model,table=None):
     """ Function to try all possible moves and select the best according to the model provided
+
+    Every candidate move is played and taken back on the game state, so the
+    candidate positions include any pieces the move captures. They are
+    built into one (N, 121) batch, which the model scores in a single
+    forward pass. On a hnefatafl_features.FeatureState the candidates are
+    copied from its board as each move is played instead of being patched
+    onto the current position. If a TranspositionTable is given, candidates already
+    scored by this model are looked up in it instead of being scored again.
     """
 
-    game_state = game_state_to_array() # Preserves the current game state
+    moves = state.legal_moves()
+    if not moves:
+        print("ERROR: No valid moves to choose from... Fix!")
+        sys.exit(1)
 
-    if move.a_turn:
-        pieces = tafl.Attackers
+    keys = []
+    if isinstance(state, FeatureState):
+        # The board follows every move, so each candidate is just a copy of it
+        candidates = np.empty((len(moves), 11*11), dtype=int)
+        for i, (frm, to) in enumerate(moves):
+            state.make_move(frm, to)
+            keys.append(state.hash)
+            candidates[i] = state.board
+            state.unmake_move()
     else:
-        pieces = tafl.Defenders
-
-    best_score = -1.0
-    best_piece = None
-    best_move = None
-    best_game_state = None
-    #len("N Pieces: ",len(pieces))
-    for piece in pieces:
-        move.select(piece) # Move class defines all possible valid moves
-        tafl.Current.add(piece)
-        if len(move.vm)==0: # No valid moves for this piece, move on
-            move.select(piece)
-            tafl.Current.empty()
-            continue
-        else:
-            for m in move.vm:
-                # Swap game state for candidate move
-                temp = game_state[piece.x_tile][piece.y_tile]
-                game_state[piece.x_tile][piece.y_tile] = 0
-                game_state[m[0]][m[1]] = temp
-
-                try: # model.predict crashed once... 
-                    score = model.predict(game_state.reshape(1,11*11))[0][0]
-                except:
-                    score = -1.0
-                    #score = random.random()
-
-                if score > best_score:
-                    best_score = score
-                    best_piece = piece
-                    best_move  = m
-
-                # Reverse swap to restore game state
-                temp = game_state[m[0]][m[1]]
-                game_state[piece.x_tile][piece.y_tile] = temp
-                game_state[m[0]][m[1]] = 0
-        move.select(piece) # Deselect
-        tafl.Current.empty()
-
-    move.select(best_piece)
-    tafl.Current.add(best_piece)
-    #print("Moving piece to: {}".format(pos))
-    if move.is_valid_move(best_move,tafl.Current.sprites()[0], True):
-        if tafl.Current.sprites()[0] in tafl.Kings:
-            move.king_escaped(tafl.Kings)
-        if move.a_turn:
-            move.remove_pieces(tafl.Defenders, tafl.Attackers, tafl.Kings)
-        else:
-            move.remove_pieces(tafl.Attackers, tafl.Defenders, tafl.Kings)
-        move.end_turn(tafl.Current.sprites()[0])
-        tafl.Current.empty()
-        #return best_score,game_state_to_array()
-        # Just do this by hand for efficiency
-        temp = game_state[best_piece.x_tile][best_piece.y_tile]
-        game_state[best_piece.x_tile][best_piece.y_tile] = 0
-        game_state[best_move[0]][best_move[1]] = temp
-
-        #print(game_state,best_score)
-        return game_state,best_score
+        game_state = game_state_to_array(state).reshape(11*11) # Preserves the current game state
+        candidates = np.repeat(game_state.reshape(1,11*11), len(moves), axis=0)
+        for i, (frm, to) in enumerate(moves):
+            captured = state.make_move(frm, to)
+            keys.append(state.hash)
+            state.unmake_move()
+            candidates[i, to] = candidates[i, frm]
+            candidates[i, frm] = 0
+            if captured:
+                candidates[i, list(engine.iter_squares(captured))] = 0
+
+    if table is None:
+        scores = model.predict(candidates, batch_size=len(moves), verbose=0)[:,0]
     else:
-        print("ERROR: Efficient move logic failed... Fix!")
-        sys.exit(1)
+        scores = np.empty(len(moves))
+        missing = []
+        for i, key in enumerate(keys):
+            entry = table.probe(key)
+            if entry is None:
+                missing.append(i)
+            else:
+                scores[i] = entry[1]
+        if missing:
+            scores[missing] = model.predict(candidates[missing], batch_size=len(missing), verbose=0)[:,0]
+            for i in missing:
+                table.store(keys[i], 0, float(scores[i]))
+    best = int(np.argmax(scores))
+
+    state.move(*moves[best])
+    #print(candidates[best],scores[best])
+    return candidates[best].reshape(11,11).copy(),scores[best]
 
 
 def initialize_random_nn_model():
 
+        from tensorflow.keras import Sequential
+        from tensorflow.keras.layers import Dense, Dropout
+        from tensorflow.keras.optimizers import SGD
+
         print("Initializing randomized NN model")
         model = Sequential()
         model.add(Dense(2*11*11, input_dim=11*11,kernel_initializer='normal', activation='relu'))
@@ -281,22 +447,17 @@ def initialize_random_nn_model():
         model.summary()
         return model
 
-def game_state_to_array():
+def game_state_to_array(state):
     """2D Numpy array representation of game state for ML model.
-    """
-    if tafl.Attackers is None or tafl.Defenders is None or tafl.Kings is None:
-        print("Game not properly initialized.  Exiting.")
-        sys.exit(1)
-    arr = np.zeros((11,11),dtype=int)
 
-    for p in tafl.Attackers:
-        arr[p.x_tile][p.y_tile] = '1'
-    for p in tafl.Defenders:
-        arr[p.x_tile][p.y_tile] = '2'
-    for p in tafl.Kings:
-        arr[p.x_tile][p.y_tile] = '3'
-
-    return arr
+    A FeatureState already holds this array, kept up to date as it is
+    played, so it is just copied; otherwise it is unpacked from the bitboards.
+    """
+    if isinstance(state, FeatureState):
+        return state.board.reshape(11,11).astype(int)
+    arr = (bitboard_to_array(state.attackers).astype(int) + 2*bitboard_to_array(state.defenders)
+           + 3*bitboard_to_array(state.king))
+    return arr.reshape(11,11)
 
 def unison_shuffled_copies(a, b):
     assert len(a) == len(b)
@@ -311,39 +472,478 @@ def smooth_corrected_scores(corrected_scores,num_to_smooth=10):
     for i in range(num_to_smooth-1):
         corrected_scores[-1*(i+2)] = (corrected_scores[-1*(i+2)] + corrected_scores[-1*(i+1)]) / 2. # Average
 
-def main():
-    """Main function- initializes screen and starts new games."""
-    interactive = True 
+def train_on_game(attacker_model, a_game_states, a_corrected_scores):
+    """ Fit the attacker model to the corrected scores from one game
+    """
+    #a_game_states,a_corrected_scores = unison_shuffled_copies(a_game_states,a_corrected_scores)
+    smooth_corrected_scores(a_corrected_scores)
+    attacker_model.fit(np.array(a_game_states).reshape(-1,11*11),np.array(a_corrected_scores),epochs=1,batch_size=1,verbose=0)
+
+def learn_from_game(attacker_model, game, replay=None, batch_size=256):
+    """ Train the attacker model on a finished game
+
+    Without a replay buffer the model is fit to the game itself, as in
+    train_on_game. With one, both sides of the game are added to the buffer
+    and the model is fit to a minibatch of attacker positions drawn from the
+    recent games in it instead.
+
+    Args:
+        game (tuple): output of run_game_cacd_RL
+        replay (ReplayBuffer): buffer to add the game to, or None
+        batch_size (int): number of positions to fit on after every game
+    """
+    a_game_states,a_corrected_scores, d_game_states,d_corrected_scores = game
+    if replay is None:
+        train_on_game(attacker_model, a_game_states, a_corrected_scores)
+        return
+    smooth_corrected_scores(a_corrected_scores)
+    smooth_corrected_scores(d_corrected_scores)
+    replay.add_game(a_game_states, a_corrected_scores, d_game_states, d_corrected_scores)
+    for states, targets in replay.batches(batch_size, 1, side=ATTACKER):
+        attacker_model.fit(states, targets, epochs=1, batch_size=batch_size, verbose=0)
+
+def model_snapshot(model):
+    """ Architecture and weights of a model, in a form that can be sent to another process
+    """
+    return model.to_json(), model.get_weights()
+
+def inference_server(path, snapshots, max_batch=4096, max_latency=0.002):
+    """ Serve the models to the self-play workers from one process
+
+    Args:
+        path (str): file name of the Unix socket to listen on
+        snapshots (tuple): attacker and defender snapshots from model_snapshot
+    """
+    models = {"attacker": NumpyModel.from_json(*snapshots[0]),
+              "defender": NumpyModel.from_json(*snapshots[1])}
+    InferenceServer(path, models, max_batch, max_latency).serve_forever()
+
+def selfplay_worker(weights_queue, results_queue, seed, server_path=None):
+    """ Play games until told to stop, sending each finished game back to the trainer
+
+    The worker waits for its first model snapshots on weights_queue, then
+    before every game it switches to the newest snapshots the trainer has
+    pushed since. A None on weights_queue stops the worker.
+
+    If server_path is given, the worker builds no models of its own and
+    scores positions on the inference server listening there instead, which
+    the trainer keeps up to date.
+
+    Args:
+        weights_queue (Queue): (attacker snapshot, defender snapshot) tuples from the trainer
+        results_queue (Queue): receives the output of run_game_cacd_RL for every game
+        seed (int): seed for this worker's random move choices
+        server_path (str): Unix socket of an inference_server, or None
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    attacker_model = None
+    defender_model = None
+    attacker_table = TranspositionTable(1 << 16)
+    if server_path is not None:
+        client = InferenceClient(server_path, timeout=60)
+        attacker_model = RemoteModel(client, "attacker")
+        defender_model = RemoteModel(client, "defender")
+        # The server's weights change without the worker knowing
+        attacker_table = None
+    while 1:
+        # Block for the first snapshot, then only take newer ones
+        pending = [weights_queue.get()] if attacker_model is None else []
+        try:
+            while 1:
+                pending.append(weights_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if pending:
+            snapshots = pending[-1]
+            if snapshots is None:
+                return
+            if attacker_model is None:
+                # Playing only needs the forward pass, which NumPy does faster
+                attacker_model = NumpyModel.from_json(*snapshots[0])
+                defender_model = NumpyModel.from_json(*snapshots[1])
+            attacker_model.set_weights(snapshots[0][1])
+            defender_model.set_weights(snapshots[1][1])
+            attacker_table.clear()
+        results_queue.put(run_game_cacd_RL(attacker_model,defender_model,None,attacker_table))
+
+def run_parallel_selfplay(attacker_model, defender_model, num_workers, first_game, last_game, sync_every=10, server_path=None, replay=None):
+    """ Train on games played by a pool of self-play worker processes
+
+    Every worker plays games against its own copy of the current models and
+    streams the finished trajectories back. This process fits the attacker
+    model on each game as it arrives and pushes the updated weights to the
+    workers every sync_every games.
+
+    If server_path is given, the models are loaded once into an
+    inference_server process listening on that Unix socket instead. The
+    workers send it their positions, which it scores in batches, and the
+    updated weights are pushed to the server.
+
+    Args:
+        attacker_model (Model): attacker model to play with and train
+        defender_model (Model): defender model to play with
+        num_workers (int): number of worker processes to start
+        first_game (int): number of games the models were already trained on
+        last_game (int): stop once the models have been trained on this many games
+        sync_every (int): number of games between weight updates to the workers
+        server_path (str): Unix socket for an inference server, or None to
+                           give every worker its own models
+        replay (ReplayBuffer): buffer to train from, as in learn_from_game
+    """
+    # Keras does not survive a fork, so workers start in a fresh interpreter
+    ctx = multiprocessing.get_context('spawn')
+    results_queue = ctx.Queue(maxsize=2*num_workers)
+    weights_queues = [ctx.Queue() for _ in range(num_workers)]
+    workers = [ctx.Process(target=selfplay_worker, args=(weights_queues[i], results_queue, random.randrange(2**31), server_path), daemon=True)
+               for i in range(num_workers)]
+    server = None
+    if server_path is not None:
+        snapshots = (model_snapshot(attacker_model), model_snapshot(defender_model))
+        server = ctx.Process(target=inference_server, args=(server_path, snapshots), daemon=True)
+        server.start()
+        client = InferenceClient(server_path, timeout=60)
+    for w in workers:
+        w.start()
+
+    def push_weights():
+        if server is not None:
+            client.set_weights("attacker", attacker_model.get_weights())
+            client.set_weights("defender", defender_model.get_weights())
+            print("Inference server: {}".format(client.stats()))
+            return
+        snapshots = (model_snapshot(attacker_model), model_snapshot(defender_model))
+        for q in weights_queues:
+            q.put(snapshots)
+
+    push_weights()
+    start = time.time()
+    num_train_games = first_game
+    try:
+        while num_train_games < last_game:
+            num_train_games += 1
+            game = results_queue.get()
+            print("Game finished in {} moves ({:.1f} games/hour)".format(len(game[1])+len(game[3]),
+                  3600. * (num_train_games - first_game) / (time.time() - start)))
+            learn_from_game(attacker_model, game, replay)
+            if(num_train_games%sync_every==0):
+                push_weights()
+            if(num_train_games%10==0):
+                attacker_model.save('attacker_model_after_{}_games.h5'.format(num_train_games))
+    finally:
+        for q in weights_queues:
+            q.put(None)
+        # Unblock workers waiting to deliver a game so they can see the stop
+        while any(w.is_alive() for w in workers):
+            try:
+                results_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for w in workers:
+            w.join()
+        if server is not None:
+            client.close()
+            server.terminate()
+
+def run_pipelined_training(attacker_model, first_game, last_game, replay, batch_size=256, selfplay_batch=256,
+                           batches_per_game=1, sync_every=10, checkpoint_every=100, report_every=30.0):
+    """ Train with self-play, data loading, fitting and checkpointing running at the same time
+
+    The four stages run in their own threads, connected by bounded queues:
+
+        selfplay    plays games with run_games_cacd_RL_vec, on a NumPy copy of the attacker model
+        load        adds every game to the replay buffer and draws batches_per_game shuffled minibatches
+        fit         fits the attacker model on each minibatch, and every sync_every minibatches
+                    copies the new weights to the self-play model
+        checkpoint  saves a copy of the weights every checkpoint_every games, without holding up fit
+
+    A full queue holds up the stage filling it, so the pipeline runs at the
+    pace of its slowest stage; the statistics printed every report_every
+    seconds show which one that is. Self-play stops after the games up to
+    last_game, and once they are loaded the minibatches already drawn are
+    fitted and the final model is saved.
+
+    Args:
+        attacker_model (Model): Keras attacker model to play with and train
+        first_game (int): number of games the model was already trained on
+        last_game (int): stop once the model has been trained on this many games
+        replay (ReplayBuffer): buffer to keep the games in and draw minibatches from
+    """
+    player = NumpyModel.from_json(*model_snapshot(attacker_model))
+    games = queue.Queue(maxsize=4)
+    batches = queue.Queue(maxsize=16)
+    checkpoints = queue.Queue(maxsize=2)
+    pipeline = Pipeline()
+    selfplay_games = run_games_cacd_RL_vec(player,selfplay_batch,num_games=max(last_game - first_game, 0))
+    counts = {"games": first_game, "batches": 0}
+    saver = []
+
+    def play():
+        game = next(selfplay_games, None)
+        if game is None:
+            # Every game up to last_game has been played
+            pipeline.stop()
+            return []
+        return [game]
+
+    def load(game):
+        a_game_states,a_corrected_scores, d_game_states,d_corrected_scores = game
+        smooth_corrected_scores(a_corrected_scores)
+        smooth_corrected_scores(d_corrected_scores)
+        replay.add_game(a_game_states, a_corrected_scores, d_game_states, d_corrected_scores)
+        counts["games"] += 1
+        if counts["games"] >= last_game:
+            pipeline.stop()
+        minibatches = list(replay.batches(batch_size, batches_per_game, side=ATTACKER))
+        if counts["games"] % checkpoint_every == 0:
+            minibatches.append(counts["games"]) # Checkpoint once the batches before it are fitted
+        return minibatches
+
+    def fit(batch):
+        if not isinstance(batch, tuple):
+            return [(attacker_model.get_weights(), 'attacker_model_after_{}_games.h5'.format(batch))]
+        states, targets = batch
+        attacker_model.fit(states, targets, epochs=1, batch_size=batch_size, verbose=0)
+        counts["batches"] += 1
+        if counts["batches"] % sync_every == 0:
+            player.set_weights(attacker_model.get_weights())
+        return []
+
+    def checkpoint(item):
+        weights, path = item
+        if not saver:
+            from tensorflow.keras.models import clone_model
+            saver.append(clone_model(attacker_model))
+        saver[0].set_weights(weights)
+        saver[0].save(path)
+        return []
+
+    pipeline.add_stage("selfplay", play, output=games)
+    pipeline.add_stage("load", load, input=games, output=batches)
+    pipeline.add_stage("fit", fit, input=batches, output=checkpoints)
+    pipeline.add_stage("checkpoint", checkpoint, input=checkpoints)
+    pipeline.run(report_every)
+    print(pipeline.report())
+    attacker_model.save('attacker_model_after_{}_games.h5'.format(counts["games"]))
+
+def load_attacker_model(path):
+    """ Load a model saved by Keras (.h5), exported by hnefatafl_nn (.npz), or
+    the weights of a hnefatafl_eval.StaticEvaluator (.json)
+
+    .npz and .json models only need NumPy, so they can play but not be trained.
+    """
+    if path.endswith('.npz'):
+        return NumpyModel.load(path)
+    if path.endswith('.json'):
+        return StaticEvaluator.load(path)
+    from tensorflow.keras.models import load_model
+    return load_model(path)
+
+def main(num_workers=0,batch_size=0,server_path=None,model_path='attacker_model_after_340_games.h5',num_train_games=340,replay_dir=None,replay_window=None,pipelined=False):
+    """Main function- initializes screen and starts new games.
+
+    Args:
+        num_workers (int): number of self-play worker processes; 0 plays every
+                           game in this process
+        batch_size (int): number of games to play at once with
+                          run_games_cacd_RL_vec; 0 plays one game at a time
+        server_path (str): Unix socket for the workers' shared inference
+                           server, or None to give every worker its own models
+        model_path (str): saved attacker model to start from, or None for a new one
+        num_train_games (int): number of games the saved model was trained on
+        replay_dir (str): directory of a ReplayBuffer to keep the games in and
+                          train from, or None to train on each game once
+        replay_window (int): number of recent replay shards to train from
+        pipelined (bool): train with run_pipelined_training; needs replay_dir
+    """
+    interactive = num_workers == 0 and batch_size == 0 and not pipelined
     if interactive:
+        import pygame
+        import hnefatafl as tafl
         pygame.init()
         screen = pygame.display.set_mode(tafl.WINDOW_SIZE)
     else:
         screen = None
-    tafl.initialize_groups()
 
-    #attacker_model = initialize_random_nn_model()
-    attacker_model = load_model('attacker_model_after_340_games.h5')
+    if model_path is None:
+        attacker_model = initialize_random_nn_model()
+    else:
+        attacker_model = load_attacker_model(model_path)
     defender_model = initialize_random_nn_model()
 
+    attacker_table = TranspositionTable(1 << 16)
+    replay = None if replay_dir is None else ReplayBuffer(replay_dir, window=replay_window)
+
     #train = True
-    num_train_games = 340
+    if pipelined:
+        run_pipelined_training(attacker_model,num_train_games,10000,replay,selfplay_batch=batch_size or 256)
+        return
+    if num_workers > 0:
+        run_parallel_selfplay(attacker_model,defender_model,num_workers,num_train_games,10000,server_path=server_path,replay=replay)
+        return
+    if batch_size > 0:
+        for game in run_games_cacd_RL_vec(attacker_model,batch_size):
+            num_train_games += 1
+            print("Game finished in {} moves".format(len(game[1])+len(game[3])))
+            learn_from_game(attacker_model, game, replay)
+            if(num_train_games%10==0):
+                attacker_model.save('attacker_model_after_{}_games.h5'.format(num_train_games))
+            if num_train_games >= 10000:
+                return
     #while train:
     while num_train_games < 10000:
         num_train_games += 1
         #play = tafl.run_game(screen)
         #play = run_game_cacd(screen)
         #a_game_states,a_corrected_scores, d_game_states,d_corrected_scores = run_game_cacd_RL(attacker_model,defender_model)
-        a_game_states,a_corrected_scores, d_game_states,d_corrected_scores = run_game_cacd_RL(attacker_model,defender_model,screen)
+        game = run_game_cacd_RL(attacker_model,defender_model,screen,attacker_table)
         #play = run_game_cacd_RL(attacker_model,defender_model,screen)
-        print("Game finished in {} moves".format(len(a_corrected_scores)+len(d_corrected_scores)))
-        #a_game_states,a_corrected_scores = unison_shuffled_copies(a_game_states,a_corrected_scores)
-        smooth_corrected_scores(a_corrected_scores)
-        attacker_model.fit(np.array(a_game_states).reshape(-1,11*11),np.array(a_corrected_scores),epochs=1,batch_size=1,verbose=0)
+        print("Game finished in {} moves".format(len(game[1])+len(game[3])))
+        learn_from_game(attacker_model, game, replay)
+        attacker_table.clear()
         if(num_train_games%10==0):
             attacker_model.save('attacker_model_after_{}_games.h5'.format(num_train_games))
 
         #time.sleep(5)
-        tafl.cleanup()
+
+def selfplay(attacker_model, num_games, batch_size=256, writer=None):
+    """ Play games of the attacker model against random moves, without training
+
+    If a hnefatafl_record.RecordWriter is given, the games are written to it.
+
+    Returns:
+        (dict): games, attacker wins, defender wins, draws, moves and games per second
+    """
+    counts = {1.0: 0, -1.0: 0, 0.0: 0}
+    moves = 0
+    start = time.time()
+    for a_game_states,a_corrected_scores, d_game_states,d_corrected_scores in run_games_cacd_RL_vec(attacker_model,min(batch_size,num_games),num_games=num_games,writer=writer):
+        counts[float(a_corrected_scores[-1])] += 1
+        moves += len(a_game_states) + len(d_game_states)
+    elapsed = time.time() - start
+    return {"games": num_games, "attacker_wins": counts[1.0], "defender_wins": counts[-1.0],
+            "draws": counts[0.0], "moves": moves, "games_per_sec": num_games / elapsed}
+
+def mcts_selfplay(attacker_model, num_games, simulations=100, rules=None):
+    """ Play games of an MCTS attacker guided by a model against random moves
+
+    The tree search scores its leaves with model_value and orders its moves
+    with model_prior, both from the attacker model, and runs the given number
+    of simulations per attacker move. Games end as decided by an
+    engine.Referee under rules.
+
+    Returns:
+        (dict): games, attacker wins, defender wins, draws, moves and games per second
+    """
+    counts = {1.0: 0, -1.0: 0, 0.0: 0}
+    moves = 0
+    start = time.time()
+    for _ in range(num_games):
+        player = mcts_player(MCTS(model_value(attacker_model), model_prior(attacker_model)), simulations)
+        state = engine.GameState()
+        referee = engine.Referee(state, rules)
+        result = None
+        while result is None:
+            if state.a_turn:
+                state.move(*player(state))
+            else:
+                do_random_move(state)
+            result = referee.update(state)
+        counts[result] += 1
+        moves += referee.num_moves
+    elapsed = time.time() - start
+    return {"games": num_games, "attacker_wins": counts[1.0], "defender_wins": counts[-1.0],
+            "draws": counts[0.0], "moves": moves, "games_per_sec": num_games / elapsed}
+
+def cli(argv=None):
+    """ Command line front end; see the module docstring for examples
+    """
+    parser = argparse.ArgumentParser(description="Play, train and evaluate Hnefatafl players.")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser("play", help="play a game in a window")
+    p.add_argument("--mode", choices=["hahd","hacd","cahd","random"], default="hahd",
+                   help="human/computer attacker and defender, or random moves")
+    p.add_argument("--time", type=float, default=1.0, help="seconds per computer move")
+    p.add_argument("--eval", help="weights for the computer's static evaluation (.json)")
+    p.add_argument("--mcts", type=int, metavar="SIMS",
+                   help="play the computer with Monte Carlo Tree Search, SIMS simulations per move")
+    s = commands.add_parser("selfplay", help="play the attacker model against random moves")
+    s.add_argument("--model", help="attacker model (.h5, .npz or static evaluation .json); a new one if not given")
+    s.add_argument("--games", type=int, default=100)
+    s.add_argument("--batch-size", type=int, default=256)
+    s.add_argument("--record", help="file to append the games to (see hnefatafl_record.py)")
+    t = commands.add_parser("train", help="train the attacker model by self-play")
+    t.add_argument("--model", default='attacker_model_after_340_games.h5',
+                   help="saved Keras model to start from (.h5); 'new' for a new one")
+    t.add_argument("--games-trained", type=int, default=340,
+                   help="number of games the saved model was trained on")
+    t.add_argument("--workers", type=int, default=0, help="self-play worker processes")
+    t.add_argument("--batch-size", type=int, default=0, help="games to play at once in this process")
+    t.add_argument("--server", help="Unix socket for an inference server shared by the workers")
+    t.add_argument("--replay", help="directory to keep games in and train from")
+    t.add_argument("--replay-window", type=int, help="number of recent replay shards to train from")
+    t.add_argument("--pipelined", action="store_true",
+                   help="overlap self-play, loading, fitting and saving (needs --replay)")
+    e = commands.add_parser("eval", help="report how often a model beats random moves")
+    e.add_argument("model", help="attacker model (.h5, .npz or static evaluation .json)")
+    e.add_argument("--games", type=int, default=200)
+    e.add_argument("--mcts", type=int, metavar="SIMS",
+                   help="search the attacker's moves with Monte Carlo Tree Search, SIMS simulations per move")
+    commands.add_parser("bench", help="run hnefatafl_bench.py", add_help=False)
+    args, rest = parser.parse_known_args(argv)
+
+    if args.command == "train" and args.pipelined and not args.replay:
+        parser.error("--pipelined needs --replay")
+    if (args.command == "train" and args.model != 'new' and
+            not args.model.endswith(".h5")):
+        # NumPy and static evaluation models cannot be fitted
+        parser.error("--model must be a Keras model (.h5) or 'new', not {}".format(args.model))
+    if args.command == "bench":
+        import hnefatafl_bench
+        return hnefatafl_bench.main(rest)
+    if rest:
+        parser.error("unrecognized arguments: {}".format(" ".join(rest)))
+
+    if args.command == "play":
+        evaluator = None if args.eval is None else StaticEvaluator.load(args.eval)
+        import pygame
+        import hnefatafl as tafl
+        pygame.init()
+        screen = pygame.display.set_mode(tafl.WINDOW_SIZE)
+        if args.mode == "hahd":
+            run_game_hahd(screen)
+        elif args.mode == "hacd":
+            run_game_hacd(screen, args.time, evaluator, args.mcts)
+        elif args.mode == "cahd":
+            run_game_cahd(screen, args.time, evaluator, args.mcts)
+        else:
+            run_game_random(screen)
+    elif args.command == "selfplay":
+        if args.model is None:
+            model = initialize_random_nn_model()
+        else:
+            model = load_attacker_model(args.model)
+        if args.record:
+            with RecordWriter(args.record) as writer:
+                print(selfplay(model, args.games, args.batch_size, writer))
+        else:
+            print(selfplay(model, args.games, args.batch_size))
+    elif args.command == "eval":
+        model = load_attacker_model(args.model)
+        if args.mcts:
+            results = mcts_selfplay(model, args.games, args.mcts)
+        else:
+            results = selfplay(model, args.games)
+        print("Attacker model won {} of {} games against random defenders ({:.1f}%), lost {}, drew {}".format(
+              results["attacker_wins"], args.games, 100. * results["attacker_wins"] / args.games,
+              results["defender_wins"], results["draws"]))
+    elif args.command == "train":
+        main(args.workers, args.batch_size, args.server,
+             None if args.model == 'new' else args.model, args.games_trained,
+             args.replay, args.replay_window, args.pipelined)
+    else:
+        main()
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(cli())
@@ -0,0 +1,520 @@
+"""
+Vectorized Hnefatafl environment for batched self-play.
+
+VecGame holds many games at once as rows of a (B, 121) int8 NumPy array in
+the encoding of hnefatafl_train.game_state_to_array (0 empty, 1 attacker,
+2 defender, 3 king), indexed by the square numbers of hnefatafl_engine.
+Legal moves, captures and the end of every game are worked out for all the
+games in a handful of array operations, and finished games are started
+again automatically, so a single model call per step can serve thousands
+of games.
+
+A move is an action index, (direction * 10 + distance - 1) * 121 + sq, for
+a piece on square sq sliding 1 to 10 squares in one of four directions.
+NUM_ACTIONS indices cover every move, so the legal moves of a batch of
+games are a (B, NUM_ACTIONS) bool mask. Actions are ordered so that the
+mask is built by shifting whole boards, one direction and distance at a
+time, rather than by looking at every square on its own.
+
+The rules are the same as hnefatafl_engine.GameState, including that a
+side with no legal moves loses. Games also end on a repeated position, as
+with an engine.Referee: every row is hashed with the Zobrist keys of the
+engine, so its hash equals GameState.hash, and the hashes of every game's
+positions are kept in a (B, limit + 1) array. Encirclement, edge forts and
+forced escapes are checked as by the Referee: the first two for the whole
+batch with array operations, and edge forts with engine.edge_fort on a
+GameState of the few boards where the king is on the edge.
+
+"""
+
+import numpy as np
+import hnefatafl_engine as engine
+from hnefatafl_engine import DIM, NUM_SQUARES
+
+EMPTY = 0
+ATTACKER = 1
+DEFENDER = 2
+KING = 3
+
+MAX_DISTANCE = DIM - 1
+NUM_ACTIONS = NUM_SQUARES * 4 * MAX_DISTANCE
+
+# Off-board squares are mapped to an extra column that is always empty
+OFF_BOARD = NUM_SQUARES
+
+# Square reached by every direction and distance from every square, with
+# directions in the order of engine.SHIFTS: +y, +x, -y, -x
+DIRECTIONS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+TARGETS = np.full((4, MAX_DISTANCE, NUM_SQUARES), OFF_BOARD, dtype=np.intp)
+for _sq in range(NUM_SQUARES):
+    _x, _y = engine.coords(_sq)
+    for _d, (_dx, _dy) in enumerate(DIRECTIONS):
+        for _k in range(MAX_DISTANCE):
+            _tx = _x + _dx * (_k + 1)
+            _ty = _y + _dy * (_k + 1)
+            if 0 <= _tx < DIM and 0 <= _ty < DIM:
+                TARGETS[_d, _k, _sq] = engine.square(_tx, _ty)
+
+ACTION_FROM = np.tile(np.arange(NUM_SQUARES), 4 * MAX_DISTANCE)
+ACTION_TO = TARGETS.reshape(NUM_ACTIONS)
+ADJACENT = TARGETS[:, 0].T.copy()
+BEYOND = TARGETS[:, 1].T.copy()
+
+
+def _slices(delta, k):
+    if delta > 0:
+        return slice(0, DIM - k), slice(k, DIM)
+    if delta < 0:
+        return slice(k, DIM), slice(0, DIM - k)
+    return slice(None), slice(None)
+
+
+# For every direction and distance, the part of an (N, 11, 11) board whose
+# pieces land on the board, and the part they land on
+SLIDES = []
+for _d, (_dx, _dy) in enumerate(DIRECTIONS):
+    for _k in range(1, MAX_DISTANCE + 1):
+        (_fx, _tx), (_fy, _ty) = _slices(_dx, _k), _slices(_dy, _k)
+        SLIDES.append((_d, _k - 1, (slice(None), _fx, _fy),
+                       (slice(None), _tx, _ty)))
+
+
+def _bitboard_mask(bb):
+    return np.array([bool(bb >> sq & 1) for sq in range(NUM_SQUARES + 1)])
+
+
+SPECIAL = _bitboard_mask(engine.SPECIAL)
+CORNERS = _bitboard_mask(engine.CORNERS)
+EDGES = _bitboard_mask(engine.EDGES)
+EDGE_SQUARES = np.flatnonzero(EDGES[:NUM_SQUARES])
+EDGE_GRID = EDGES[:NUM_SQUARES].reshape(DIM, DIM)
+
+# The squares of the king's lines to a corner from every square, as in
+# engine.CORNER_RAYS, and which of the two lines there are
+CORNER_RAYS = np.zeros((NUM_SQUARES, 2, NUM_SQUARES), dtype=bool)
+HAS_CORNER_RAY = np.zeros((NUM_SQUARES, 2), dtype=bool)
+for _sq in range(NUM_SQUARES):
+    for _i, _ray in enumerate(engine.CORNER_RAYS[_sq]):
+        CORNER_RAYS[_sq, _i] = _bitboard_mask(_ray)[:NUM_SQUARES]
+        HAS_CORNER_RAY[_sq, _i] = True
+SPECIAL_TARGETS = SPECIAL[TARGETS].reshape(4 * MAX_DISTANCE, NUM_SQUARES)
+
+# Zobrist keys of the engine by VecGame piece code, zero for empty squares
+ZOBRIST = np.zeros((4, NUM_SQUARES), dtype=np.uint64)
+for _piece, _engine_piece in ((ATTACKER, engine.ATTACKER),
+                              (DEFENDER, engine.DEFENDER),
+                              (KING, engine.KING)):
+    ZOBRIST[_piece] = engine.ZOBRIST[_engine_piece]
+ZOBRIST_SIDE = np.uint64(engine.ZOBRIST_SIDE)
+SQUARES = np.arange(NUM_SQUARES)
+
+
+def board_from_state(state):
+    """Encode a GameState as a row of a VecGame.
+
+    Args:
+        state (GameState): the position
+
+    Returns:
+        (numpy.ndarray): int8 array of 121 squares
+    """
+    board = np.zeros(NUM_SQUARES, dtype=np.int8)
+    for piece, bb in ((ATTACKER, state.attackers), (DEFENDER, state.defenders),
+                      (KING, state.king)):
+        board[list(engine.iter_squares(bb))] = piece
+    return board
+
+
+def state_from_board(board, a_turn=True):
+    """Decode a row of a VecGame into a GameState.
+
+    Args:
+        board (numpy.ndarray): 121 squares in the VecGame encoding
+        a_turn (bool): True if the attackers are to move
+
+    Returns:
+        (GameState): the position
+    """
+    tiles = ".adc"
+    grid = ["".join(tiles[board[engine.square(x, y)]] for x in range(DIM))
+            for y in range(DIM)]
+    state = engine.GameState(grid)
+    state.a_turn = bool(a_turn)
+    state.hash = state.compute_hash()
+    return state
+
+
+def board_hashes(boards, a_turn):
+    """Hash a batch of positions like GameState.hash.
+
+    Args:
+        boards (numpy.ndarray): (N, 121) positions
+        a_turn (numpy.ndarray): (N,) bools, True where the attackers move
+
+    Returns:
+        (numpy.ndarray): (N,) uint64 hashes
+    """
+    hashes = np.bitwise_xor.reduce(ZOBRIST[boards, SQUARES], axis=1)
+    hashes[~np.asarray(a_turn)] ^= ZOBRIST_SIDE
+    return hashes
+
+
+def move_to_action(frm, to):
+    """Convert a (from square, to square) move to an action index."""
+    fx, fy = engine.coords(frm)
+    tx, ty = engine.coords(to)
+    dx, dy = tx - fx, ty - fy
+    distance = abs(dx) + abs(dy)
+    d = DIRECTIONS.index((dx // distance, dy // distance))
+    return (d * MAX_DISTANCE + distance - 1) * NUM_SQUARES + frm
+
+
+def action_to_move(action):
+    """Convert an action index to a (from square, to square) move."""
+    return int(ACTION_FROM[action]), int(ACTION_TO[action])
+
+
+def legal_mask(boards, a_turn):
+    """Find the legal moves of a batch of positions.
+
+    Args:
+        boards (numpy.ndarray): (N, 121) positions
+        a_turn (numpy.ndarray): (N,) bools, True where the attackers move
+
+    Returns:
+        (numpy.ndarray): (N, NUM_ACTIONS) bool mask of legal actions
+    """
+    n = len(boards)
+    free = (boards == EMPTY).reshape(n, DIM, DIM)
+    reach = np.zeros((n, 4, MAX_DISTANCE, DIM, DIM), dtype=bool)
+    # A piece can slide as far as the squares before it are empty
+    for d, k, frm, to in SLIDES:
+        if k:
+            np.logical_and(reach[:, d, k - 1][frm], free[to],
+                           out=reach[:, d, k][frm])
+        else:
+            reach[:, d, k][frm] = free[to]
+    reach = reach.reshape(n, 4 * MAX_DISTANCE, NUM_SQUARES)
+    a_turn = np.asarray(a_turn)[:, None]
+    own = np.where(a_turn, boards == ATTACKER, boards >= DEFENDER)
+    reach &= own[:, None, :]
+    # Only the king may stop on the center and corners
+    reach &= ~(SPECIAL_TARGETS & (boards != KING)[:, None, :])
+    return reach.reshape(n, NUM_ACTIONS)
+
+
+def forced_escapes(boards, a_turn):
+    """Check a batch of positions like engine.forced_escape.
+
+    Args:
+        boards (numpy.ndarray): (N, 121) positions with a king on the board
+        a_turn (numpy.ndarray): (N,) bools, True where the attackers move
+
+    Returns:
+        (numpy.ndarray): (N,) bools, True where the king escapes within two
+                         moves whatever the attackers do
+    """
+    king_sq = np.argmax(boards == KING, axis=1)
+    occupied = (boards != EMPTY)[:, None, :]
+    blocked = (CORNER_RAYS[king_sq] & occupied).any(axis=2)
+    routes = np.count_nonzero(HAS_CORNER_RAY[king_sq] & ~blocked, axis=1)
+    return (routes >= 2) | ((routes == 1) & ~a_turn)
+
+
+def encircled(boards):
+    """Check a batch of positions like engine.encircled.
+
+    The defenders are spread over the squares free of attackers until every
+    board has either reached the edge or stopped growing.
+
+    Args:
+        boards (numpy.ndarray): (N, 121) positions
+
+    Returns:
+        (numpy.ndarray): (N,) bools, True where no defender and not the king
+                         can reach the edge of the board
+    """
+    result = np.zeros(len(boards), dtype=bool)
+    games = np.arange(len(boards))
+    free = (boards != ATTACKER).reshape(-1, DIM, DIM)
+    region = (boards >= DEFENDER).reshape(-1, DIM, DIM)
+    while len(games):
+        inside = ~(region & EDGE_GRID).any(axis=(1, 2))
+        grown = region.copy()
+        grown[:, 1:] |= region[:, :-1]
+        grown[:, :-1] |= region[:, 1:]
+        grown[:, :, 1:] |= region[:, :, :-1]
+        grown[:, :, :-1] |= region[:, :, 1:]
+        grown &= free
+        stopped = inside & (grown == region).all(axis=(1, 2))
+        result[games[stopped]] = True
+        growing = inside & ~stopped
+        games = games[growing]
+        free = free[growing]
+        region = grown[growing]
+    return result
+
+
+def apply_moves(boards, actions):
+    """Play one move in each of a batch of positions, in place.
+
+    Captures are resolved as in GameState.find_captures: an opponent's
+    piece next to the moved piece is captured if the square beyond it holds
+    one of the mover's pieces or is an empty center or corner square, and
+    the king is captured by an attacker completing the enclosure around it
+    away from the edge.
+
+    Args:
+        boards (numpy.ndarray): (N, 121) positions, changed in place
+        actions (numpy.ndarray): (N,) legal action of every position
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): (N,) bools, True where the king was
+                                        killed, and True where it escaped
+    """
+    n = len(boards)
+    rows = np.arange(n)
+    frm = ACTION_FROM[actions]
+    to = ACTION_TO[actions]
+    piece = boards[rows, frm]
+    boards[rows, to] = piece
+    boards[rows, frm] = EMPTY
+    escaped = (piece == KING) & CORNERS[to]
+    attacker = piece == ATTACKER
+
+    padded = np.zeros((n, NUM_SQUARES + 1), dtype=np.int8)
+    padded[:, :NUM_SQUARES] = boards
+    adjacent = ADJACENT[to]
+    beyond = BEYOND[to]
+    near = padded[rows[:, None], adjacent]
+    far = padded[rows[:, None], beyond]
+    attacker = attacker[:, None]
+    enemy = np.where(attacker, near == DEFENDER, near == ATTACKER)
+    hostile = (np.where(attacker, far == ATTACKER, far >= DEFENDER) |
+               (SPECIAL[beyond] & (far == EMPTY)))
+    captured = enemy & hostile
+
+    king_killed = np.zeros(n, dtype=bool)
+    threat = attacker[:, 0] & (near == KING).any(axis=1)
+    if threat.any():
+        t = np.flatnonzero(threat)
+        king_sq = np.argmax(boards[t] == KING, axis=1)
+        around = ADJACENT[king_sq]
+        enclosed = ((padded[t[:, None], around] == ATTACKER) |
+                    SPECIAL[around]).all(axis=1)
+        enclosed &= ~EDGES[king_sq]
+        boards[t[enclosed], king_sq[enclosed]] = EMPTY
+        king_killed[t[enclosed]] = True
+
+    r, d = np.nonzero(captured)
+    boards[r, adjacent[r, d]] = EMPTY
+    return king_killed, escaped
+
+
+class VecGame(object):
+
+    """A batch of games played in lockstep.
+
+    Attributes:
+        boards (numpy.ndarray): (B, 121) int8 positions
+        a_turn (numpy.ndarray): (B,) bools, True where the attackers move
+        num_moves (numpy.ndarray): (B,) moves played in every game
+        history (numpy.ndarray): (B, limit + 1) hashes of the positions of
+                                 every game, by move number
+        games_played (int): number of games finished so far
+    """
+
+    def __init__(self, num_games, grid=None, limit=1000, repetition=3,
+                 repetition_result=0.0, encirclement=True, edge_fort=True,
+                 forced_escape=True):
+        """Start a batch of games.
+
+        Args:
+            num_games (int): number of games to play at once
+            grid (list(str)): starting layout in the format of Board.grid,
+                              defaults to the normal starting layout
+            limit (int): moves per game before it is called a draw
+            repetition (int): a game ends once a position, with the same
+                              side to move, occurs this many times; None to
+                              allow repeats
+            repetition_result (float): result of a game ended by repetition
+            encirclement (bool): the attackers win by shutting in the king
+                                 and every defender
+            edge_fort (bool): the defenders win by building an edge fort
+            forced_escape (bool): the defenders win as soon as the king has
+                                  an escape the attackers cannot stop
+        """
+        self.num_games = num_games
+        self.limit = limit
+        self.repetition = repetition
+        self.repetition_result = repetition_result
+        self.encirclement = encirclement
+        self.edge_fort = edge_fort
+        self.forced_escape = forced_escape
+        self.start = board_from_state(engine.GameState(grid))
+        self.start_hash = board_hashes(self.start[None], [True])[0]
+        self.boards = np.repeat(self.start[None], num_games, axis=0)
+        self.a_turn = np.ones(num_games, dtype=bool)
+        self.num_moves = np.zeros(num_games, dtype=np.int32)
+        self.history = np.zeros((num_games, limit + 1), dtype=np.uint64)
+        self.history[:, 0] = self.start_hash
+        self.games_played = 0
+        self.mask = legal_mask(self.boards, self.a_turn)
+
+    def legal_mask(self):
+        """Return the (B, NUM_ACTIONS) mask of legal actions of every game.
+
+        Every game has at least one legal move, since games where the side
+        to move is stuck are finished and started again by step.
+        """
+        return self.mask
+
+    def random_actions(self, rng=np.random):
+        """Pick a legal action uniformly at random in every game.
+
+        Args:
+            rng (numpy.random.RandomState): source of random numbers
+
+        Returns:
+            (numpy.ndarray): (B,) action indices
+        """
+        # Pick a direction and distance first, then the piece, so that only
+        # small arrays are counted through
+        games = np.arange(self.num_games)
+        mask = self.mask.reshape(self.num_games, 4 * MAX_DISTANCE, NUM_SQUARES)
+        counts = mask.sum(axis=2, dtype=np.int32)
+        totals = np.cumsum(counts, axis=1)
+        r = (rng.random_sample(self.num_games) * totals[:, -1]).astype(np.int32)
+        slide = np.argmax(totals > r[:, None], axis=1)
+        r -= totals[games, slide] - counts[games, slide]
+        pieces = np.cumsum(mask[games, slide], axis=1, dtype=np.int32)
+        sq = np.argmax(pieces > r[:, None], axis=1)
+        return slide * NUM_SQUARES + sq
+
+    def successors(self, games=None):
+        """Play every legal move of some games on a copy of their boards.
+
+        Args:
+            games (numpy.ndarray): sorted indices of the games, or None for
+                                   every game
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): for each of the N
+                legal moves of the games, the game it belongs to, its action
+                and the (N, 121) positions after it, grouped by game
+        """
+        if games is None:
+            games = np.arange(self.num_games)
+        index, actions = np.nonzero(self.mask[games])
+        games = games[index]
+        boards = self.boards[games]
+        apply_moves(boards, actions)
+        return games, actions, boards
+
+    def best_successors(self, games, scores):
+        """Pick the highest scoring successor of every game.
+
+        Args:
+            games (numpy.ndarray): game of every successor, as returned by
+                                   successors
+            scores (numpy.ndarray): (N,) score of every successor
+
+        Returns:
+            (numpy.ndarray): index of the best successor of each game in
+                             games, in order of the games
+        """
+        order = np.lexsort((-np.asarray(scores), games))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = games[order][1:] != games[order][:-1]
+        return order[first]
+
+    def step(self, actions):
+        """Play one move in every game and restart the games that end.
+
+        Args:
+            actions (numpy.ndarray): (B,) legal action of every game
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): (B,) bools, True
+                for the games that ended, with their results (1.0 if the
+                attackers won, -1.0 if the defenders won, 0.0 for a draw)
+                and number of moves; finished games are reset afterwards
+        """
+        king_killed, escaped = apply_moves(self.boards, actions)
+        self.a_turn = ~self.a_turn
+        self.num_moves += 1
+        results = np.zeros(self.num_games)
+        results[king_killed] = 1.0
+        results[escaped] = -1.0
+        done = king_killed | escaped
+
+        if self.repetition is not None:
+            hashes = board_hashes(self.boards, self.a_turn)
+            self.history[np.arange(self.num_games), self.num_moves] = hashes
+            # Only the moves played so far in the longest game can match
+            played = self.history[:, :self.num_moves.max() + 1]
+            repeats = np.count_nonzero(played == hashes[:, None], axis=1)
+            repeated = ~done & (repeats >= self.repetition)
+            results[repeated] = self.repetition_result
+            done |= repeated
+
+        if self.encirclement or self.edge_fort or self.forced_escape:
+            self._check_rules(done, results)
+
+        self.mask = legal_mask(self.boards, self.a_turn)
+        stuck = ~done & ~self.mask.any(axis=1)
+        # A side with no legal moves loses
+        results[stuck] = np.where(self.a_turn[stuck], -1.0, 1.0)
+        done |= stuck
+        done |= self.num_moves >= self.limit
+        lengths = self.num_moves.copy()
+
+        if done.any():
+            self.games_played += int(done.sum())
+            self.reset(np.flatnonzero(done))
+        return done, results, lengths
+
+    def _check_rules(self, done, results):
+        # An escape or an edge fort needs the king on the edge, and the
+        # defenders can only be encircled if none of them is on the edge
+        playing = ~done
+        edges = self.boards[:, EDGE_SQUARES]
+        king_on_edge = playing & (edges == KING).any(axis=1)
+        if self.encirclement:
+            games = np.flatnonzero(playing & ~self.a_turn &
+                                   ~(edges >= DEFENDER).any(axis=1))
+            games = games[encircled(self.boards[games])]
+            results[games] = 1.0
+            done[games] = True
+        if self.forced_escape:
+            games = np.flatnonzero(king_on_edge)
+            games = games[forced_escapes(self.boards[games],
+                                         self.a_turn[games])]
+            results[games] = -1.0
+            done[games] = True
+        if self.edge_fort:
+            for game in np.flatnonzero(king_on_edge & ~done & self.a_turn):
+                if engine.edge_fort(self.state(game)):
+                    results[game] = -1.0
+                    done[game] = True
+
+    def reset(self, games=None):
+        """Start some or all of the games again from the starting layout.
+
+        Args:
+            games (numpy.ndarray): indices of the games to reset, or None
+                                   for every game
+        """
+        if games is None:
+            games = np.arange(self.num_games)
+        self.boards[games] = self.start
+        self.a_turn[games] = True
+        self.num_moves[games] = 0
+        self.history[games] = 0
+        self.history[games, 0] = self.start_hash
+        self.mask[games] = legal_mask(self.boards[games], self.a_turn[games])
+
+    def state(self, game):
+        """Return one of the games as a GameState."""
+        return state_from_board(self.boards[game], self.a_turn[game])
+